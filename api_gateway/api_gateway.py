@@ -1,11 +1,16 @@
+import concurrent.futures
 import functools
 import json
 import logging
+import os
 
 from flask import Flask, request, render_template
 from flask_socketio import SocketIO, send, emit
 
 from event_store.event_store_client import EventStoreClient
+from lib.cart_items import get_items
+from lib.read_batch import ReadBatch
+from lib.service_calls import ServiceCalls, gather
 from message_queue.message_queue_client import send_message, send_message_async
 
 
@@ -16,11 +21,15 @@ socketio = SocketIO(app)
 logging.basicConfig(level=logging.ERROR)
 
 event_store = EventStoreClient()
+service_calls = ServiceCalls(_send_message=send_message)
+
+REPORT_TIMEOUT = float(os.getenv('API_GATEWAY_REPORT_TIMEOUT', '30'))
+REPORT_MAIL_PAGE = int(os.getenv('API_GATEWAY_REPORT_MAIL_PAGE', '10000'))
 
 
 def _send_message(_service_name, _func_name, _add_params=None, _async=False):
     """
-    Helper function to send a message to a service.
+    Helper function to send a message to a service, an 'Idempotency-Key' header is passed on as parameter.
 
     :param _service_name: The name of the service to call.
     :param _func_name: The name of the function to call.
@@ -35,6 +44,9 @@ def _send_message(_service_name, _func_name, _add_params=None, _async=False):
     if _add_params:
         params.update(_add_params)
 
+    if 'Idempotency-Key' in request.headers and isinstance(params, dict):
+        params['idempotency_key'] = request.headers['Idempotency-Key']
+
     if _async:
         return {
             "result": send_message_async(_service_name, _func_name, params)
@@ -89,6 +101,12 @@ def get_billings(billing_id=None):
     return _read_model('billing', billing_id)
 
 
+@app.route('/billings/reconciliation', methods=['GET'])
+def reconcile_billings():
+
+    return _send_message('billing-service', 'reconcile_billings')
+
+
 @app.route('/billing', methods=['POST'])
 def create_billing():
 
@@ -138,6 +156,24 @@ def update_cart(cart_id):
     return _send_message('cart-service', 'update_cart', {'entity_id': cart_id})
 
 
+@app.route('/cart/<cart_id>', methods=['PATCH'])
+def patch_cart(cart_id):
+
+    return _send_message('cart-service', 'patch_cart', {'entity_id': cart_id})
+
+
+@app.route('/cart/<cart_id>/item', methods=['POST'])
+def add_cart_item(cart_id):
+
+    return _send_message('cart-service', 'add_item', {'entity_id': cart_id})
+
+
+@app.route('/cart/<cart_id>/item/<product_id>', methods=['DELETE'])
+def remove_cart_item(cart_id, product_id):
+
+    return _send_message('cart-service', 'remove_item', {'entity_id': cart_id, 'product_id': product_id})
+
+
 @app.route('/cart/<cart_id>', methods=['DELETE'])
 def delete_cart(cart_id):
 
@@ -147,6 +183,9 @@ def delete_cart(cart_id):
 @app.route('/customers', methods=['GET'])
 @app.route('/customer/<customer_id>', methods=['GET'])
 def get_customers(customer_id=None):
+    if not customer_id and 'email' in request.args:
+        params = {'name': 'customer', 'props': {'email': request.args['email']}}
+        return _send_message('read-model', 'get_entities', params)
 
     return _read_model('customer', customer_id)
 
@@ -169,6 +208,12 @@ def update_customer(customer_id):
     return _send_message('customer-service', 'update_customer', {'entity_id': customer_id})
 
 
+@app.route('/customer/<customer_id>', methods=['PATCH'])
+def patch_customer(customer_id):
+
+    return _send_message('customer-service', 'patch_customer', {'entity_id': customer_id})
+
+
 @app.route('/customer/<customer_id>', methods=['DELETE'])
 def delete_customer(customer_id):
 
@@ -200,6 +245,12 @@ def update_inventory(inventory_id):
     return _send_message('inventory-service', 'update_inventory', {'entity_id': inventory_id})
 
 
+@app.route('/inventory/<inventory_id>', methods=['PATCH'])
+def patch_inventory(inventory_id):
+
+    return _send_message('inventory-service', 'patch_inventory', {'entity_id': inventory_id})
+
+
 @app.route('/inventory/<inventory_id>', methods=['DELETE'])
 def delete_inventory(inventory_id):
 
@@ -227,8 +278,16 @@ def get_unshipped_orders():
 
 @app.route('/orders/delivered', methods=['GET'])
 def get_delivered_orders():
+    params = {name: request.args[name] for name in ['from', 'to'] if name in request.args}
 
-    return _send_message('read-model', 'get_delivered_orders')
+    return _send_message('read-model', 'get_delivered_orders', params)
+
+
+@app.route('/orders/undelivered', methods=['GET'])
+def get_undelivered_orders():
+    params = {name: request.args[name] for name in ['before'] if name in request.args}
+
+    return _send_message('read-model', 'get_undelivered_orders', params)
 
 
 @app.route('/order', methods=['POST'])
@@ -249,6 +308,12 @@ def update_order(order_id):
     return _send_message('order-service', 'update_order', {'entity_id': order_id})
 
 
+@app.route('/order/<order_id>', methods=['PATCH'])
+def patch_order(order_id):
+
+    return _send_message('order-service', 'patch_order', {'entity_id': order_id})
+
+
 @app.route('/order/<order_id>', methods=['DELETE'])
 def delete_order(order_id):
 
@@ -274,12 +339,24 @@ def create_products():
     return _send_message('product-service', 'create_products', _async=True)
 
 
+@app.route('/products', methods=['PUT'])
+def upsert_products():
+
+    return _send_message('product-service', 'upsert_products')
+
+
 @app.route('/product/<product_id>', methods=['PUT'])
 def put_prodcut(product_id):
 
     return _send_message('product-service', 'update_product', {'entity_id': product_id})
 
 
+@app.route('/product/<product_id>', methods=['PATCH'])
+def patch_product(product_id):
+
+    return _send_message('product-service', 'patch_product', {'entity_id': product_id})
+
+
 @app.route('/product/<product_id>', methods=['DELETE'])
 def del_prodcut(product_id):
 
@@ -305,6 +382,12 @@ def create_shippings():
     return _send_message('shipping-service', 'create_shippings', _async=True)
 
 
+@app.route('/shippings/delivered', methods=['POST'])
+def mark_delivered():
+
+    return _send_message('shipping-service', 'mark_delivered')
+
+
 @app.route('/shipping/<shipping_id>', methods=['PUT'])
 def update_shipping(shipping_id):
 
@@ -319,23 +402,57 @@ def delete_shipping(shipping_id):
 
 @app.route('/mails/sent', methods=['GET'])
 def get_sent_mails():
+    params = {name: request.args[name] for name in ['to', 'since', 'limit', 'cursor'] if name in request.args}
 
-    return _send_message('read-model', 'get_mails')
+    return _send_message('read-model', 'get_mails', params)
 
 
 @app.route('/report', methods=['GET'])
 def get_report():
-    return {
-        "result": {
-            "billings": _read_model('billing')['result'],
-            "carts": _read_model('cart')['result'],
-            "customers": _read_model('customer')['result'],
-            "inventory": _read_model('inventory')['result'],
-            "orders": _read_model('order')['result'],
-            "products": _read_model('product')['result'],
-            "shippings": _read_model('shipping')['result'],
-            "mails": _send_message('read-model', 'get_mails')['result'],
+    names = {
+        "billings": 'billing',
+        "carts": 'cart',
+        "customers": 'customer',
+        "inventory": 'inventory',
+        "orders": 'order',
+        "products": 'product',
+        "shippings": 'shipping'
+    }
+
+    # query all parts of the report in parallel
+    futures = [service_calls.call('read-model', 'get_entities', {'name': name}) for name in names.values()]
+    futures.append(service_calls.call('read-model', 'get_mails', {'limit': REPORT_MAIL_PAGE}))
+    try:
+        rsps = gather(futures, REPORT_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        return {
+            "error": "timed out querying the report (from read-model)"
         }
+    except Exception as e:
+        return {
+            "error": "could not query the report: {}".format(e)
+        }
+
+    errors = [rsp['error'] for rsp in rsps if 'error' in rsp]
+    if errors:
+        return {
+            "error": errors[0] + ' (from read-model)'
+        }
+
+    result = dict(zip(list(names.keys()) + ['mails'], [rsp['result'] for rsp in rsps]))
+
+    # mails are paged, get the remaining pages, in large pages to save round trips
+    cursor = rsps[-1].get('cursor')
+    while cursor:
+        rsp = send_message('read-model', 'get_mails', {'limit': REPORT_MAIL_PAGE, 'cursor': cursor})
+        if 'error' in rsp:
+            rsp['error'] += ' (from read-model)'
+            return rsp
+        result['mails'] += rsp['result']
+        cursor = rsp.get('cursor')
+
+    return {
+        "result": result
     }
 
 
@@ -343,24 +460,34 @@ def get_report():
 def get_order_report():
     rsp = send_message('read-model', 'get_entities', {'name': 'order'})
     orders = rsp['result']
+
+    # query the related entities of all orders in one round trip
+    batch = ReadBatch()
+    positions = []
     for order in orders:
-        rsp = send_message('read-model', 'get_entity', {'name': 'cart', 'id': order['cart_id']})
-        order['cart'] = rsp['result']
+        cart = batch.get_entity('cart', order['cart_id'])
+        positions.append((cart,
+                          batch.get_entity('customer', ReadBatch.ref(cart, 'customer_id')),
+                          batch.get_entities('product', ReadBatch.ref(cart, 'items')),
+                          batch.get_entities('billing', _props={'order_id': order['entity_id']}),
+                          batch.get_entities('shipping', _props={'order_id': order['entity_id']})))
+    results = batch.send() if orders else []
+
+    for order, (cart, customer, products, billings, shippings) in zip(orders, positions):
+        order['cart'] = results[cart]
         del order['cart_id']
 
-        rsp = send_message('read-model', 'get_entity', {'name': 'customer', 'id': order['cart']['customer_id']})
-        order['cart']['customer'] = rsp['result']
-        del order['cart']['customer_id']
-
-        rsp = send_message('read-model', 'get_entities', {'name': 'product', 'ids': order['cart']['product_ids']})
-        order['cart']['products'] = rsp['result']
-        del order['cart']['product_ids']
-
-        rsp = send_message('read-model', 'get_entities', {'name': 'billing', 'props': {'order_id': order['entity_id']}})
-        order['billings'] = rsp['result']
-
-        rsp = send_message('read-model', 'get_entities', {'name': 'shipping', 'props': {'order_id': order['entity_id']}})
-        order['shippings'] = rsp['result']
+        if order['cart']:
+            items = get_items(order['cart'])
+            order['cart']['customer'] = results[customer]
+            del order['cart']['customer_id']
+            order['cart']['products'] = [dict(product, quantity=quantity) if product else None
+                                         for product, quantity in zip(results[products] or [], items.values())]
+            order['cart'].pop('items', None)
+            order['cart'].pop('product_ids', None)
+
+        order['billings'] = results[billings]
+        order['shippings'] = results[shippings]
 
     return {
         "result": orders
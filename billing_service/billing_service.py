@@ -1,21 +1,55 @@
-import json
+import concurrent.futures
+import functools
 import logging
+import math
+import os
 import signal
+import threading
 import uuid
 
 from event_store.event_store_client import EventStoreClient, create_event
+from lib.bloom_filter import RotatingBloomFilter
+from lib.cart_items import ITEM_ACTIONS, apply_item, get_items
+from lib.event_dispatcher import EventDispatcher
+from lib.event_publisher import EventPublisher
+from lib.event_replay import EventReplay
+from lib.idempotency_keys import IdempotencyKeys
+from lib.product_catalogue import ProductCatalogue
+from lib.read_batch import ReadBatch
+from lib.service_calls import ServiceCalls, gather
 from message_queue.message_queue_client import Consumers, send_message
+from reconciliation import reconcile
 
 
 class BillingService(object):
     """
     Billing Service class.
     """
-    def __init__(self):
+    def __init__(self, _call_workers=16, _call_timeout=10):
+        """
+        :param _call_workers: The maximum amount of parallel calls to other services.
+        :param _call_timeout: The time in seconds to wait for the response of a call to another service.
+        """
         self.event_store = EventStoreClient()
+        self.publisher = EventPublisher(self.event_store)
+        self.calls = ServiceCalls(_call_workers)
+        self.call_workers = _call_workers
+        self.call_timeout = _call_timeout
         self.consumers = Consumers('billing-service', [self.create_billings,
                                                        self.update_billing,
-                                                       self.delete_billing])
+                                                       self.delete_billing,
+                                                       self.reconcile_billings])
+        self.idempotency = IdempotencyKeys()
+        self.index = {
+            'product': ProductCatalogue(),
+            'cart': {},
+            'order': {}
+        }
+        self.index_lock = threading.Lock()
+        self.replay = EventReplay(self._apply_event, self.index_lock, list(self.index.keys()))
+        self.dispatcher = EventDispatcher(self.event_store, None, RotatingBloomFilter())
+        for name in self.index.keys():
+            self.dispatcher.register(name, functools.partial(self.entity_changed, name))
 
     @staticmethod
     def _create_entity(_order_id, _amount):
@@ -33,54 +67,182 @@ class BillingService(object):
         }
 
     @staticmethod
-    def _check_amount(_billing):
-        rsp = send_message('read-model', 'get_entity', {'name': 'order', 'id': _billing['order_id']})
-        order = rsp['result']
+    def _index_value(_name, _entity):
+        """
+        Get the indexed value of an entity, i.e. the items of a cart or the cart ID of an order.
 
-        rsp = send_message('read-model', 'get_entity', {'name': 'cart', 'id': order['cart_id']})
-        cart = rsp['result']
+        :param _name: The entity name.
+        :param _entity: The entity.
+        :return: The indexed value.
+        """
+        if _name == 'cart':
+            return get_items(_entity)
+        if _name == 'order':
+            return _entity['cart_id']
 
-        rsp = send_message('read-model', 'get_entities', {'name': 'product', 'ids': cart['product_ids']})
-        products = rsp['result']
+    def _apply_event(self, _name, _action, _entity):
+        """
+        Apply an entity event to the index.
 
-        amount = sum([int(product['price']) for product in products])
+        :param _name: The entity name.
+        :param _action: The event action.
+        :param _entity: The entity.
+        """
+        if _name == 'product':
+            self.index['product'].apply(_action, _entity)
+        elif _action == 'entity_deleted':
+            self.index[_name].pop(_entity['entity_id'], None)
+        elif _action in ('entity_created', 'entity_updated'):
+            self.index[_name][_entity['entity_id']] = BillingService._index_value(_name, _entity)
+        elif _action == 'entity_patched' and _entity['entity_id'] in self.index[_name]:
+            if {'items', 'product_ids', 'cart_id'} & _entity.keys():
+                self.index[_name][_entity['entity_id']] = BillingService._index_value(_name, _entity)
+        elif _action in ITEM_ACTIONS and _entity['entity_id'] in self.index[_name]:
+            items = self.index[_name][_entity['entity_id']]
+            self.index[_name][_entity['entity_id']] = apply_item(items, _action, _entity)
+
+    def _load_index(self, _name):
+        """
+        Build the index of an entity from its event history, events received meanwhile are applied afterwards.
 
-        return amount == int(_billing['amount'])
+        :param _name: The entity name.
+        """
+        self.replay.replay(self.event_store, _name)
+
+        logging.info('indexed {} {}s'.format(len(self.index[_name]), _name))
+
+    def _query_amounts(self, _order_ids):
+        """
+        Query the total amounts of orders from the read model, the orders are queried in parallel.
+
+        :param _order_ids: A list with order IDs.
+        :return: A list with the total amount per order, None if the order or its cart could not be found, or the
+                 exception if it could not be queried, e.g. a concurrent.futures.TimeoutError.
+        """
+        batches = []
+        for order_id in _order_ids:
+            batch = ReadBatch()
+            order = batch.get_entity('order', order_id)
+            cart = batch.get_entity('cart', ReadBatch.ref(order, 'cart_id'))
+            batch.get_entities('product', ReadBatch.ref(cart, 'items'))
+            batches.append(batch)
+
+        # each call gets the call timeout, the calls run in waves of the amount of workers
+        timeout = self.call_timeout * math.ceil(len(batches) / self.call_workers)
+        rsps = gather([self.calls.call('read-model', 'batch', batch.requests) for batch in batches], timeout, True)
+
+        amounts = []
+        for order_id, rsp in zip(_order_ids, rsps):
+            try:
+                if isinstance(rsp, Exception):
+                    raise rsp
+                _, cart, products = ReadBatch.parse(rsp)
+            except Exception as e:
+                logging.error('could not query amount of order {}: {!r}'.format(order_id, e))
+                amounts.append(e)
+                continue
+
+            if not cart or products is None or not all(products):
+                amounts.append(None)
+                continue
+
+            amounts.append(sum([int(product['price']) * quantity
+                                for product, quantity in zip(products, get_items(cart).values())]))
+
+        return amounts
+
+    def _check_amounts(self, _billings):
+        """
+        Check the amounts of billings in one pass, the totals of all indexed orders are computed at once.
+
+        :param _billings: A list with billings.
+        :return: A list with an error message, or None if the amount is accurate, per billing.
+        """
+        carts = [self.index['cart'].get(self.index['order'].get(billing['order_id'])) for billing in _billings]
+        totals, complete = self.index['product'].totals([items or {} for items in carts])
+
+        # query the orders which are not indexed (yet) all at once
+        missing = [i for i in range(len(_billings)) if carts[i] is None or not complete[i]]
+        queried = dict(zip(missing, self._query_amounts([_billings[i]['order_id'] for i in missing])))
+
+        errors = []
+        for i, billing in enumerate(_billings):
+            amount = queried[i] if i in queried else int(totals[i])
+
+            if isinstance(amount, concurrent.futures.TimeoutError):
+                errors.append('timed out querying order {}'.format(billing['order_id']))
+            elif isinstance(amount, Exception):
+                errors.append('could not query order {}: {}'.format(billing['order_id'], amount))
+            elif amount is None:
+                errors.append('could not find order {}'.format(billing['order_id']))
+            elif amount != int(billing['amount']):
+                errors.append('amount is not accurate')
+            else:
+                errors.append(None)
+
+        return errors
 
     def start(self):
         logging.info('starting ...')
+        self.dispatcher.start()
+        for name in self.index.keys():
+            self._load_index(name)
         self.consumers.start()
         self.consumers.wait()
 
     def stop(self):
+        self.dispatcher.stop()
         self.consumers.stop()
+        self.publisher.stop()
+        self.calls.stop()
         logging.info('stopped.')
 
     def create_billings(self, _req):
         billings = _req if isinstance(_req, list) else [_req]
-        billing_ids = []
+        idempotency_key = _req.get('idempotency_key') if isinstance(_req, dict) else None
 
-        for billing in billings:
-            res = self._check_amount(billing)
-            if not res:
+        # replay a retried request
+        if idempotency_key:
+            billing_id = self.idempotency.replay(idempotency_key)
+            if billing_id:
                 return {
-                    'error': 'amount is not accurate'
+                    "result": [billing_id]
                 }
 
-            try:
-                new_billing = BillingService._create_entity(billing['order_id'], billing['amount'])
-            except KeyError:
+        try:
+            new_billings = [BillingService._create_entity(billing['order_id'], billing['amount'])
+                            for billing in billings]
+        except KeyError:
+            return {
+                "error": "missing mandatory parameter 'order_id' and/or 'amount'"
+            }
+
+        # validate all billings first
+        for error in self._check_amounts(new_billings):
+            if error:
                 return {
-                    "error": "missing mandatory parameter 'order_id' and/or 'amount'"
+                    'error': error
                 }
 
-            # trigger event
-            self.event_store.publish('billing', create_event('entity_created', new_billing))
+        # reserve the idempotency key, a concurrent retry may have been faster
+        if idempotency_key and new_billings:
+            billing_id = self.idempotency.reserve(idempotency_key, new_billings[0]['entity_id'])
+            if billing_id:
+                return {
+                    "result": [billing_id]
+                }
 
-            billing_ids.append(new_billing['entity_id'])
+        # trigger events, release the idempotency key if they could not be published
+        events = [create_event('entity_created', new_billing) for new_billing in new_billings]
+        try:
+            self.publisher.publish_all('billing', events, [new_billing['entity_id'] for new_billing in new_billings])
+        except Exception:
+            if idempotency_key and new_billings:
+                self.idempotency.release(idempotency_key, new_billings[0]['entity_id'])
+            raise
 
         return {
-            "result": billing_ids
+            "result": [new_billing['entity_id'] for new_billing in new_billings]
         }
 
     def update_billing(self, _req):
@@ -91,7 +253,7 @@ class BillingService(object):
                 "error": "missing mandatory parameter 'entity_id'"
             }
 
-        rsp = send_message('read-model', 'get_entitiy', {'name': 'billing', 'id': billing_id})
+        rsp = send_message('read-model', 'get_entity', {'name': 'billing', 'id': billing_id})
         if 'error' in rsp:
             rsp['error'] += ' (from read-model)'
             return rsp
@@ -112,14 +274,14 @@ class BillingService(object):
                 "result": "missing mandatory parameter 'order_id' and/or 'amount"
             }
 
-        res = self._check_amount(billing)
-        if not res:
+        error = self._check_amounts([billing])[0]
+        if error:
             return {
-                'error': 'amount is not accurate'
+                'error': error
             }
 
         # trigger event
-        self.event_store.publish('billing', create_event('entity_updated', billing))
+        self.publisher.publish('billing', create_event('entity_updated', billing)).result()
 
         return {
             "result": True
@@ -133,7 +295,7 @@ class BillingService(object):
                 "error": "missing mandatory parameter 'entity_id'"
             }
 
-        rsp = send_message('read-model', 'get_entitiy', {'name': 'billing', 'id': billing_id})
+        rsp = send_message('read-model', 'get_entity', {'name': 'billing', 'id': billing_id})
         if 'error' in rsp:
             rsp['error'] += ' (from read-model)'
             return rsp
@@ -145,16 +307,36 @@ class BillingService(object):
             }
 
         # trigger event
-        self.event_store.publish('billing', create_event('entity_deleted', billing))
+        self.publisher.publish('billing', create_event('entity_deleted', billing)).result()
 
         return {
             "result": True
         }
 
+    def reconcile_billings(self, _req):
+        rsp = send_message('read-model', 'get_entities', {'name': 'billing'})
+        if 'error' in rsp:
+            rsp['error'] += ' (from read-model)'
+            return rsp
+
+        with self.index_lock:
+            carts = dict(self.index['cart'])
+            orders = dict(self.index['order'])
+
+        return {
+            "result": reconcile(self.index['product'], carts, orders, rsp['result'])
+        }
+
+    def entity_changed(self, _name, _item, _entity):
+        self.replay.receive(_name, _item, _entity)
+
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)-6s] %(message)s')
 
-b = BillingService()
+CALL_WORKERS = int(os.getenv('BILLING_SERVICE_CALL_WORKERS', '16'))
+CALL_TIMEOUT = float(os.getenv('BILLING_SERVICE_CALL_TIMEOUT', '10'))
+
+b = BillingService(_call_workers=CALL_WORKERS, _call_timeout=CALL_TIMEOUT)
 
 signal.signal(signal.SIGINT, lambda n, h: b.stop())
 signal.signal(signal.SIGTERM, lambda n, h: b.stop())
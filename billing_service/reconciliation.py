@@ -0,0 +1,42 @@
+import numpy as np
+
+
+def reconcile(_catalogue, _carts, _orders, _billings):
+    """
+    Reconcile billings against the totals of their orders.
+
+    All cart totals are computed at once by the product catalogue. Billings are resolved to cart positions,
+    unknown orders or carts are mapped to position -1, which holds a sentinel at the end of each array.
+
+    :param _catalogue: The product catalogue.
+    :param _carts: A dict mapping cart ID -> dict mapping product ID -> quantity.
+    :param _orders: A dict mapping order ID -> cart ID.
+    :param _billings: A list with billings.
+    :return: A dict with the amount of checked billings, the mismatching and the unresolvable billings.
+    """
+    cart_pos = {cart_id: pos for pos, cart_id in enumerate(_carts.keys())}
+
+    # carts with unknown products are invalid
+    totals, complete = _catalogue.totals(list(_carts.values()))
+    totals = np.append(totals, 0)
+    invalid = np.append(~complete, True)
+
+    # resolve billings to carts
+    billing_carts = np.fromiter((cart_pos.get(_orders.get(billing['order_id']), -1) for billing in _billings),
+                                dtype=np.int64, count=len(_billings))
+    amounts = np.fromiter((int(billing['amount']) for billing in _billings), dtype=np.int64, count=len(_billings))
+
+    unresolved = invalid[billing_carts]
+    expected = totals[billing_carts]
+    mismatched = ~unresolved & (expected != amounts)
+
+    return {
+        'billings': len(_billings),
+        'mismatches': [{
+            'billing_id': _billings[i]['entity_id'],
+            'order_id': _billings[i]['order_id'],
+            'amount': int(amounts[i]),
+            'expected': int(expected[i])
+        } for i in np.flatnonzero(mismatched)],
+        'unresolved': [_billings[i]['entity_id'] for i in np.flatnonzero(unresolved)]
+    }
@@ -1,9 +1,17 @@
-import collections
+import json
 import logging
+import os
 import signal
+import threading
+import time
 import uuid
 
 from event_store.event_store_client import EventStoreClient, create_event
+from lib.cart_items import create_item, get_items
+from lib.entity_patch import create_patch
+from lib.event_dispatcher import EventDispatcher
+from lib.event_publisher import EventPublisher
+from lib.idempotency_keys import IdempotencyKeys
 from message_queue.message_queue_client import Consumers, send_message
 
 
@@ -11,76 +19,245 @@ class CartService(object):
     """
     Cart Service class.
     """
-    def __init__(self):
+    def __init__(self, _inventory_ttl=60):
         self.event_store = EventStoreClient()
         self.consumers = Consumers('cart-service', [self.create_carts,
                                                     self.update_cart,
+                                                    self.patch_cart,
+                                                    self.add_item,
+                                                    self.remove_item,
                                                     self.delete_cart])
+        self.idempotency = IdempotencyKeys()
+        self.publisher = EventPublisher(self.event_store)
+        self.inventory = {}
+        self.inventory_products = {}
+        self.inventory_ttl = _inventory_ttl
+        self.inventory_lock = threading.Lock()
+        self.inventory_warm = False
+        self.dispatcher = EventDispatcher(self.event_store)
+        self.dispatcher.register('inventory', self.inventory_changed)
 
     @staticmethod
-    def _create_entity(_customer_id, _product_ids):
+    def _create_entity(_customer_id, _items):
         """
         Create a cart entity.
 
         :param _customer_id: The customer ID.
-        :param _product_ids: The product IDs.
+        :param _items: A dict mapping product ID -> quantity.
         :return: A dict with the entity properties.
         """
         return {
             'entity_id': str(uuid.uuid4()),
             'customer_id': _customer_id,
-            'product_ids': _product_ids
+            'items': _items
         }
 
     @staticmethod
-    def _check_inventory(_product_ids):
-        product_counts = collections.Counter(_product_ids)
-        for product_id, amount in product_counts.items():
-            rsp = send_message('read-model', 'get_entity', {'name': 'inventory', 'props': {'product_id': product_id}})
-            if 'error' in rsp:
-                rsp['error'] += ' (from read-model)'
-                raise Exception(rsp['error'])
-
-            inventory = rsp['result']
-            if not inventory or int(inventory['amount']) - amount < 0:
+    def _get_items(_req):
+        """
+        Get the items of a request, given as a dict mapping product ID -> quantity, or as a list of product IDs.
+
+        :param _req: The request.
+        :return: A dict mapping product ID -> quantity.
+        :raise KeyError: In case the request has no items.
+        :raise ValueError: In case a quantity is not a positive number.
+        """
+        if 'items' not in _req and 'product_ids' not in _req:
+            raise KeyError('items')
+
+        items = get_items(_req)
+        if not all(quantity > 0 for quantity in items.values()):
+            raise ValueError('quantity')
+
+        return items
+
+    def _apply_inventory(self, _action, _inventory, _ts):
+        """
+        Apply an inventory event to the stock cache.
+
+        :param _action: The event action.
+        :param _inventory: The inventory entity, or an inventory patch.
+        :param _ts: The TS of the cache update.
+        """
+        old_product_id = self.inventory_products.get(_inventory['entity_id'])
+        if _action == 'entity_patched':
+            if old_product_id and 'amount' in _inventory and 'product_id' not in _inventory:
+                self.inventory[old_product_id] = (int(_inventory['amount']), _ts)
+                return
+
+            # the stock of the products involved is read from the read model again
+            self.inventory.pop(old_product_id, None)
+            if 'product_id' in _inventory:
+                self.inventory.pop(_inventory['product_id'], None)
+                self.inventory_products[_inventory['entity_id']] = _inventory['product_id']
+            return
+
+        if old_product_id and old_product_id != _inventory['product_id']:
+            self.inventory[old_product_id] = (None, _ts)
+
+        if _action == 'entity_deleted':
+            self.inventory_products.pop(_inventory['entity_id'], None)
+            self.inventory[_inventory['product_id']] = (None, _ts)
+        else:
+            self.inventory_products[_inventory['entity_id']] = _inventory['product_id']
+            self.inventory[_inventory['product_id']] = (int(_inventory['amount']), _ts)
+
+    def _load_inventory(self):
+        """
+        Build the stock cache from the inventory event history.
+        """
+        with self.inventory_lock:
+            events = self.event_store.get('inventory') or []
+            now = time.time()
+            for event in events:
+                self._apply_inventory(event[1]['event_action'], json.loads(event[1]['event_data']), now)
+            self.inventory_warm = True
+
+        logging.info('loaded stock of {} products'.format(len(self.inventory)))
+
+    def _get_stock(self, _product_id):
+        """
+        Get the amount in stock of a product, from the cache if the entry is fresh, else from the read model.
+
+        :param _product_id: The product ID.
+        :return: The amount in stock, or None if there is no inventory for the product.
+        """
+        entry = self.inventory.get(_product_id)
+        if self.inventory_warm and entry and time.time() - entry[1] < self.inventory_ttl:
+            return entry[0]
+
+        rsp = send_message('read-model', 'get_entity', {'name': 'inventory', 'props': {'product_id': _product_id}})
+        if 'error' in rsp:
+            rsp['error'] += ' (from read-model)'
+            raise Exception(rsp['error'])
+
+        inventory = rsp['result']
+        amount = int(inventory['amount']) if inventory else None
+
+        # refresh entry, unless an event came in meanwhile
+        with self.inventory_lock:
+            if self.inventory_warm and self.inventory.get(_product_id) is entry:
+                self.inventory[_product_id] = (amount, time.time())
+
+        return amount
+
+    def _check_inventory(self, _items, _old_items=None):
+        """
+        Check the stock of the items of a cart, only lines which are new or grew are checked.
+
+        :param _items: A dict mapping product ID -> quantity.
+        :param _old_items: An optional dict with the items before.
+        :return: A tuple with a boolean indicating all products are in stock, and the product ID which is not.
+        """
+        for product_id, amount in _items.items():
+            if _old_items and amount <= _old_items.get(product_id, 0):
+                continue
+            stock = self._get_stock(product_id)
+            if stock is None or stock - amount < 0:
                 return False, product_id
 
         return True, None
 
+    @staticmethod
+    def _get_open_cart(_cart_id):
+        """
+        Get a cart from the read model, as long as its order is not in progress.
+
+        :param _cart_id: The cart ID.
+        :return: The cart, or None if it could not be found.
+        :raise Exception: In case the read model could not be queried, or the order of the cart is in progress.
+        """
+        rsp = send_message('read-model', 'get_entity', {'name': 'order', 'props': {'cart_id': _cart_id}})
+        if 'error' in rsp:
+            raise Exception(rsp['error'] + ' (from read-model)')
+
+        order = rsp['result']
+        if order and not order['status'] == 'CREATED':
+            raise Exception("order {} in progress".format(order['entity_id']))
+
+        rsp = send_message('read-model', 'get_entity', {'name': 'cart', 'id': _cart_id})
+        if 'error' in rsp:
+            raise Exception(rsp['error'] + ' (from read-model)')
+
+        return rsp['result']
+
     def start(self):
         logging.info('starting ...')
+        self.dispatcher.start()
+        self._load_inventory()
         self.consumers.start()
         self.consumers.wait()
 
     def stop(self):
+        self.dispatcher.stop()
         self.consumers.stop()
+        self.publisher.stop()
         logging.info('stopped.')
 
     def create_carts(self, _req):
         carts = _req if isinstance(_req, list) else [_req]
-        cart_ids = []
+        idempotency_key = _req.get('idempotency_key') if isinstance(_req, dict) else None
 
-        for cart in carts:
-            res, product_id = self._check_inventory(cart['product_ids'])
-            if not res:
+        # replay a retried request
+        if idempotency_key:
+            cart_id = self.idempotency.replay(idempotency_key)
+            if cart_id:
                 return {
-                    'error': 'product {} is out of stock'.format(product_id)
+                    "result": [cart_id]
                 }
 
+        new_carts = []
+        results = []
+
+        # validate all carts first
+        for cart in carts:
             try:
-                new_cart = CartService._create_entity(cart['customer_id'], cart['product_ids'])
-            except KeyError:
+                new_cart = CartService._create_entity(cart['customer_id'], CartService._get_items(cart))
+            except (KeyError, TypeError, ValueError, AttributeError):
+                results.append({
+                    "error": "missing mandatory parameter 'customer_id' and/or 'items'"
+                })
+                continue
+
+            res, product_id = self._check_inventory(new_cart['items'])
+            if not res:
+                results.append({
+                    'error': 'product {} is out of stock'.format(product_id)
+                })
+                continue
+
+            new_carts.append(new_cart)
+            results.append({
+                "result": new_cart['entity_id']
+            })
+
+        # reserve the idempotency key, a concurrent retry may have been faster
+        if idempotency_key and new_carts:
+            cart_id = self.idempotency.reserve(idempotency_key, new_carts[0]['entity_id'])
+            if cart_id:
                 return {
-                    "error": "missing mandatory parameter 'customer_id' and/or 'product_ids'"
+                    "result": [cart_id]
                 }
 
-            # trigger event
-            self.event_store.publish('cart', create_event('entity_created', new_cart))
+        # trigger events, release the idempotency key if they could not be published
+        events = [create_event('entity_created', new_cart) for new_cart in new_carts]
+        try:
+            self.publisher.publish_all('cart', events, [new_cart['entity_id'] for new_cart in new_carts])
+        except Exception:
+            if idempotency_key and new_carts:
+                self.idempotency.release(idempotency_key, new_carts[0]['entity_id'])
+            raise
 
-            cart_ids.append(new_cart['entity_id'])
+        if isinstance(_req, list):
+            return {
+                "result": results
+            }
+
+        if 'error' in results[0]:
+            return results[0]
 
         return {
-            "result": cart_ids
+            "result": [results[0]['result']]
         }
 
     def update_cart(self, _req):
@@ -91,46 +268,169 @@ class CartService(object):
                 "error": "missing mandatory parameter 'entity_id'"
             }
 
-        rsp = send_message('read-model', 'get_entity', {'name': 'order', 'props': {'cart_id': cart_id}})
-        if 'error' in rsp:
-            rsp['error'] += ' (from read-model)'
-            return rsp
-
-        order = rsp['result']
-        if order and not order['status'] == 'CREATED':
+        try:
+            cart = CartService._get_open_cart(cart_id)
+        except Exception as e:
             return {
-                "error": "order {} in progress".format(order['entity_id'])
+                "error": str(e)
             }
-
-        rsp = send_message('read-model', 'get_entity', {'name': 'cart', 'id': cart_id})
-        if 'error' in rsp:
-            rsp['error'] += ' (from read-model)'
-            return rsp
-
-        cart = rsp['result']
         if not cart:
             return {
                 "error": "could not find cart {}".format(cart_id)
             }
 
         # set new props
+        old_items = get_items(cart)
         cart['entity_id'] = cart_id
+        cart.pop('product_ids', None)
         try:
             cart['customer_id'] = _req['customer_id']
-            cart['product_ids'] = _req['product_ids']
-        except KeyError:
+            cart['items'] = CartService._get_items(_req)
+        except (KeyError, TypeError, ValueError, AttributeError):
             return {
-                "result": "missing mandatory parameter 'customer_id' and/or 'product_ids"
+                "result": "missing mandatory parameter 'customer_id' and/or 'items"
             }
 
-        res, product_id = self._check_inventory(cart['product_ids'])
+        res, product_id = self._check_inventory(cart['items'], old_items)
         if not res:
             return {
                 'error': 'product {} is out of stock'.format(product_id)
             }
 
         # trigger event
-        self.event_store.publish('cart', create_event('entity_updated', cart))
+        self.publisher.publish('cart', create_event('entity_updated', cart)).result()
+
+        return {
+            "result": True
+        }
+
+    def patch_cart(self, _req):
+        try:
+            cart_id = _req['entity_id']
+            props = {'customer_id': _req['customer_id']} if 'customer_id' in _req else {}
+            if 'items' in _req or 'product_ids' in _req:
+                props['items'] = CartService._get_items(_req)
+        except KeyError:
+            return {
+                "error": "missing mandatory parameter 'entity_id'"
+            }
+        except (TypeError, ValueError, AttributeError):
+            return {
+                "error": "invalid parameter 'items'"
+            }
+
+        try:
+            cart = CartService._get_open_cart(cart_id)
+        except Exception as e:
+            return {
+                "error": str(e)
+            }
+        if not cart:
+            return {
+                "error": "could not find cart {}".format(cart_id)
+            }
+
+        cart['items'] = get_items(cart)
+        patch = create_patch(cart, props)
+        if patch and 'items' in patch:
+            res, product_id = self._check_inventory(patch['items'], cart['items'])
+            if not res:
+                return {
+                    'error': 'product {} is out of stock'.format(product_id)
+                }
+
+        # trigger event, if any prop changed
+        if patch:
+            self.publisher.publish('cart', create_event('entity_patched', patch)).result()
+
+        return {
+            "result": True
+        }
+
+    def add_item(self, _req):
+        try:
+            cart_id = _req['entity_id']
+            product_id = _req['product_id']
+            quantity = int(_req.get('quantity', 1))
+        except KeyError:
+            return {
+                "error": "missing mandatory parameter 'entity_id' and/or 'product_id'"
+            }
+        except (TypeError, ValueError):
+            return {
+                "error": "invalid parameter 'quantity'"
+            }
+
+        if quantity <= 0:
+            return {
+                "error": "invalid parameter 'quantity'"
+            }
+
+        try:
+            cart = CartService._get_open_cart(cart_id)
+        except Exception as e:
+            return {
+                "error": str(e)
+            }
+        if not cart:
+            return {
+                "error": "could not find cart {}".format(cart_id)
+            }
+
+        # check the stock of the changed line only
+        res, product_id = self._check_inventory({product_id: get_items(cart).get(product_id, 0) + quantity})
+        if not res:
+            return {
+                'error': 'product {} is out of stock'.format(product_id)
+            }
+
+        # trigger event, it carries the added quantity, so that concurrent adds are not lost
+        item = create_item(cart_id, product_id, quantity)
+        self.publisher.publish('cart', create_event('item_added', item)).result()
+
+        return {
+            "result": True
+        }
+
+    def remove_item(self, _req):
+        try:
+            cart_id = _req['entity_id']
+            product_id = _req['product_id']
+            quantity = int(_req['quantity']) if 'quantity' in _req else None
+        except KeyError:
+            return {
+                "error": "missing mandatory parameter 'entity_id' and/or 'product_id'"
+            }
+        except (TypeError, ValueError):
+            return {
+                "error": "invalid parameter 'quantity'"
+            }
+
+        if quantity is not None and quantity <= 0:
+            return {
+                "error": "invalid parameter 'quantity'"
+            }
+
+        try:
+            cart = CartService._get_open_cart(cart_id)
+        except Exception as e:
+            return {
+                "error": str(e)
+            }
+        if not cart:
+            return {
+                "error": "could not find cart {}".format(cart_id)
+            }
+
+        items = get_items(cart)
+        if product_id not in items:
+            return {
+                "error": "could not find product {} in cart {}".format(product_id, cart_id)
+            }
+
+        # trigger event, it removes the whole line, unless a quantity is given
+        item = create_item(cart_id, product_id, quantity)
+        self.publisher.publish('cart', create_event('item_removed', item)).result()
 
         return {
             "result": True
@@ -156,16 +456,22 @@ class CartService(object):
             }
 
         # trigger event
-        self.event_store.publish('cart', create_event('entity_deleted', cart))
+        self.publisher.publish('cart', create_event('entity_deleted', cart)).result()
 
         return {
             "result": True
         }
 
+    def inventory_changed(self, _item, _inventory):
+        with self.inventory_lock:
+            self._apply_inventory(_item.event_action, _inventory, time.time())
+
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)-6s] %(message)s')
 
-p = CartService()
+INVENTORY_TTL = float(os.getenv('CART_SERVICE_INVENTORY_TTL', '60'))
+
+p = CartService(_inventory_ttl=INVENTORY_TTL)
 
 signal.signal(signal.SIGINT, lambda n, h: p.stop())
 signal.signal(signal.SIGTERM, lambda n, h: p.stop())
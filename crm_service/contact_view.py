@@ -0,0 +1,141 @@
+import logging
+import threading
+
+from lib.cart_items import ITEM_ACTIONS, apply_item, get_items
+from lib.event_replay import EventReplay
+from lib.product_catalogue import ProductCatalogue
+
+
+class ContactView(object):
+    """
+    Contact View class, a denormalized view of the customer contacts of orders and carts, kept up to date from the
+    customer, product, cart and order events. Only the properties needed to compose mails are kept.
+    """
+
+    NAMES = ['customer', 'product', 'cart', 'order']
+
+    def __init__(self):
+        self.customers = {}
+        self.products = ProductCatalogue()
+        self.carts = {}
+        self.orders = {}
+        self.lock = threading.RLock()
+        self.replay = EventReplay(self.apply, self.lock, ContactView.NAMES)
+
+    def _index(self, _name):
+        return {
+            'customer': self.customers,
+            'product': self.products,
+            'cart': self.carts,
+            'order': self.orders
+        }[_name]
+
+    @staticmethod
+    def _index_value(_name, _entity):
+        """
+        Get the indexed value of an entity, i.e. the name and email of a customer, the customer ID and
+        items of a cart or the cart ID of an order.
+
+        :param _name: The entity name.
+        :param _entity: The entity.
+        :return: The indexed value.
+        """
+        if _name == 'customer':
+            return _entity['name'], _entity['email']
+        if _name == 'cart':
+            return _entity['customer_id'], get_items(_entity)
+        if _name == 'order':
+            return _entity['cart_id']
+
+    @staticmethod
+    def _patch_value(_name, _value, _patch):
+        """
+        Patch the indexed value of an entity.
+
+        :param _name: The entity name.
+        :param _value: The indexed value.
+        :param _patch: The entity patch.
+        :return: The patched value.
+        """
+        if _name == 'customer':
+            return _patch.get('name', _value[0]), _patch.get('email', _value[1])
+        if _name == 'cart':
+            items = get_items(_patch) if 'items' in _patch or 'product_ids' in _patch else _value[1]
+            return _patch.get('customer_id', _value[0]), items
+        if _name == 'order':
+            return _patch.get('cart_id', _value)
+
+    def apply(self, _name, _action, _entity):
+        """
+        Apply an entity event to the view.
+
+        :param _name: The entity name.
+        :param _action: The event action.
+        :param _entity: The entity.
+        """
+        with self.lock:
+            if _name == 'product':
+                self.products.apply(_action, _entity)
+            elif _action == 'entity_deleted':
+                self._index(_name).pop(_entity['entity_id'], None)
+            elif _action in ('entity_created', 'entity_updated'):
+                self._index(_name)[_entity['entity_id']] = ContactView._index_value(_name, _entity)
+            elif _action == 'entity_patched' and _entity['entity_id'] in self._index(_name):
+                value = self._index(_name)[_entity['entity_id']]
+                self._index(_name)[_entity['entity_id']] = ContactView._patch_value(_name, value, _entity)
+            elif _action in ITEM_ACTIONS and _entity['entity_id'] in self.carts:
+                customer_id, items = self.carts[_entity['entity_id']]
+                self.carts[_entity['entity_id']] = customer_id, apply_item(items, _action, _entity)
+
+    def load(self, _event_store, _name):
+        """
+        Build the view of an entity from its event history. Events received before are buffered by receive and applied
+        afterwards, instead of being overwritten by older events of the history, unless they are in the history.
+
+        :param _event_store: The event store client.
+        :param _name: The entity name.
+        """
+        self.replay.replay(_event_store, _name)
+
+        logging.info('loaded {} {}s into contact view'.format(len(self._index(_name)), _name))
+
+    def receive(self, _name, _item, _entity):
+        """
+        Apply a received entity event to the view, it is buffered until the history of the entity is loaded.
+
+        :param _name: The entity name.
+        :param _item: The event.
+        :param _entity: The entity.
+        """
+        self.replay.receive(_name, _item, _entity)
+
+    def get_cart_contact(self, _cart_id):
+        """
+        Get the contact of a cart.
+
+        :param _cart_id: The cart ID.
+        :return: A dict with the name and email of the customer and the total of the cart, None if the cart or its
+            customer is unknown. The total is None if a product is unknown.
+        """
+        cart = self.carts.get(_cart_id)
+        if not cart:
+            return None
+
+        customer = self.customers.get(cart[0])
+        if not customer:
+            return None
+
+        return {
+            'name': customer[0],
+            'email': customer[1],
+            'total': self.products.total(cart[1])
+        }
+
+    def get_order_contact(self, _order_id):
+        """
+        Get the contact of an order.
+
+        :param _order_id: The order ID.
+        :return: A dict with the name and email of the customer and the total of the order, see get_cart_contact.
+        """
+        return self.get_cart_contact(self.orders.get(_order_id))
@@ -1,182 +1,210 @@
-import json
+import functools
 import logging
+import os
 import signal
 
 from event_store.event_store_client import EventStoreClient
-from message_queue.message_queue_client import send_message, send_message_async
+from lib.batcher import Batcher
+from lib.bloom_filter import RotatingBloomFilter
+from lib.cart_items import get_items
+from lib.consumer_group import ConsumerGroup
+from lib.event_dispatcher import EventDispatcher
+from lib.keyed_executor import KeyedExecutor
+from lib.read_batch import ReadBatch
+from lib.redis_channel import RedisChannel
+from message_queue.message_queue_client import send_message_async
+from contact_view import ContactView
 
 
 class CrmService(object):
     """
     CRM Service class.
     """
-    def __init__(self):
+    def __init__(self, _workers=8, _max_queue=100, _mail_batch=100, _mail_delay=0.05, _redis_host='localhost',
+                 _redis_port=6379):
         self.event_store = EventStoreClient()
+        self.mails = Batcher(self.send_mails, _mail_batch, _mail_delay)
+        self.group = ConsumerGroup(RedisChannel(_redis_host, _redis_port), 'crm-service')
+        self.executor = KeyedExecutor('crm-service', _workers, _max_queue)
+        self.dispatcher = EventDispatcher(self.event_store, self.group, RotatingBloomFilter(), self.executor)
+        self.contacts = ContactView()
+        for name in ContactView.NAMES:
+            self.dispatcher.register(name, functools.partial(self.entity_changed, name), _broadcast=True)
+        self.dispatcher.register('billing', self.billing_created, 'entity_created')
+        self.dispatcher.register('customer', self.customer_created, 'entity_created')
+        self.dispatcher.register('customer', self.customer_deleted, 'entity_deleted')
+        self.dispatcher.register('order', self.order_updated, 'entity_updated')
+        self.dispatcher.register('order', self.order_updated, 'entity_patched')
+        self.dispatcher.register('shipping', self.shipping_created, 'entity_created')
 
     def start(self):
         logging.info('starting ...')
-        self.event_store.subscribe('billing', self.billing_created)
-        self.event_store.subscribe('customer', self.customer_created)
-        self.event_store.subscribe('customer', self.customer_deleted)
-        self.event_store.subscribe('order', self.order_updated)
-        self.event_store.subscribe('shipping', self.shipping_created)
+        self.dispatcher.start()
+        for name in ContactView.NAMES:
+            self.contacts.load(self.event_store, name)
 
     def stop(self):
-        self.event_store.unsubscribe('billing', self.billing_created)
-        self.event_store.unsubscribe('customer', self.customer_created)
-        self.event_store.unsubscribe('customer', self.customer_deleted)
-        self.event_store.unsubscribe('order', self.order_updated)
-        self.event_store.unsubscribe('shipping', self.shipping_created)
+        self.dispatcher.stop()
+        self.mails.stop()
         logging.info('stopped.')
 
     @staticmethod
-    def customer_created(_item):
-        if _item.event_action != 'entity_created':
-            return
+    def send_mails(_mails):
+        send_message_async('mail-service', 'send_batch', _mails)
+
+    def entity_changed(self, _name, _item, _entity):
+        self.contacts.receive(_name, _item, _entity)
 
-        customer = json.loads(_item.event_data)
+    def customer_created(self, _item, _customer):
         msg = """Dear {}!
 
 Welcome to Ordershop.
 
-Cheers""".format(customer['name'])
+Cheers""".format(_customer['name'])
 
-        send_message_async('mail-service', 'send', {
-            "to": customer['email'],
+        self.mails.add({
+            "to": _customer['email'],
             "msg": msg
         })
 
-    @staticmethod
-    def customer_deleted(_item):
-        if _item.event_action != 'entity_deleted':
-            return
-
-        customer = json.loads(_item.event_data)
+    def customer_deleted(self, _item, _customer):
         msg = """Dear {}!
 
 Good bye, hope to see you soon again at Ordershop.
 
-Cheers""".format(customer['name'])
+Cheers""".format(_customer['name'])
 
-        send_message_async('mail-service', 'send', {
-            "to": customer['email'],
+        self.mails.add({
+            "to": _customer['email'],
             "msg": msg
         })
 
     @staticmethod
-    def order_updated(_item):
-        if _item.event_action != 'entity_updated':
-            return
-
-        order = json.loads(_item.event_data)
-        if order['status'] != 'IN_STOCK':
+    def _query_contact(_order_id=None, _cart_id=None):
+        """
+        Query the contact of an order or a cart from the read model.
+
+        :param _order_id: The order ID.
+        :param _cart_id: The cart ID, if the order ID is not given.
+        :return: A dict with the name and email of the customer and the total, None if it could not be found.
+        """
+        batch = ReadBatch()
+        if _order_id:
+            order = batch.get_entity('order', _order_id)
+            cart = batch.get_entity('cart', ReadBatch.ref(order, 'cart_id'))
+        else:
+            cart = batch.get_entity('cart', _cart_id)
+        customer = batch.get_entity('customer', ReadBatch.ref(cart, 'customer_id'))
+        products = batch.get_entities('product', ReadBatch.ref(cart, 'items'))
+
+        try:
+            results = batch.send()
+        except Exception as e:
+            logging.error('could not query contact: {}'.format(e))
+            return None
+
+        cart, customer, products = results[cart], results[customer], results[products]
+        if not cart or not customer or products is None or not all(products):
+            return None
+
+        items = get_items(cart)
+
+        return {
+            'name': customer['name'],
+            'email': customer['email'],
+            'total': sum([int(product['price']) * quantity for product, quantity in zip(products, items.values())])
+        }
+
+    def _get_contact(self, _order_id=None, _cart_id=None, _total=False):
+        """
+        Get the contact of an order or a cart from the contact view, or from the read model if it is not in the view
+        (yet).
+
+        :param _order_id: The order ID.
+        :param _cart_id: The cart ID, if the order ID is not given.
+        :param _total: Boolean indicating the total is needed.
+        :return: A dict with the name and email of the customer and the total, None if it could not be found.
+        """
+        if _order_id:
+            contact = self.contacts.get_order_contact(_order_id)
+        else:
+            contact = self.contacts.get_cart_contact(_cart_id)
+
+        if not contact or (_total and contact['total'] is None):
+            return CrmService._query_contact(_order_id, _cart_id)
+
+        return contact
+
+    def order_updated(self, _item, _order):
+        if _order.get('status') != 'IN_STOCK':
             return
 
-        rsp = send_message('read-model', 'get_entity', {'name': 'cart', 'id': order['cart_id']})
-        cart = rsp['result']
-        if not cart:
-            logging.error('could not find cart {} for order {}'.format(order['cart_id'], order['entity_id']))
-            return
-
-        rsp = send_message('read-model', 'get_entity', {'name': 'customer', 'id': cart['customer_id']})
-        customer = rsp['result']
-        if not customer:
-            logging.error('could not find customer {} for cart {}'.format(cart['customer_id'], cart['entity_id']))
-            return
-
-        rsp = send_message('read-model', 'get_entities', {'name': 'product', 'ids': cart['product_ids']})
-        products = rsp['result']
-        if not all(products) and not len(products) == len(cart['product_ids']):
-            logging.error('could not find all products for cart {}'.format(cart['entity_id']))
+        # a patch carries the changed props only, i.e. the cart is looked up by the order
+        if 'cart_id' in _order:
+            contact = self._get_contact(_cart_id=_order['cart_id'], _total=True)
+        else:
+            contact = self._get_contact(_order_id=_order['entity_id'], _total=True)
+        if not contact:
+            logging.error('could not find contact for order {}'.format(_order['entity_id']))
             return
 
         msg = """Dear {}!
 
 Please transfer € {} with your favourite payment method.
 
-Cheers""".format(customer['name'], sum([int(product['price']) for product in products]))
+Cheers""".format(contact['name'], contact['total'])
 
-        send_message_async('mail-service', 'send', {
-            "to": customer['email'],
+        self.mails.add({
+            "to": contact['email'],
             "msg": msg
         })
 
-    @staticmethod
-    def billing_created(_item):
-        if _item.event_action != 'entity_created':
-            return
-
-        billing = json.loads(_item.event_data)
-
-        rsp = send_message('read-model', 'get_entity', {'name': 'order', 'id': billing['order_id']})
-        order = rsp['result']
-        if not order:
-            logging.error('could not find order {} for billing {}'.format(billing['order_id'], billing['entity_id']))
-            return
-
-        rsp = send_message('read-model', 'get_entity', {'name': 'cart', 'id': order['cart_id']})
-        cart = rsp['result']
-        if not cart:
-            logging.error('could not find cart {} for order {}'.format(order['cart_id'], order['entity_id']))
-            return
-
-        rsp = send_message('read-model', 'get_entity', {'name': 'customer', 'id': cart['customer_id']})
-        customer = rsp['result']
-        if not customer:
-            logging.error('could not find customer {} for cart {}'.format(cart['customer_id'], cart['entity_id']))
+    def billing_created(self, _item, _billing):
+        contact = self._get_contact(_order_id=_billing['order_id'])
+        if not contact:
+            logging.error('could not find contact for billing {}'.format(_billing['entity_id']))
             return
 
         msg = """Dear {}!
 
 We've just received € {} from you, thank you for your transfer.
 
-Cheers""".format(customer['name'], billing['amount'])
+Cheers""".format(contact['name'], _billing['amount'])
 
-        send_message_async('mail-service', 'send', {
-            "to": customer['email'],
+        self.mails.add({
+            "to": contact['email'],
             "msg": msg
         })
 
-    @staticmethod
-    def shipping_created(_item):
-        if _item.event_action != 'entity_created':
-            return
-
-        shipping = json.loads(_item.event_data)
-
-        rsp = send_message('read-model', 'get_entity', {'name': 'order', 'id': shipping['order_id']})
-        order = rsp['result']
-        if not order:
-            logging.error('could not find order {} for shipping {}'.format(shipping['order_id'], shipping['entity_id']))
-            return
-
-        rsp = send_message('read-model', 'get_entity', {'name': 'cart', 'id': order['cart_id']})
-        cart = rsp['result']
-        if not cart:
-            logging.error('could not find cart {} for order {}'.format(order['cart_id'], order['entity_id']))
-            return
-
-        rsp = send_message('read-model', 'get_entity', {'name': 'customer', 'id': cart['customer_id']})
-        customer = rsp['result']
-        if not customer:
-            logging.error('could not find customer {} for cart {}'.format(cart['customer_id'], cart['entity_id']))
+    def shipping_created(self, _item, _shipping):
+        contact = self._get_contact(_order_id=_shipping['order_id'])
+        if not contact:
+            logging.error('could not find contact for shipping {}'.format(_shipping['entity_id']))
             return
 
         msg = """Dear {}!
 
 We've just shipped order {}. It will be soon delivered to you.
 
-Cheers""".format(customer['name'], order['entity_id'])
+Cheers""".format(contact['name'], _shipping['order_id'])
 
-        send_message_async('mail-service', 'send', {
-            "to": customer['email'],
+        self.mails.add({
+            "to": contact['email'],
             "msg": msg
         })
 
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)-6s] %(message)s')
 
-c = CrmService()
+WORKERS = int(os.getenv('CRM_SERVICE_WORKERS', '8'))
+MAX_QUEUE = int(os.getenv('CRM_SERVICE_MAX_QUEUE', '100'))
+MAIL_BATCH = int(os.getenv('CRM_SERVICE_MAIL_BATCH', '100'))
+MAIL_DELAY = float(os.getenv('CRM_SERVICE_MAIL_DELAY', '0.05'))
+REDIS_HOST = os.getenv('CRM_SERVICE_REDIS_HOST', 'localhost')
+REDIS_PORT = int(os.getenv('CRM_SERVICE_REDIS_PORT', '6379'))
+
+c = CrmService(_workers=WORKERS, _max_queue=MAX_QUEUE, _mail_batch=MAIL_BATCH, _mail_delay=MAIL_DELAY,
+               _redis_host=REDIS_HOST, _redis_port=REDIS_PORT)
 
 signal.signal(signal.SIGINT, lambda n, h: c.stop())
 signal.signal(signal.SIGTERM, lambda n, h: c.stop())
@@ -3,6 +3,8 @@ import signal
 import uuid
 
 from event_store.event_store_client import EventStoreClient, create_event
+from lib.entity_patch import create_patch
+from lib.event_publisher import EventPublisher
 from message_queue.message_queue_client import Consumers, send_message
 
 
@@ -14,7 +16,9 @@ class CustomerService(object):
         self.event_store = EventStoreClient()
         self.consumers = Consumers('customer-service', [self.create_customers,
                                                         self.update_customer,
+                                                        self.patch_customer,
                                                         self.delete_customer])
+        self.publisher = EventPublisher(self.event_store)
 
     @staticmethod
     def _create_entity(_name, _email):
@@ -38,27 +42,77 @@ class CustomerService(object):
 
     def stop(self):
         self.consumers.stop()
+        self.publisher.stop()
         logging.info('stopped.')
 
+    @staticmethod
+    def _query_customer_ids(_emails):
+        """
+        Query the customers with given email addresses.
+
+        :param _emails: A list with email addresses.
+        :return: A list with the customer ID per email address, None if there is no such customer.
+        :raise Exception: In case the read model could not be queried.
+        """
+        rsp = send_message('read-model', 'get_entity_ids', {'name': 'customer', 'prop': 'email', 'values': _emails})
+        if 'error' in rsp:
+            raise Exception(rsp['error'] + ' (from read-model)')
+
+        return rsp['result']
+
     def create_customers(self, _req):
         customers = _req if isinstance(_req, list) else [_req]
-        customer_ids = []
+        new_customers = []
+        results = []
 
+        # check the email addresses of all customers at once
+        emails = [customer['email'] for customer in customers
+                  if isinstance(customer, dict) and isinstance(customer.get('email'), str)]
+        try:
+            customer_ids = CustomerService._query_customer_ids(emails)
+        except Exception as e:
+            return {
+                "error": str(e)
+            }
+        taken = {email.strip().lower() for email, customer_id in zip(emails, customer_ids) if customer_id}
+
+        # validate all customers first
         for customer in customers:
             try:
                 new_customer = CustomerService._create_entity(customer['name'], customer['email'])
-            except KeyError:
-                return {
+            except (KeyError, TypeError):
+                results.append({
                     "error": "missing mandatory parameter 'name' and/or 'email'"
-                }
-
-            # trigger event
-            self.event_store.publish('customer', create_event('entity_created', new_customer))
+                })
+                continue
+
+            email = str(new_customer['email']).strip().lower()
+            if email in taken:
+                results.append({
+                    "error": "email '{}' already exists".format(new_customer['email'])
+                })
+                continue
+            taken.add(email)
+
+            new_customers.append(new_customer)
+            results.append({
+                "result": new_customer['entity_id']
+            })
+
+        # trigger events
+        events = [create_event('entity_created', new_customer) for new_customer in new_customers]
+        self.publisher.publish_all('customer', events, [new_customer['entity_id'] for new_customer in new_customers])
+
+        if isinstance(_req, list):
+            return {
+                "result": results
+            }
 
-            customer_ids.append(new_customer['entity_id'])
+        if 'error' in results[0]:
+            return results[0]
 
         return {
-            "result": customer_ids
+            "result": [results[0]['result']]
         }
 
     def update_customer(self, _req):
@@ -76,8 +130,60 @@ class CustomerService(object):
                 "error": "missing mandatory parameter 'entity_id'"
             }
 
+        try:
+            customer_id = CustomerService._query_customer_ids([customer['email']])[0]
+        except Exception as e:
+            return {
+                "error": str(e)
+            }
+        if customer_id and customer_id != customer['entity_id']:
+            return {
+                "error": "email '{}' already exists".format(customer['email'])
+            }
+
         # trigger event
-        self.event_store.publish('customer', create_event('entity_updated', customer))
+        self.publisher.publish('customer', create_event('entity_updated', customer)).result()
+
+        return {
+            "result": True
+        }
+
+    def patch_customer(self, _req):
+        try:
+            customer_id = _req['entity_id']
+        except KeyError:
+            return {
+                "error": "missing mandatory parameter 'entity_id'"
+            }
+
+        rsp = send_message('read-model', 'get_entity', {'name': 'customer', 'id': customer_id})
+        if 'error' in rsp:
+            rsp['error'] += ' (from read-model)'
+            return rsp
+
+        customer = rsp['result']
+        if not customer:
+            return {
+                "error": "could not find customer"
+            }
+
+        patch = create_patch(customer, {prop_name: _req[prop_name] for prop_name in ['name', 'email']
+                                        if prop_name in _req})
+        if patch and 'email' in patch:
+            try:
+                owner_id = CustomerService._query_customer_ids([patch['email']])[0]
+            except Exception as e:
+                return {
+                    "error": str(e)
+                }
+            if owner_id and owner_id != customer_id:
+                return {
+                    "error": "email '{}' already exists".format(patch['email'])
+                }
+
+        # trigger event, if any prop changed
+        if patch:
+            self.publisher.publish('customer', create_event('entity_patched', patch)).result()
 
         return {
             "result": True
@@ -103,7 +209,7 @@ class CustomerService(object):
             }
 
         # trigger event
-        self.event_store.publish('customer', create_event('entity_deleted', customer))
+        self.publisher.publish('customer', create_event('entity_deleted', customer)).result()
 
         return {
             "result": True
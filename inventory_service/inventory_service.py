@@ -1,9 +1,16 @@
-import json
 import logging
+import os
 import signal
 import uuid
 
 from event_store.event_store_client import EventStoreClient, create_event
+from lib.bloom_filter import RotatingBloomFilter
+from lib.cart_items import get_items
+from lib.consumer_group import ConsumerGroup
+from lib.entity_patch import create_patch
+from lib.event_dispatcher import EventDispatcher
+from lib.event_publisher import EventPublisher
+from lib.redis_channel import RedisChannel
 from message_queue.message_queue_client import Consumers, send_message
 
 
@@ -11,11 +18,17 @@ class InventoryService(object):
     """
     Inventory Service class.
     """
-    def __init__(self):
+    def __init__(self, _redis_host='localhost', _redis_port=6379):
         self.event_store = EventStoreClient()
+        self.publisher = EventPublisher(self.event_store)
         self.consumers = Consumers('inventory-service', [self.create_inventories,
                                                          self.update_inventory,
+                                                         self.patch_inventory,
                                                          self.delete_inventory])
+        self.group = ConsumerGroup(RedisChannel(_redis_host, _redis_port), 'inventory-service')
+        self.dispatcher = EventDispatcher(self.event_store, self.group, RotatingBloomFilter())
+        self.dispatcher.register('order', self.order_created, 'entity_created')
+        self.dispatcher.register('order', self.order_deleted, 'entity_deleted')
 
     @staticmethod
     def _create_entity(_product_id, _amount):
@@ -42,10 +55,10 @@ class InventoryService(object):
             logging.error("could not find inventory for product {}".format(_product_id))
             return False
 
-        inventory['amount'] = int(inventory['amount']) - (_value if _value else 1)
+        amount = int(inventory['amount']) + (_value if _value else 1)
 
         # trigger event
-        self.event_store.publish('inventory', create_event('entity_updated', inventory))
+        self.publisher.publish('inventory', create_event('entity_patched', create_patch(inventory, {'amount': amount})))
 
         return True
 
@@ -63,20 +76,18 @@ class InventoryService(object):
             logging.info("product {} is out of stock".format(_product_id))
             return False
 
-        inventory['amount'] = int(inventory['amount']) - (_value if _value else 1)
+        amount = int(inventory['amount']) - (_value if _value else 1)
 
         # trigger event
-        self.event_store.publish('inventory', create_event('entity_updated', inventory))
+        self.publisher.publish('inventory', create_event('entity_patched', create_patch(inventory, {'amount': amount})))
 
         return True
 
     def _decr_from_cart(self, _cart):
-        try:
-            product_ids = _cart['product_ids']
-        except KeyError:
-            raise Exception("missing mandatory parameter 'product_ids'")
+        items = get_items(_cart)
 
-        rsp = send_message('read-model', 'get_entities', {'name': 'inventory', 'props': {'product_id': product_ids}})
+        rsp = send_message('read-model', 'get_entities', {'name': 'inventory',
+                                                          'props': {'product_id': list(items.keys())}})
         if 'error' in rsp:
             raise Exception(rsp['error'] + ' (from read-model)')
 
@@ -85,7 +96,7 @@ class InventoryService(object):
         # count products
         product_counts = []
         for inventory in inventories:
-            found = product_ids.count(inventory['product_id'])
+            found = items.get(inventory['product_id'], 0)
 
             # check amount
             if found > int(inventory['amount']):
@@ -96,24 +107,23 @@ class InventoryService(object):
 
         # decrement inventory
         for inventory, count in product_counts:
-            inventory['amount'] = int(inventory['amount']) - count
+            patch = create_patch(inventory, {'amount': int(inventory['amount']) - count})
 
             # trigger event
-            self.event_store.publish('inventory', create_event('entity_updated', inventory))
+            self.publisher.publish('inventory', create_event('entity_patched', patch))
 
         return True
 
     def start(self):
         logging.info('starting ...')
-        self.event_store.subscribe('order', self.order_created)
-        self.event_store.subscribe('order', self.order_deleted)
+        self.dispatcher.start()
         self.consumers.start()
         self.consumers.wait()
 
     def stop(self):
-        self.event_store.unsubscribe('order', self.order_created)
-        self.event_store.unsubscribe('order', self.order_deleted)
+        self.dispatcher.stop()
         self.consumers.stop()
+        self.publisher.stop()
         logging.info('stopped.')
 
     def create_inventories(self, _req):
@@ -129,7 +139,7 @@ class InventoryService(object):
                 }
 
             # trigger event
-            self.event_store.publish('inventory', create_event('entity_created', new_inventory))
+            self.publisher.publish('inventory', create_event('entity_created', new_inventory)).result()
 
             inventory_ids.append(new_inventory['entity_id'])
 
@@ -167,7 +177,36 @@ class InventoryService(object):
             }
 
         # trigger event
-        self.event_store.publish('inventory', create_event('entity_updated', inventory))
+        self.publisher.publish('inventory', create_event('entity_updated', inventory)).result()
+
+        return {
+            "result": True
+        }
+
+    def patch_inventory(self, _req):
+        try:
+            inventory_id = _req['entity_id']
+        except KeyError:
+            return {
+                "error": "missing mandatory parameter 'entity_id'"
+            }
+
+        rsp = send_message('read-model', 'get_entity', {'name': 'inventory', 'id': inventory_id})
+        if 'error' in rsp:
+            rsp['error'] += ' (from read-model)'
+            return rsp
+
+        inventory = rsp['result']
+        if not inventory:
+            return {
+                "error": "could not find inventory"
+            }
+
+        # trigger event, if any prop changed
+        patch = create_patch(inventory, {prop_name: _req[prop_name] for prop_name in ['product_id', 'amount']
+                                         if prop_name in _req})
+        if patch:
+            self.publisher.publish('inventory', create_event('entity_patched', patch)).result()
 
         return {
             "result": True
@@ -193,39 +232,34 @@ class InventoryService(object):
             }
 
         # trigger event
-        self.event_store.publish('inventory', create_event('entity_deleted', inventory))
+        self.publisher.publish('inventory', create_event('entity_deleted', inventory)).result()
 
         return {
             "result": True
         }
 
-    def order_created(self, _item):
-        if _item.event_action != 'entity_created':
-            return
-
-        order = json.loads(_item.event_data)
-        rsp = send_message('read-model', 'get_entity', {'name': 'cart', 'id': order['cart_id']})
+    def order_created(self, _item, _order):
+        rsp = send_message('read-model', 'get_entity', {'name': 'cart', 'id': _order['cart_id']})
         cart = rsp['result']
         result = self._decr_from_cart(cart)
-        order['status'] = 'IN_STOCK' if result else 'OUT_OF_STOCK'
-        self.event_store.publish('order', create_event('entity_updated', order))
+        patch = create_patch(_order, {'status': 'IN_STOCK' if result else 'OUT_OF_STOCK'})
+        self.publisher.publish('order', create_event('entity_patched', patch))
 
-    def order_deleted(self, _item):
-        if _item.event_action != 'entity_deleted':
+    def order_deleted(self, _item, _order):
+        if _order['status'] != 'IN_STOCK':
             return
 
-        order = json.loads(_item.event_data)
-        if order['status'] != 'IN_STOCK':
-            return
-
-        rsp = send_message('read-model', 'get_entity', {'name': 'cart', 'id': order['cart_id']})
+        rsp = send_message('read-model', 'get_entity', {'name': 'cart', 'id': _order['cart_id']})
         cart = rsp['result']
-        [self._incr_inventory(product_id) for product_id in cart['product_ids']]
+        [self._incr_inventory(product_id, quantity) for product_id, quantity in get_items(cart).items()]
 
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)-6s] %(message)s')
 
-i = InventoryService()
+REDIS_HOST = os.getenv('INVENTORY_SERVICE_REDIS_HOST', 'localhost')
+REDIS_PORT = int(os.getenv('INVENTORY_SERVICE_REDIS_PORT', '6379'))
+
+i = InventoryService(_redis_host=REDIS_HOST, _redis_port=REDIS_PORT)
 
 signal.signal(signal.SIGINT, lambda n, h: i.stop())
 signal.signal(signal.SIGTERM, lambda n, h: i.stop())
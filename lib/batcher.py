@@ -0,0 +1,82 @@
+import logging
+import queue
+import threading
+import time
+
+
+def collect(_queue, _max_batch, _max_delay):
+    """
+    Collect a batch of items from a queue, i.e. wait for an item, then take more items until the batch is full or
+    the maximum delay has passed. A None item stops collecting.
+
+    :param _queue: The queue.
+    :param _max_batch: The maximum amount of items per batch.
+    :param _max_delay: The maximum time in seconds to wait for more items, 0 takes the queued items only.
+    :return: A tuple with a list of items, and a boolean indicating a None item was taken.
+    """
+    item = _queue.get()
+    if item is None:
+        return [], True
+
+    batch = [item]
+    deadline = time.time() + _max_delay
+    while len(batch) < _max_batch:
+        try:
+            item = _queue.get(timeout=max(deadline - time.time(), 0))
+        except queue.Empty:
+            break
+        if item is None:
+            return batch, True
+        batch.append(item)
+
+    return batch, False
+
+
+class Batcher(object):
+    """
+    Batcher class, collects items for a short time or up to a maximum batch size and hands them over in one call.
+    Batches are flushed one after the other, in the order the items were added.
+    """
+
+    def __init__(self, _flush, _max_batch=100, _max_delay=0.05):
+        """
+        :param _flush: The function to call with a list of items.
+        :param _max_batch: The maximum amount of items per batch.
+        :param _max_delay: The maximum time in seconds an item is buffered.
+        """
+        self.flush = _flush
+        self.max_batch = _max_batch
+        self.max_delay = _max_delay
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        """
+        Collect items into batches and flush them, until stopped.
+        """
+        stopped = False
+        while not stopped:
+            batch, stopped = collect(self.queue, self.max_batch, self.max_delay)
+            if not batch:
+                continue
+
+            try:
+                self.flush(batch)
+            except Exception:
+                logging.exception('could not flush batch of {} items'.format(len(batch)))
+
+    def add(self, _item):
+        """
+        Add an item to the next batch.
+
+        :param _item: The item.
+        """
+        self.queue.put(_item)
+
+    def stop(self):
+        """
+        Flush all buffered items and stop.
+        """
+        self.queue.put(None)
+        self.thread.join()
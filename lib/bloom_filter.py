@@ -0,0 +1,91 @@
+import hashlib
+import logging
+import math
+import threading
+
+
+class RotatingBloomFilter(object):
+    """
+    Rotating Bloom Filter class, remembers recently seen keys in bounded memory.
+
+    Keys are added to the current of two generations, when it is full the previous generation is dropped and a new
+    one is started, so a key is remembered for at least the capacity of one generation. Lookups may report a key as
+    seen although it is not (a false positive), but never the other way around.
+    """
+
+    def __init__(self, _capacity=100000, _error_rate=1e-6):
+        """
+        :param _capacity: The amount of keys per generation.
+        :param _error_rate: The false positive rate of a full generation.
+        """
+        self.capacity = _capacity
+        self.size = int(math.ceil(-_capacity * math.log(_error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / _capacity * math.log(2))))
+        self.current = bytearray((self.size + 7) // 8)
+        self.previous = bytearray(len(self.current))
+        self.count = 0
+        self.previous_count = 0
+        self.lock = threading.Lock()
+
+    def _positions(self, _key):
+        digest = hashlib.blake2b(str(_key).encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+
+        # enhanced double hashing, avoids short cycles if h2 and the size share factors
+        return [(h1 + i * h2 + (i ** 3 - i) // 6) % self.size for i in range(self.hashes)]
+
+    @staticmethod
+    def _contains(_bits, _positions):
+        return all(_bits[p >> 3] & (1 << (p & 7)) for p in _positions)
+
+    def _rotate(self):
+        self.previous, self.current = self.current, self.previous
+        self.current[:] = bytes(len(self.current))
+        self.previous_count, self.count = self.count, 0
+
+        logging.info('rotated bloom filter, using {} KiB, false positive rate {:.2e}'.format(
+            self.memory // 1024, self.false_positive_rate))
+
+    def __contains__(self, _key):
+        positions = self._positions(_key)
+        with self.lock:
+            return self._contains(self.current, positions) or self._contains(self.previous, positions)
+
+    def add(self, _key):
+        """
+        Add a key, if it is not seen yet.
+
+        :param _key: The key, e.g. an event ID.
+        :return: True if the key is new, False if it is (probably) seen before.
+        """
+        positions = self._positions(_key)
+        with self.lock:
+            if self._contains(self.current, positions) or self._contains(self.previous, positions):
+                return False
+
+            if self.count >= self.capacity:
+                self._rotate()
+
+            for p in positions:
+                self.current[p >> 3] |= 1 << (p & 7)
+            self.count += 1
+
+            return True
+
+    @property
+    def memory(self):
+        """
+        :return: The memory of both generations in bytes.
+        """
+        return len(self.current) + len(self.previous)
+
+    @property
+    def false_positive_rate(self):
+        """
+        :return: The estimated false positive rate of a lookup, according to the current fill of both generations.
+        """
+        def rate(_count):
+            return (1 - math.exp(-self.hashes * _count / self.size)) ** self.hashes
+
+        return 1 - (1 - rate(self.count)) * (1 - rate(self.previous_count))
@@ -0,0 +1,64 @@
+import collections
+
+
+# actions of item events, changing a single line of a cart
+ITEM_ACTIONS = ('item_added', 'item_removed')
+
+
+def get_items(_cart):
+    """
+    Get the items of a cart, carts created before items were introduced carry a list of product IDs instead.
+
+    :param _cart: The cart entity.
+    :return: A dict mapping product ID -> quantity.
+    """
+    if 'items' in _cart:
+        return {product_id: int(quantity) for product_id, quantity in (_cart['items'] or {}).items()}
+
+    return dict(collections.Counter(_cart.get('product_ids') or []))
+
+
+def create_item(_cart_id, _product_id, _quantity=None):
+    """
+    Create the data of an item event. It carries the change of the quantity instead of the new quantity, so that
+    concurrent changes of the same line add up instead of overwriting each other.
+
+    :param _cart_id: The cart ID.
+    :param _product_id: The product ID.
+    :param _quantity: The quantity to add or remove, None removes the whole line.
+    :return: A dict with the event data.
+    """
+    item = {
+        'entity_id': _cart_id,
+        'product_id': _product_id
+    }
+    if _quantity is not None:
+        item['quantity'] = _quantity
+
+    return item
+
+
+def apply_item(_items, _action, _item):
+    """
+    Apply an item event to the items of a cart.
+
+    :param _items: A dict mapping product ID -> quantity.
+    :param _action: The event action, i.e. item_added or item_removed.
+    :param _item: The event data.
+    :return: A copy of the items with the new quantity of the product.
+    """
+    items = dict(_items)
+    quantity = items.get(_item['product_id'], 0)
+    if _action == 'item_added':
+        quantity += int(_item['quantity'])
+    elif 'quantity' in _item:
+        quantity -= int(_item['quantity'])
+    else:
+        quantity = 0
+
+    if quantity > 0:
+        items[_item['product_id']] = quantity
+    else:
+        items.pop(_item['product_id'], None)
+
+    return items
@@ -0,0 +1,138 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+
+
+class ConsumerGroup(object):
+    """
+    Consumer Group class, lets the replicas of a service share the handling of events.
+
+    Events are partitioned by a key, e.g. their entity ID, and each partition is handled by exactly one member of
+    the group, so events of the same entity are handled in order. Members announce themselves with heartbeat events
+    on the group topic, partitions are assigned by rendezvous hashing and rebalanced as members join or leave.
+
+    The group topic is published on a channel which does not persist events, e.g. a RedisChannel, so that heartbeats
+    do not pile up in the event store. A joining member owns no partitions until it has waited one heartbeat interval
+    for the other members to answer, and it is taken into account by them once it announces to be alive afterwards.
+    """
+
+    def __init__(self, _channel, _name, _partitions=64, _interval=5, _timeout=15, _create_event=None):
+        """
+        :param _channel: The channel to publish the group topic on, e.g. a RedisChannel.
+        :param _name: The group name, e.g. the service name.
+        :param _partitions: The amount of partitions.
+        :param _interval: The heartbeat interval in seconds.
+        :param _timeout: The time in seconds after which a silent member is considered gone.
+        :param _create_event: An optional event factory, defaults to the one of the event store client.
+        """
+        if not _create_event:
+            from event_store.event_store_client import create_event
+            _create_event = create_event
+
+        self.channel = _channel
+        self.name = _name
+        self.topic = '{}-group'.format(_name)
+        self.partitions = _partitions
+        self.interval = _interval
+        self.timeout = _timeout
+        self.create_event = _create_event
+        self.member_id = str(uuid.uuid4())
+        self.members = {self.member_id: time.time()}
+        self.owned = set()
+        self.joined = False
+        self.lock = threading.Lock()
+        self.exit = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def _hash(_value):
+        return int(hashlib.md5(_value.encode('utf-8')).hexdigest()[:16], 16)
+
+    def _announce(self, _action):
+        """
+        Announce this member to the group.
+
+        :param _action: The event action, i.e. member_joined, member_alive or member_left.
+        """
+        self.channel.publish(self.topic, self.create_event(_action, {'member_id': self.member_id}))
+
+    def _rebalance(self):
+        """
+        Assign partitions to the current members, must be called with the lock held.
+        """
+        members = sorted(self.members.keys())
+        self.owned = {p for p in range(self.partitions)
+                      if max(members, key=lambda m: ConsumerGroup._hash('{}:{}'.format(m, p))) == self.member_id}
+
+        logging.info('{} has {} members, owning {} of {} partitions'.format(
+            self.name, len(members), len(self.owned), self.partitions))
+
+    def _run(self):
+        """
+        Send heartbeats and remove silent members, until stopped.
+        """
+        while not self.exit.wait(self.interval):
+            self._announce('member_alive')
+
+            with self.lock:
+                now = time.time()
+                gone = [m for m, seen in self.members.items() if m != self.member_id and now - seen > self.timeout]
+                for member_id in gone:
+                    del self.members[member_id]
+                if gone:
+                    self._rebalance()
+
+    def member_changed(self, _item):
+        member_id = json.loads(_item.event_data)['member_id']
+        if member_id == self.member_id:
+            return
+
+        # a joining member is taken into account once it is alive, i.e. when it owns partitions itself
+        with self.lock:
+            known = member_id in self.members
+            if _item.event_action == 'member_left':
+                self.members.pop(member_id, None)
+            elif _item.event_action == 'member_alive':
+                self.members[member_id] = time.time()
+
+            if self.joined and known != (member_id in self.members):
+                self._rebalance()
+
+        # let a new member know about this one
+        if _item.event_action == 'member_joined':
+            self._announce('member_alive')
+
+    def owns(self, _key):
+        """
+        Check if an event key belongs to a partition of this member.
+
+        :param _key: The event key, e.g. the entity ID.
+        :return: True if this member handles the key, False otherwise.
+        """
+        return ConsumerGroup._hash(str(_key)) % self.partitions in self.owned
+
+    def start(self):
+        """
+        Join the group, this waits one heartbeat interval for the other members to answer.
+        """
+        self.channel.subscribe(self.topic, self.member_changed)
+        self._announce('member_joined')
+        self.exit.wait(self.interval)
+
+        with self.lock:
+            self.joined = True
+            self._rebalance()
+
+        self._announce('member_alive')
+        self.thread.start()
+
+    def stop(self):
+        """
+        Leave the group.
+        """
+        self.exit.set()
+        self._announce('member_left')
+        self.channel.unsubscribe(self.topic, self.member_changed)
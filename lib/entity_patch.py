@@ -0,0 +1,30 @@
+def create_patch(_entity, _props):
+    """
+    Create a patch of an entity, i.e. the entity ID and the properties which differ from the entity.
+
+    :param _entity: The entity.
+    :param _props: A dict with the new properties.
+    :return: A dict with the entity ID and the changed properties, or None if no property changed.
+    """
+    patch = {prop_name: prop_value for prop_name, prop_value in _props.items()
+             if prop_name != 'entity_id' and _entity.get(prop_name) != prop_value}
+    if not patch:
+        return None
+
+    patch['entity_id'] = _entity['entity_id']
+
+    return patch
+
+
+def apply_patch(_entity, _patch):
+    """
+    Apply a patch to an entity.
+
+    :param _entity: The entity.
+    :param _patch: The patch.
+    :return: A copy of the entity with the patched properties.
+    """
+    entity = dict(_entity)
+    entity.update(_patch)
+
+    return entity
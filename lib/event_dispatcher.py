@@ -0,0 +1,167 @@
+import functools
+import json
+import logging
+
+
+class EventDispatcher(object):
+    """
+    Event Dispatcher class, subscribes once per topic and routes each event by its action to the registered handlers.
+
+    Events are keyed by their entity ID, unless a handler is registered with a key function, e.g. to key billing
+    events by the order they belong to. With a consumer group, an event is only handled by the member owning its key,
+    except for broadcast handlers, e.g. the ones maintaining local state, which handle all events. With a filter,
+    events which are delivered again, e.g. after a reconnect, are dropped before they are handled. With an executor,
+    events are handled on its workers, in order per key, instead of on the thread of the subscription. Broadcast
+    handlers still run on the thread of the subscription, so that local state is up to date when the other handlers
+    run.
+    """
+
+    def __init__(self, _event_store, _group=None, _filter=None, _executor=None):
+        """
+        :param _event_store: The event store client.
+        :param _group: An optional consumer group.
+        :param _filter: An optional filter of seen events, e.g. a RotatingBloomFilter.
+        :param _executor: An optional executor, e.g. a KeyedExecutor.
+        """
+        self.event_store = _event_store
+        self.group = _group
+        self.filter = _filter
+        self.executor = _executor
+        self.handlers = {}
+        self.broadcast = set()
+        self.keys = {}
+        self.subscriptions = {}
+
+    def register(self, _topic, _handler, _action=None, _broadcast=False, _key=None):
+        """
+        Register an event handler, it is called with the event and its decoded data. The data is shared between
+        all handlers of an event, so handlers must not modify it.
+
+        :param _topic: The event topic.
+        :param _handler: The event handler.
+        :param _action: The event action to handle, defaults to None (all actions).
+        :param _broadcast: Boolean indicating the handler handles all events, regardless of the consumer group.
+        :param _key: An optional function returning the key of the decoded event data, defaults to its entity ID.
+        """
+        self.handlers.setdefault(_topic, {}).setdefault(_action, []).append(_handler)
+        if _broadcast:
+            self.broadcast.add(_handler)
+        if _key:
+            self.keys[_handler] = _key
+
+    def start(self):
+        """
+        Join the consumer group, if any, and subscribe to all topics with registered handlers.
+        """
+        if self.group and not self.subscriptions:
+            self.group.start()
+
+        for topic in self.handlers.keys():
+            if topic in self.subscriptions:
+                continue
+
+            handler = functools.partial(self.dispatch, topic)
+            self.event_store.subscribe(topic, handler)
+            self.subscriptions[topic] = handler
+
+    def stop(self):
+        """
+        Unsubscribe from all topics and leave the consumer group, if any.
+        """
+        for topic, handler in self.subscriptions.items():
+            self.event_store.unsubscribe(topic, handler)
+        self.subscriptions = {}
+
+        if self.executor:
+            self.executor.stop()
+
+        if self.group:
+            self.group.stop()
+
+        if self.filter:
+            logging.info('event filter used {} KiB, false positive rate {:.2e}'.format(
+                self.filter.memory // 1024, self.filter.false_positive_rate))
+
+    def dispatch(self, _topic, _item):
+        """
+        Dispatch an event to its handlers, the event data is decoded once for all of them.
+
+        :param _topic: The event topic.
+        :param _item: The event.
+        """
+        handlers = self.handlers.get(_topic, {})
+        handlers = handlers.get(_item.event_action, []) + handlers.get(None, [])
+        if not handlers:
+            return
+
+        if self.filter and not self.filter.add('{}:{}'.format(_topic, _item.event_id)):
+            logging.info('dropping duplicate {} event {}'.format(_topic, _item.event_id))
+            return
+
+        data = json.loads(_item.event_data)
+
+        # group the other handlers by key, dropping the ones for keys owned by other members
+        broadcast = [handler for handler in handlers if handler in self.broadcast]
+        keyed = {}
+        for handler in handlers:
+            if handler in self.broadcast:
+                continue
+
+            key = self._key(handler, _item, data)
+            if self.group and not self.group.owns(key):
+                continue
+
+            keyed.setdefault(key, []).append(handler)
+
+        if not self.executor:
+            owned = set(handler for key_handlers in keyed.values() for handler in key_handlers)
+            self._handle(_topic, _item, data, [handler for handler in handlers if handler in self.broadcast
+                                               or handler in owned])
+            return
+
+        # keep local state in order with the events, before other handlers may use it
+        if broadcast:
+            self._handle(_topic, _item, data, broadcast)
+        for key, key_handlers in keyed.items():
+            self.executor.submit(key, self._handle, _topic, _item, data, key_handlers, True)
+
+    def _key(self, _handler, _item, _data):
+        """
+        Get the key of an event for a handler.
+
+        :param _handler: The event handler.
+        :param _item: The event.
+        :param _data: The decoded event data.
+        :return: The key, i.e. the result of the key function of the handler, or the entity ID of the event.
+        """
+        key = self.keys[_handler](_data) if _handler in self.keys else None
+        if key is None:
+            key = _data.get('entity_id', _item.event_id)
+
+        return key
+
+    @staticmethod
+    def _handle(_topic, _item, _data, _handlers, _raise=False):
+        """
+        Call the handlers of an event, a failing handler does not keep the others from being called.
+
+        :param _topic: The event topic.
+        :param _item: The event.
+        :param _data: The decoded event data.
+        :param _handlers: A list with event handlers.
+        :param _raise: Boolean indicating to raise an exception afterwards if a handler failed, e.g. so that the
+                       executor counts the failure.
+        :raise Exception: In case a handler failed and :param _raise: is True.
+        """
+        failed = 0
+        for handler in _handlers:
+            try:
+                handler(_item, _data)
+            except Exception:
+                logging.exception('could not handle {} event {} with {}'.format(
+                    _topic, _item.event_action, getattr(handler, '__name__', handler)))
+                failed += 1
+
+        if failed and _raise:
+            raise Exception('{} of {} handlers of {} event {} failed'.format(
+                failed, len(_handlers), _topic, _item.event_action))
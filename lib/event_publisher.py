@@ -0,0 +1,118 @@
+import collections
+import concurrent.futures
+import logging
+import queue
+import threading
+
+from lib.batcher import collect
+
+
+class EventPublisher(object):
+    """
+    Event Publisher class, publishes events in the background as a group with the events queued meanwhile, up to a
+    maximum batch size. Events with the same ordering key, by default their topic, are published in order, events
+    with different ordering keys are published in parallel.
+
+    By default a batch is published as soon as no more events are queued, so that a lone event is not delayed.
+    """
+
+    def __init__(self, _event_store, _max_batch=100, _max_delay=0, _max_workers=16):
+        """
+        :param _event_store: The event store client.
+        :param _max_batch: The maximum amount of events per batch.
+        :param _max_delay: The maximum time in seconds to wait for more events, defaults to 0 (do not wait).
+        :param _max_workers: The maximum amount of publish requests in flight.
+        """
+        self.event_store = _event_store
+        self.max_batch = _max_batch
+        self.max_delay = _max_delay
+        self.queue = queue.Queue()
+        self.stopped = False
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=_max_workers)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        """
+        Collect events into batches and publish them, until stopped.
+        """
+        stopped = False
+        while not stopped:
+            batch, stopped = collect(self.queue, self.max_batch, self.max_delay)
+            if batch:
+                self._publish_batch(batch)
+
+    def _publish_batch(self, _batch):
+        """
+        Publish a batch of events, one sequence per ordering key. Returns when all events are published,
+        so that the next batch can not overtake this one.
+
+        :param _batch: A list with (topic, key, event, future) tuples.
+        """
+        sequences = collections.OrderedDict()
+        for topic, key, event, future in _batch:
+            sequences.setdefault((topic, key), []).append((event, future))
+
+        concurrent.futures.wait([self.executor.submit(self._publish_sequence, topic, sequence)
+                                 for (topic, key), sequence in sequences.items()])
+
+    def _publish_sequence(self, _topic, _sequence):
+        """
+        Publish a sequence of events in order. If an event can not be published, the remaining events fail as well.
+
+        :param _topic: The event topic.
+        :param _sequence: A list with (event, future) tuples.
+        """
+        for i, (event, future) in enumerate(_sequence):
+            try:
+                self.event_store.publish(_topic, event)
+            except Exception as e:
+                logging.exception('could not publish {} event {}'.format(_topic, event.get('event_action')))
+                [future.set_exception(e) for _, future in _sequence[i:]]
+                return
+
+            future.set_result(True)
+
+    def publish(self, _topic, _event, _key=None):
+        """
+        Publish an event asynchronously.
+
+        :param _topic: The event topic.
+        :param _event: The event.
+        :param _key: An optional ordering key, defaults to the topic.
+        :return: A future, resolving to True when the event is published.
+        :raise RuntimeError: In case the publisher is stopped.
+        """
+        future = concurrent.futures.Future()
+        with self.lock:
+            if self.stopped:
+                raise RuntimeError('cannot publish {} event after stop'.format(_topic))
+            self.queue.put((_topic, _key, _event, future))
+
+        return future
+
+    def publish_all(self, _topic, _events, _keys=None):
+        """
+        Publish events and wait until all of them are published.
+
+        :param _topic: The event topic.
+        :param _events: A list with events.
+        :param _keys: An optional list with an ordering key per event, e.g. entity IDs.
+        :raise Exception: In case an event could not be published.
+        """
+        futures = [self.publish(_topic, event, _keys[i] if _keys else None) for i, event in enumerate(_events)]
+        for future in futures:
+            future.result()
+
+    def stop(self):
+        """
+        Publish all buffered events and stop, events published afterwards are rejected.
+        """
+        with self.lock:
+            if self.stopped:
+                return
+            self.stopped = True
+            self.queue.put(None)
+        self.thread.join()
+        self.executor.shutdown()
@@ -0,0 +1,60 @@
+import json
+
+
+class EventReplay(object):
+    """
+    Event Replay class, builds local state from the event history of topics which are subscribed to already.
+
+    Events received before the history of their topic is replayed are buffered and applied after it, skipping the
+    ones contained in the history, so that no event is applied out of order or twice, e.g. an item delta.
+    """
+
+    def __init__(self, _apply, _lock, _topics):
+        """
+        :param _apply: A function to call with the topic, action and decoded data of each event.
+        :param _lock: The lock guarding the state, it is held while events are applied.
+        :param _topics: A list with the topics to replay, their events are buffered until they are replayed.
+        """
+        self.apply = _apply
+        self.lock = _lock
+        self.buffers = {topic: [] for topic in _topics}
+
+    def replay(self, _event_store, _topic):
+        """
+        Apply the event history of a topic, then the events received meanwhile which are not in the history.
+        Subsequent events are applied as they are received.
+
+        :param _event_store: The event store client.
+        :param _topic: The event topic.
+        """
+        with self.lock:
+            self.buffers.setdefault(_topic, [])
+
+        # the history is fetched without the lock, events received meanwhile are buffered
+        events = _event_store.get(_topic) or []
+
+        seen = set()
+        with self.lock:
+            for _, event in events:
+                seen.add(event['event_id'])
+                self.apply(_topic, event['event_action'], json.loads(event['event_data']))
+
+            for item, data in self.buffers.pop(_topic):
+                if item.event_id not in seen:
+                    seen.add(item.event_id)
+                    self.apply(_topic, item.event_action, data)
+
+    def receive(self, _topic, _item, _data):
+        """
+        Apply a received event, it is buffered if the history of its topic is not replayed yet.
+
+        :param _topic: The event topic.
+        :param _item: The event.
+        :param _data: The decoded event data.
+        """
+        with self.lock:
+            buffer = self.buffers.get(_topic)
+            if buffer is not None:
+                buffer.append((_item, _data))
+            else:
+                self.apply(_topic, _item.event_action, _data)
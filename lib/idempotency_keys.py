@@ -0,0 +1,56 @@
+import logging
+
+from lib.ttl_cache import TTLCache
+
+
+class IdempotencyKeys(TTLCache):
+    """
+    Idempotency Keys class, maps the idempotency key of a create request to the ID of the entity created for it, so
+    that a retried request is replayed instead of creating the entity again.
+
+    The keys are kept in the memory of the process, i.e. a retry is only replayed if it reaches the same replica of
+    the service within the TTL. A retry handled by another replica, or after a restart, creates the entity again.
+    """
+
+    def _log_replay(self, _key):
+        logging.info('replayed request with idempotency key {} ({} hits, {} misses)'.format(
+            _key, self.hits, self.misses))
+
+    def replay(self, _key):
+        """
+        Get the entity ID of a retried request.
+
+        :param _key: The idempotency key.
+        :return: The entity ID, or None if the request was not seen before.
+        """
+        entity_id = self.get(_key)
+        if entity_id:
+            self._log_replay(_key)
+
+        return entity_id
+
+    def reserve(self, _key, _entity_id):
+        """
+        Reserve an idempotency key for an entity, before its event is published.
+
+        :param _key: The idempotency key.
+        :param _entity_id: The entity ID.
+        :return: None if the key is reserved, or the entity ID of a concurrent retry which reserved it first.
+        """
+        entity_id = self.setdefault(_key, _entity_id)
+        if entity_id == _entity_id:
+            return None
+
+        self._log_replay(_key)
+
+        return entity_id
+
+    def release(self, _key, _entity_id):
+        """
+        Release an idempotency key, e.g. if the event of its entity could not be published, so that a retry creates
+        the entity again.
+
+        :param _key: The idempotency key.
+        :param _entity_id: The entity ID the key is reserved for.
+        """
+        self.pop(_key, _entity_id)
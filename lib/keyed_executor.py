@@ -0,0 +1,113 @@
+import logging
+import queue
+import threading
+import time
+import zlib
+
+
+class KeyedExecutor(object):
+    """
+    Keyed Executor class, runs tasks on a bounded pool of workers. Tasks with the same key, e.g. an entity ID, run
+    in order on the same worker, tasks with different keys run in parallel. Each worker has a bounded queue, if it
+    is full submitting blocks, so that a slow handler slows down its caller instead of piling up tasks.
+    """
+
+    def __init__(self, _name, _workers=8, _max_queue=100, _report_interval=60):
+        """
+        :param _name: The executor name, used for reporting.
+        :param _workers: The amount of worker threads.
+        :param _max_queue: The maximum amount of queued tasks per worker.
+        :param _report_interval: The interval in seconds to log metrics, 0 disables reporting.
+        """
+        self.name = _name
+        self.queues = [queue.Queue(maxsize=_max_queue) for _ in range(_workers)]
+        self.threads = [threading.Thread(target=self._run, args=(q,), daemon=True) for q in self.queues]
+        self.lock = threading.Lock()
+        self.report_interval = _report_interval
+        self.exit = threading.Event()
+        self._reset()
+
+        [thread.start() for thread in self.threads]
+        if _report_interval:
+            threading.Thread(target=self._report, daemon=True).start()
+
+    def _reset(self):
+        self.completed = 0
+        self.failed = 0
+        self.latency_sum = 0
+        self.latency_max = 0
+
+    def _run(self, _queue):
+        """
+        Run tasks of a queue, until stopped.
+
+        :param _queue: The queue of the worker.
+        """
+        while True:
+            task = _queue.get()
+            if task is None:
+                break
+
+            fn, args = task
+            start = time.time()
+            try:
+                fn(*args)
+                failed = 0
+            except Exception:
+                logging.exception('could not run {} task {}'.format(self.name, getattr(fn, '__name__', fn)))
+                failed = 1
+            latency = time.time() - start
+
+            with self.lock:
+                self.completed += 1
+                self.failed += failed
+                self.latency_sum += latency
+                self.latency_max = max(self.latency_max, latency)
+
+    def _report(self):
+        """
+        Log metrics periodically, until stopped.
+        """
+        while not self.exit.wait(self.report_interval):
+            metrics = self.metrics(True)
+            if metrics['completed'] or metrics['queued']:
+                logging.info('{} completed {completed} tasks ({failed} failed), {queued} queued, '
+                             'latency avg {latency_avg:.3f}s max {latency_max:.3f}s'.format(self.name, **metrics))
+
+    def submit(self, _key, _fn, *_args):
+        """
+        Submit a task, blocks if the queue of its worker is full.
+
+        :param _key: The ordering key.
+        :param _fn: The function to run.
+        :param _args: The function arguments.
+        """
+        self.queues[zlib.crc32(str(_key).encode('utf-8')) % len(self.queues)].put((_fn, _args))
+
+    def metrics(self, _reset=False):
+        """
+        Get the metrics since start or the last reset.
+
+        :param _reset: Boolean indicating to reset the metrics.
+        :return: A dict with the amount of queued, completed and failed tasks and their average and maximum latency.
+        """
+        with self.lock:
+            metrics = {
+                'queued': sum(q.qsize() for q in self.queues),
+                'completed': self.completed,
+                'failed': self.failed,
+                'latency_avg': self.latency_sum / self.completed if self.completed else 0,
+                'latency_max': self.latency_max
+            }
+            if _reset:
+                self._reset()
+
+        return metrics
+
+    def stop(self):
+        """
+        Run all queued tasks and stop.
+        """
+        self.exit.set()
+        [q.put(None) for q in self.queues]
+        [thread.join() for thread in self.threads]
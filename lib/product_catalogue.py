@@ -0,0 +1,165 @@
+import itertools
+import json
+import logging
+import sys
+import threading
+
+import numpy as np
+
+
+class ProductCatalogue(object):
+    """
+    Product Catalogue class, a columnar store of products, kept up to date from product events.
+
+    Each product has a row, its price is stored in a contiguous array, so that the totals of many carts are
+    computed at once by gathering the prices of all cart lines and summing them up per cart. Rows of deleted
+    products are reused.
+    """
+
+    def __init__(self, _capacity=1024):
+        """
+        :param _capacity: The initial amount of rows, the arrays grow as needed.
+        """
+        self.rows = {}
+        self.ids = []
+        self.names = []
+        self.prices = np.zeros(_capacity, dtype=np.int64)
+        self.free = []
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, _product_id):
+        return _product_id in self.rows
+
+    def _row(self, _product_id):
+        """
+        Get the row of a product, a new row is allocated for an unknown product. Must be called with the lock held.
+
+        :param _product_id: The product ID.
+        :return: The row.
+        """
+        row = self.rows.get(_product_id)
+        if row is not None:
+            return row
+
+        if self.free:
+            row = self.free.pop()
+            self.ids[row] = _product_id
+        else:
+            row = len(self.ids)
+            self.ids.append(_product_id)
+            self.names.append(None)
+            if row == len(self.prices):
+                self.prices = np.concatenate([self.prices, np.zeros(len(self.prices), dtype=np.int64)])
+
+        self.rows[_product_id] = row
+
+        return row
+
+    def apply(self, _action, _product):
+        """
+        Apply a product event.
+
+        :param _action: The event action.
+        :param _product: The product entity.
+        """
+        with self.lock:
+            if _action == 'entity_deleted':
+                row = self.rows.pop(_product['entity_id'], None)
+                if row is not None:
+                    self.ids[row] = self.names[row] = None
+                    self.prices[row] = 0
+                    self.free.append(row)
+            elif _action in ('entity_created', 'entity_updated'):
+                row = self._row(_product['entity_id'])
+                self.names[row] = _product['name']
+                self.prices[row] = int(_product['price'])
+            elif _action == 'entity_patched':
+                row = self.rows.get(_product['entity_id'])
+                if row is None:
+                    return
+                if 'name' in _product:
+                    self.names[row] = _product['name']
+                if 'price' in _product:
+                    self.prices[row] = int(_product['price'])
+
+    def load(self, _event_store):
+        """
+        Build the catalogue from the product event history. The lock is held during the whole load, so that events
+        received meanwhile are applied afterwards, instead of being overwritten by older events of the history.
+
+        :param _event_store: The event store client.
+        """
+        with self.lock:
+            for event in _event_store.get('product') or []:
+                self.apply(event[1]['event_action'], json.loads(event[1]['event_data']))
+
+        logging.info('loaded {} products into catalogue, {} bytes per product'.format(
+            len(self), self.memory // max(len(self), 1)))
+
+    def get(self, _product_id):
+        """
+        Get a product.
+
+        :param _product_id: The product ID.
+        :return: A dict with the entity properties, or None if the product is unknown.
+        """
+        with self.lock:
+            row = self.rows.get(_product_id)
+            if row is None:
+                return None
+
+            return {
+                'entity_id': _product_id,
+                'name': self.names[row],
+                'price': int(self.prices[row])
+            }
+
+    def total(self, _items):
+        """
+        Compute the total of a single cart, cheaper than totals() for one cart.
+
+        :param _items: A dict mapping product ID -> quantity.
+        :return: The total, or None if a product is unknown.
+        """
+        with self.lock:
+            rows = [self.rows.get(product_id) for product_id in _items.keys()]
+            if None in rows:
+                return None
+
+            return int(self.prices[rows] @ np.fromiter(_items.values(), dtype=np.int64, count=len(_items)))
+
+    def totals(self, _carts):
+        """
+        Compute the totals of carts.
+
+        :param _carts: A list with a dict mapping product ID -> quantity per cart.
+        :return: A tuple with an array of totals and an array of booleans indicating all products of a cart are known.
+        """
+        counts = np.fromiter(map(len, _carts), dtype=np.int64, count=len(_carts))
+        quantities = np.fromiter(itertools.chain.from_iterable(map(dict.values, _carts)), dtype=np.int64,
+                                 count=int(counts.sum()))
+        with self.lock:
+            rows = np.fromiter(map(self.rows.get, itertools.chain.from_iterable(_carts), itertools.repeat(-1)),
+                               dtype=np.int64, count=int(counts.sum()))
+            prices = np.append(self.prices[:len(self.ids)], 0)
+
+        # sum up the prices of the lines per cart, unknown products are mapped to the sentinel at the end
+        line_carts = np.repeat(np.arange(len(_carts), dtype=np.int64), counts)
+        totals = np.bincount(line_carts, weights=prices[rows] * quantities, minlength=len(_carts))
+        unknown = np.bincount(line_carts[rows < 0], minlength=len(_carts)) > 0
+
+        return np.rint(totals).astype(np.int64), ~unknown
+
+    @property
+    def memory(self):
+        """
+        :return: The estimated memory of the catalogue in bytes, including IDs and names.
+        """
+        with self.lock:
+            strings = sum(sys.getsizeof(s) for s in self.ids + self.names if s is not None)
+
+            return self.prices.nbytes + sys.getsizeof(self.rows) + sys.getsizeof(self.ids) + \
+                sys.getsizeof(self.names) + strings
@@ -0,0 +1,136 @@
+from lib.cart_items import get_items
+
+
+class ReadBatch(object):
+    """
+    Read Batch class, builds a batch of read model requests which is sent in one round trip.
+
+    Parameters of a request may refer to a property of the result of an earlier request of the same batch, e.g. the
+    cart of an order is requested with a reference to the 'cart_id' of the order. A request whose reference can not
+    be resolved, e.g. as the order does not exist, results in None.
+    """
+
+    FUNCS = ['get_entity', 'get_entities']
+
+    def __init__(self, _send_message=None):
+        """
+        :param _send_message: An optional function to send a message, defaults to the message queue client.
+        """
+        if not _send_message:
+            from message_queue.message_queue_client import send_message as _send_message
+
+        self.send_message = _send_message
+        self.requests = []
+
+    def __len__(self):
+        return len(self.requests)
+
+    @staticmethod
+    def ref(_pos, _prop_name=None):
+        """
+        Create a reference to the result of an earlier request.
+
+        :param _pos: The position of the request in the batch.
+        :param _prop_name: An optional property name of the result, defaults to the whole result.
+        :return: The reference, to be used as parameter value.
+        """
+        return {'ref': _pos, 'prop': _prop_name}
+
+    def _add(self, _func, _params):
+        self.requests.append({'func': _func, 'params': _params})
+
+        return len(self.requests) - 1
+
+    def get_entity(self, _name, _id):
+        """
+        Add a request for an entity.
+
+        :param _name: The entity name.
+        :param _id: The entity ID, or a reference.
+        :return: The position of the request in the batch.
+        """
+        return self._add('get_entity', {'name': _name, 'id': _id})
+
+    def get_entities(self, _name, _ids=None, _props=None):
+        """
+        Add a request for entities.
+
+        :param _name: The entity name.
+        :param _ids: An optional list with entity IDs, or a reference.
+        :param _props: An optional dict mapping property name -> property value(s), if no IDs are given.
+        :return: The position of the request in the batch.
+        """
+        params = {'name': _name}
+        if _ids is not None:
+            params['ids'] = _ids
+        elif _props is not None:
+            params['props'] = _props
+
+        return self._add('get_entities', params)
+
+    def send(self):
+        """
+        Send the batch to the read model.
+
+        :return: A list with the result per request.
+        :raise Exception: In case the batch or one of its requests failed.
+        """
+        return ReadBatch.parse(self.send_message('read-model', 'batch', self.requests))
+
+    @staticmethod
+    def parse(_rsp):
+        """
+        Parse the response of a batch, e.g. if the batch was sent otherwise.
+
+        :param _rsp: The response of the read model.
+        :return: A list with the result per request.
+        :raise Exception: In case the batch or one of its requests failed.
+        """
+        if 'error' in _rsp:
+            raise Exception(_rsp['error'] + ' (from read-model)')
+
+        errors = [result['error'] for result in _rsp['result'] if 'error' in result]
+        if errors:
+            raise Exception(errors[0] + ' (from read-model)')
+
+        return [result['result'] for result in _rsp['result']]
+
+
+def resolve_params(_params, _results):
+    """
+    Resolve the references of request parameters, a reference to the items of a cart resolves to its product IDs
+    when used as 'ids'.
+
+    :param _params: A dict with the parameters of a request.
+    :param _results: A list with the responses of the earlier requests.
+    :return: A dict with the resolved parameters, or None if a referenced result is missing.
+    :raise ValueError: In case a reference does not point to an earlier request, or refers to a property of a result
+                       which is not an entity.
+    """
+    params = {}
+    for name, value in _params.items():
+        if not isinstance(value, dict) or 'ref' not in value:
+            params[name] = value
+            continue
+
+        pos = value['ref']
+        if not isinstance(pos, int) or not 0 <= pos < len(_results):
+            raise ValueError('invalid reference {}'.format(pos))
+
+        result = _results[pos].get('result')
+        if result is None:
+            return None
+
+        if value.get('prop') and not isinstance(result, dict):
+            raise ValueError('invalid reference {}, its result is not an entity'.format(pos))
+
+        if value.get('prop') == 'items':
+            result = get_items(result)
+        elif value.get('prop'):
+            result = result.get(value['prop'])
+            if result is None:
+                return None
+
+        params[name] = list(result.keys()) if name == 'ids' and isinstance(result, dict) else result
+
+    return params
@@ -0,0 +1,76 @@
+import functools
+import json
+import logging
+import threading
+from types import SimpleNamespace
+
+
+class RedisChannel(object):
+    """
+    Redis Channel class, publishes events with Redis Pub/Sub, i.e. they are delivered to the current subscribers only
+    and not persisted. It offers the publish and subscribe methods of the event store client, for events which are of
+    no use once received, e.g. the heartbeats of a consumer group.
+    """
+
+    def __init__(self, _host='localhost', _port=6379):
+        """
+        :param _host: The Redis host.
+        :param _port: The Redis port.
+        """
+        import redis
+
+        self.redis = redis.StrictRedis(host=_host, port=_port, decode_responses=True)
+        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        self.handlers = {}
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def _receive(self, _topic, _message):
+        try:
+            item = SimpleNamespace(**json.loads(_message['data']))
+        except (TypeError, ValueError) as e:
+            logging.error('dropping invalid {} event: {}'.format(_topic, e))
+            return
+
+        for handler in list(self.handlers.get(_topic, [])):
+            handler(item)
+
+    def publish(self, _topic, _event):
+        """
+        Publish an event to the current subscribers of a topic.
+
+        :param _topic: The event topic.
+        :param _event: The event, as created by the event store client.
+        """
+        self.redis.publish(_topic, json.dumps(_event))
+
+    def subscribe(self, _topic, _handler):
+        """
+        Subscribe to a topic, the handler is called with each event on the thread of the channel.
+
+        :param _topic: The event topic.
+        :param _handler: The event handler.
+        """
+        with self.lock:
+            subscribed = _topic in self.handlers
+            self.handlers.setdefault(_topic, []).append(_handler)
+            if not subscribed:
+                self.pubsub.subscribe(**{_topic: functools.partial(self._receive, _topic)})
+            if not self.thread:
+                self.thread = self.pubsub.run_in_thread(sleep_time=0.1, daemon=True)
+
+    def unsubscribe(self, _topic, _handler):
+        """
+        Unsubscribe from a topic.
+
+        :param _topic: The event topic.
+        :param _handler: The event handler.
+        """
+        with self.lock:
+            self.handlers[_topic].remove(_handler)
+            if not self.handlers[_topic]:
+                del self.handlers[_topic]
+                self.pubsub.unsubscribe(_topic)
+            if not self.handlers and self.thread:
+                self.thread.stop()
+                self.thread = None
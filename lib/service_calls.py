@@ -0,0 +1,86 @@
+import asyncio
+import concurrent.futures
+
+
+class ServiceCalls(object):
+    """
+    Service Calls class, sends messages to services from a pool of threads. Each call returns a future of the
+    response, so that independent calls are issued at once and their responses gathered afterwards, either from
+    threads, e.g. consumer handlers, or from asyncio code.
+    """
+
+    def __init__(self, _workers=16, _send_message=None):
+        """
+        :param _workers: The maximum amount of calls in flight.
+        :param _send_message: An optional function to send a message, defaults to the message queue client.
+        """
+        if not _send_message:
+            from message_queue.message_queue_client import send_message as _send_message
+
+        self.send_message = _send_message
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=_workers, thread_name_prefix='service-call')
+
+    def call(self, _service_name, _func_name, _params=None):
+        """
+        Call a service.
+
+        :param _service_name: The name of the service to call.
+        :param _func_name: The name of the function to call.
+        :param _params: The parameters of the call.
+        :return: A future resolving to the response.
+        """
+        return self.executor.submit(self.send_message, _service_name, _func_name, _params)
+
+    def call_async(self, _service_name, _func_name, _params=None):
+        """
+        Call a service from asyncio code, must be called from within a running event loop.
+
+        :param _service_name: The name of the service to call.
+        :param _func_name: The name of the function to call.
+        :param _params: The parameters of the call.
+        :return: An asyncio future resolving to the response.
+        """
+        return asyncio.wrap_future(self.call(_service_name, _func_name, _params))
+
+    def stop(self):
+        """
+        Wait for all calls in flight and stop.
+        """
+        self.executor.shutdown()
+
+
+def gather(_futures, _timeout=None, _return_exceptions=False):
+    """
+    Wait for the responses of calls.
+
+    :param _futures: A list with futures of calls.
+    :param _timeout: An optional time in seconds to wait for all responses.
+    :param _return_exceptions: Boolean indicating to return the exception of a failed call instead of its response,
+                               e.g. a concurrent.futures.TimeoutError if it did not respond in time.
+    :return: A list with the responses, in the order of the futures.
+    :raise concurrent.futures.TimeoutError: In case not all responses arrived in time, pending calls are cancelled.
+    :raise Exception: In case a call failed.
+    """
+    _, pending = concurrent.futures.wait(_futures, timeout=_timeout)
+    [future.cancel() for future in pending]
+    if pending and not _return_exceptions:
+        raise concurrent.futures.TimeoutError('{} of {} calls timed out'.format(len(pending), len(_futures)))
+
+    if not _return_exceptions:
+        return [future.result() for future in _futures]
+
+    return [concurrent.futures.TimeoutError('call timed out') if future in pending else
+            future.exception() or future.result() for future in _futures]
+
+
+async def gather_async(_futures, _timeout=None):
+    """
+    Wait for the responses of calls from asyncio code.
+
+    :param _futures: A list with asyncio futures of calls.
+    :param _timeout: An optional time in seconds to wait for all responses.
+    :return: A list with the responses, in the order of the futures.
+    :raise asyncio.TimeoutError: In case not all responses arrived in time, pending calls are cancelled.
+    :raise Exception: In case a call failed.
+    """
+    return await asyncio.wait_for(asyncio.gather(*_futures), _timeout)
@@ -0,0 +1,88 @@
+import collections
+import threading
+import time
+
+
+class TTLCache(object):
+    """
+    TTL Cache class, a bounded key -> value store whose entries expire after a TTL.
+    """
+
+    def __init__(self, _max_size=10000, _ttl=3600):
+        """
+        :param _max_size: The maximum amount of entries, the oldest entries are evicted first.
+        :param _ttl: The time to live of an entry in seconds.
+        """
+        self.max_size = _max_size
+        self.ttl = _ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _expire(self, _now):
+        """
+        Remove expired entries, and the oldest entries if the cache is full.
+
+        :param _now: The current TS.
+        """
+        while self.entries:
+            key, (value, expires) = next(iter(self.entries.items()))
+            if expires > _now and len(self.entries) <= self.max_size:
+                break
+            del self.entries[key]
+
+    def get(self, _key):
+        """
+        Get the value of a key, counting hits and misses.
+
+        :param _key: The key.
+        :return: The value, or None if the key is unknown or expired.
+        """
+        with self.lock:
+            self._expire(time.time())
+            entry = self.entries.get(_key)
+            if entry:
+                self.hits += 1
+                return entry[0]
+
+            self.misses += 1
+            return None
+
+    def setdefault(self, _key, _value):
+        """
+        Set the value of a key, unless it is already set.
+
+        :param _key: The key.
+        :param _value: The value.
+        :return: The value which is set for the key.
+        """
+        with self.lock:
+            now = time.time()
+            self._expire(now)
+            entry = self.entries.get(_key)
+            if entry:
+                return entry[0]
+
+            self.entries[_key] = (_value, now + self.ttl)
+            self._expire(now)
+            return _value
+
+    def pop(self, _key, _value=None):
+        """
+        Remove a key.
+
+        :param _key: The key.
+        :param _value: An optional value, the key is removed only if it is set to this value.
+        :return: The value of the removed key, or None if no key was removed.
+        """
+        with self.lock:
+            entry = self.entries.get(_key)
+            if not entry or (_value is not None and entry[0] != _value):
+                return None
+
+            del self.entries[_key]
+            return entry[0]
+
+    def __len__(self):
+        return len(self.entries)
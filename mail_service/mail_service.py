@@ -1,26 +1,49 @@
 import logging
+import os
 import signal
+import time
 
 from event_store.event_store_client import EventStoreClient, create_event
+from lib.event_publisher import EventPublisher
 from message_queue.message_queue_client import Consumers
+from outbox import DeliveryPool, Outbox, SmtpDelivery
 
 
 class MailService(object):
     """
     Mail Service class.
     """
-    def __init__(self):
-        self.consumers = Consumers('mail-service', [self.send])
+    def __init__(self, _outbox_path, _workers=4, _smtp_host=None, _smtp_port=25):
+        self.consumers = Consumers('mail-service', [self.send, self.send_batch])
         self.event_store = EventStoreClient()
+        self.publisher = EventPublisher(self.event_store)
+        self.outbox = Outbox(_outbox_path)
+        self.smtp = SmtpDelivery(_smtp_host, _smtp_port) if _smtp_host else None
+        self.delivery = DeliveryPool(self.outbox, self.deliver, _workers)
 
     def start(self):
         logging.info('starting ...')
+        self.delivery.start()
         self.consumers.start()
         self.consumers.wait()
 
     def stop(self):
         self.consumers.stop()
+        self.delivery.stop()
+        if self.smtp:
+            self.smtp.close()
+        self.outbox.close()
+        self.publisher.stop()
         logging.info('stopped.')
+        logging.info('delivered {delivered} mails ({failed} failed, {retried} retries), {depth} left in outbox, '
+                     'latency avg {latency_avg:.3f}s max {latency_max:.3f}s'.format(**self.delivery.metrics()))
+
+    def deliver(self, _mail):
+        if not self.smtp:
+            logging.debug('no SMTP relay configured, dropping mail to {}'.format(_mail['to']))
+            return
+
+        self.smtp(_mail)
 
     def send(self, _req):
         if not _req['to'] or not _req['msg']:
@@ -28,13 +51,46 @@ class MailService(object):
                 "error": "missing mandatory parameter 'to' and/or 'msg'"
             }
 
+        self.outbox.append({'to': _req['to'], 'msg': _req['msg'], 'ts': time.time()})
+
         # trigger event
-        self.event_store.publish('mail', create_event('mail_sent', {"recipient": _req['to'], "message": _req['msg']}))
+        mail = {"recipient": _req['to'], "message": _req['msg']}
+        self.publisher.publish('mail', create_event('mail_sent', mail)).result()
+
+    def send_batch(self, _req):
+        if not isinstance(_req, list):
+            return {
+                "error": "invalid parameter, a list of mails is expected"
+            }
+
+        results = []
+        mails = []
+        for req in _req:
+            if not isinstance(req, dict) or not req.get('to') or not req.get('msg'):
+                results.append({"error": "missing mandatory parameter 'to' and/or 'msg'"})
+                continue
+
+            self.outbox.append({'to': req['to'], 'msg': req['msg'], 'ts': time.time()})
+            results.append({"result": True})
+            mails.append({"recipient": req['to'], "message": req['msg']})
+
+        # trigger events, in order per recipient
+        self.publisher.publish_all('mail', [create_event('mail_sent', mail) for mail in mails],
+                                   [mail['recipient'] for mail in mails])
+
+        return {
+            "result": results
+        }
 
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)-6s] %(message)s')
 
-m = MailService()
+OUTBOX_PATH = os.getenv('MAIL_SERVICE_OUTBOX', '/var/spool/ordershop/outbox')
+WORKERS = int(os.getenv('MAIL_SERVICE_WORKERS', '4'))
+SMTP_HOST = os.getenv('MAIL_SERVICE_SMTP_HOST')
+SMTP_PORT = int(os.getenv('MAIL_SERVICE_SMTP_PORT', '25'))
+
+m = MailService(OUTBOX_PATH, _workers=WORKERS, _smtp_host=SMTP_HOST, _smtp_port=SMTP_PORT)
 
 signal.signal(signal.SIGINT, lambda n, h: m.stop())
 signal.signal(signal.SIGTERM, lambda n, h: m.stop())
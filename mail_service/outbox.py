@@ -0,0 +1,334 @@
+import email.message
+import json
+import logging
+import os
+import queue
+import smtplib
+import threading
+import time
+
+
+class Outbox(object):
+    """
+    Outbox class, a durable queue of mails on disk.
+
+    Mails are appended to segment files, one JSON line per mail, and acknowledged by appending their offset to an
+    ack file next to the segment. Segments whose mails are all acknowledged are removed. On start, the mails not
+    acknowledged yet are recovered from the remaining segments, so every mail is delivered at least once.
+    """
+
+    def __init__(self, _path, _segment_size=10000, _sync=False):
+        """
+        :param _path: The directory of the segment files.
+        :param _segment_size: The maximum amount of mails per segment.
+        :param _sync: Boolean indicating to sync each mail to disk, else it is left to the OS.
+        """
+        os.makedirs(_path, exist_ok=True)
+        self.path = _path
+        self.segment_size = _segment_size
+        self.sync = _sync
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()
+        self.unacked = {}
+        self.ack_files = {}
+        self.segment = 0
+        self.file = None
+        self.count = 0
+        self._recover()
+        self._roll()
+
+    def _segment_path(self, _segment, _ext):
+        return os.path.join(self.path, '{:010d}.{}'.format(_segment, _ext))
+
+    def _recover(self):
+        """
+        Enqueue the mails of all segments which are not acknowledged yet.
+        """
+        segments = sorted(int(name[:-4]) for name in os.listdir(self.path) if name.endswith('.log'))
+        for segment in segments:
+            acked = set()
+            if os.path.exists(self._segment_path(segment, 'ack')):
+                with open(self._segment_path(segment, 'ack')) as f:
+                    acked = {int(line) for line in f if line.strip()}
+
+            with open(self._segment_path(segment, 'log')) as f:
+                for offset, line in enumerate(f):
+                    if offset in acked:
+                        continue
+                    try:
+                        mail = json.loads(line)
+                    except ValueError:
+                        logging.warning('skipping incomplete mail {} in segment {}'.format(offset, segment))
+                        continue
+                    self.pending.put(((segment, offset), mail))
+                    self.unacked[segment] = self.unacked.get(segment, 0) + 1
+
+            if not self.unacked.get(segment):
+                self._remove(segment)
+
+        self.segment = segments[-1] if segments else 0
+        if self.pending.qsize():
+            logging.info('recovered {} mails from {} segments'.format(self.pending.qsize(), len(self.unacked)))
+
+    def _remove(self, _segment):
+        """
+        Remove a segment, must be called with the lock held, or before the outbox is used.
+
+        :param _segment: The segment.
+        """
+        self.unacked.pop(_segment, None)
+        ack_file = self.ack_files.pop(_segment, None)
+        if ack_file:
+            ack_file.close()
+        for ext in ['log', 'ack']:
+            if os.path.exists(self._segment_path(_segment, ext)):
+                os.remove(self._segment_path(_segment, ext))
+
+    def _roll(self):
+        """
+        Start a new segment, must be called with the lock held, or before the outbox is used.
+        """
+        if self.file:
+            self.file.close()
+            if not self.unacked.get(self.segment):
+                self._remove(self.segment)
+
+        self.segment += 1
+        self.file = open(self._segment_path(self.segment, 'log'), 'a')
+        self.count = 0
+
+    def append(self, _mail):
+        """
+        Append a mail.
+
+        :param _mail: A dict with the mail.
+        """
+        line = json.dumps(_mail, separators=(',', ':')) + '\n'
+        with self.lock:
+            if self.count >= self.segment_size:
+                self._roll()
+
+            self.file.write(line)
+            self.file.flush()
+            if self.sync:
+                os.fsync(self.file.fileno())
+
+            record_id = (self.segment, self.count)
+            self.count += 1
+            self.unacked[self.segment] = self.unacked.get(self.segment, 0) + 1
+
+        self.pending.put((record_id, _mail))
+
+    def get(self, _timeout=None):
+        """
+        Get the next mail to deliver.
+
+        :param _timeout: The time in seconds to wait for a mail.
+        :return: A tuple with the record ID and the mail.
+        :raise queue.Empty: In case there is no mail.
+        """
+        return self.pending.get(timeout=_timeout)
+
+    def ack(self, _record_id):
+        """
+        Acknowledge a delivered mail.
+
+        :param _record_id: The record ID of the mail.
+        """
+        segment, offset = _record_id
+        with self.lock:
+            ack_file = self.ack_files.get(segment)
+            if not ack_file:
+                ack_file = self.ack_files[segment] = open(self._segment_path(segment, 'ack'), 'a')
+            ack_file.write('{}\n'.format(offset))
+            ack_file.flush()
+
+            self.unacked[segment] -= 1
+            if not self.unacked[segment] and segment != self.segment:
+                self._remove(segment)
+
+    @property
+    def depth(self):
+        """
+        :return: The amount of mails not delivered yet.
+        """
+        with self.lock:
+            return sum(self.unacked.values())
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+            [ack_file.close() for ack_file in self.ack_files.values()]
+            self.ack_files = {}
+
+
+class DeliveryPool(object):
+    """
+    Delivery Pool class, a pool of workers draining an outbox. A failed delivery is retried with exponential
+    backoff, after the maximum amount of attempts the mail is given up.
+    """
+
+    def __init__(self, _outbox, _deliver, _workers=4, _max_attempts=5, _backoff=0.5, _max_backoff=30):
+        """
+        :param _outbox: The outbox.
+        :param _deliver: The function to deliver a mail.
+        :param _workers: The amount of worker threads.
+        :param _max_attempts: The maximum amount of delivery attempts per mail.
+        :param _backoff: The time in seconds to wait before the first retry, doubled for each further retry.
+        :param _max_backoff: The maximum time in seconds to wait before a retry.
+        """
+        self.outbox = _outbox
+        self.deliver = _deliver
+        self.max_attempts = _max_attempts
+        self.backoff = _backoff
+        self.max_backoff = _max_backoff
+        self.lock = threading.Lock()
+        self.exit = threading.Event()
+        self.threads = [threading.Thread(target=self._run, daemon=True) for _ in range(_workers)]
+        self._reset()
+
+    def _reset(self):
+        self.started = time.time()
+        self.delivered = 0
+        self.failed = 0
+        self.retried = 0
+        self.latency_sum = 0
+        self.latency_max = 0
+
+    def _run(self):
+        """
+        Deliver mails, until stopped.
+        """
+        while not self.exit.is_set():
+            try:
+                record_id, mail = self.outbox.get(0.1)
+            except queue.Empty:
+                continue
+
+            if self._deliver(mail):
+                self.outbox.ack(record_id)
+
+    def _deliver(self, _mail):
+        """
+        Deliver a mail, retrying failed attempts.
+
+        :param _mail: The mail.
+        :return: True if the mail is done, i.e. delivered or given up, False if the pool is stopped meanwhile.
+        """
+        for attempt in range(self.max_attempts):
+            try:
+                self.deliver(_mail)
+            except Exception as e:
+                if attempt + 1 == self.max_attempts:
+                    logging.error('giving up mail to {} after {} attempts: {}'.format(_mail['to'], attempt + 1, e))
+                    with self.lock:
+                        self.failed += 1
+                    return True
+
+                logging.warning('could not deliver mail to {}, retrying: {}'.format(_mail['to'], e))
+                with self.lock:
+                    self.retried += 1
+                if self.exit.wait(min(self.backoff * 2 ** attempt, self.max_backoff)):
+                    return False
+                continue
+
+            latency = time.time() - _mail['ts']
+            with self.lock:
+                self.delivered += 1
+                self.latency_sum += latency
+                self.latency_max = max(self.latency_max, latency)
+            return True
+
+    def metrics(self, _reset=False):
+        """
+        Get the metrics since start or the last reset.
+
+        :param _reset: Boolean indicating to reset the metrics.
+        :return: A dict with the outbox depth, the amount of delivered, failed and retried mails, the throughput
+            and the average and maximum latency from appending to delivering a mail.
+        """
+        with self.lock:
+            metrics = {
+                'depth': self.outbox.depth,
+                'delivered': self.delivered,
+                'failed': self.failed,
+                'retried': self.retried,
+                'throughput': self.delivered / max(time.time() - self.started, 1e-9),
+                'latency_avg': self.latency_sum / self.delivered if self.delivered else 0,
+                'latency_max': self.latency_max
+            }
+            if _reset:
+                self._reset()
+
+        return metrics
+
+    def start(self):
+        self.started = time.time()
+        [thread.start() for thread in self.threads]
+
+    def stop(self):
+        """
+        Stop the workers, mails not delivered yet stay in the outbox.
+        """
+        self.exit.set()
+        [thread.join() for thread in self.threads]
+
+
+class SmtpDelivery(object):
+    """
+    SMTP Delivery class, delivers mails to an SMTP relay, keeping one connection per thread.
+    """
+
+    def __init__(self, _host, _port=25, _sender='ordershop@localhost', _timeout=10):
+        """
+        :param _host: The SMTP relay host.
+        :param _port: The SMTP relay port.
+        :param _sender: The sender address.
+        :param _timeout: The timeout of SMTP commands in seconds.
+        """
+        self.host = _host
+        self.port = _port
+        self.sender = _sender
+        self.timeout = _timeout
+        self.local = threading.local()
+        self.connections = set()
+        self.lock = threading.Lock()
+
+    def __call__(self, _mail):
+        """
+        Deliver a mail.
+
+        :param _mail: A dict with the recipient and the message of the mail.
+        :raise Exception: In case the mail could not be delivered.
+        """
+        msg = email.message.EmailMessage()
+        msg['From'] = self.sender
+        msg['To'] = _mail['to']
+        msg['Subject'] = 'Ordershop'
+        msg.set_content(_mail['msg'])
+
+        smtp = getattr(self.local, 'smtp', None)
+        if not smtp:
+            smtp = self.local.smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            with self.lock:
+                self.connections.add(smtp)
+        try:
+            smtp.send_message(msg)
+        except Exception:
+            self.local.smtp = None
+            with self.lock:
+                self.connections.discard(smtp)
+            smtp.close()
+            raise
+
+    def close(self):
+        """
+        Close all connections.
+        """
+        with self.lock:
+            for smtp in self.connections:
+                try:
+                    smtp.quit()
+                except Exception:
+                    smtp.close()
+            self.connections = set()
@@ -1,9 +1,19 @@
-import logging
+import functools
 import json
+import logging
+import os
 import signal
+import threading
 import uuid
 
 from event_store.event_store_client import EventStoreClient, create_event
+from lib.bloom_filter import RotatingBloomFilter
+from lib.consumer_group import ConsumerGroup
+from lib.entity_patch import apply_patch, create_patch
+from lib.event_dispatcher import EventDispatcher
+from lib.event_publisher import EventPublisher
+from lib.idempotency_keys import IdempotencyKeys
+from lib.redis_channel import RedisChannel
 from message_queue.message_queue_client import Consumers, send_message
 
 
@@ -12,11 +22,27 @@ class OrderService(object):
     Order Service class.
     """
 
-    def __init__(self):
+    def __init__(self, _redis_host='localhost', _redis_port=6379):
         self.event_store = EventStoreClient()
         self.consumers = Consumers('order-service', [self.create_orders,
                                                      self.update_order,
+                                                     self.patch_order,
                                                      self.delete_order])
+        self.idempotency = IdempotencyKeys()
+        self.publisher = EventPublisher(self.event_store)
+        self.orders = {}
+        self.orders_pending = {}
+        self.orders_lock = threading.Lock()
+        self.group = ConsumerGroup(RedisChannel(_redis_host, _redis_port), 'order-service')
+        self.dispatcher = EventDispatcher(self.event_store, self.group, RotatingBloomFilter())
+        self.dispatcher.register('order', self.order_changed, _broadcast=True)
+
+        # billings and shippings change their order, hence their events are handled in order per order ID
+        order_key = lambda _data: _data.get('order_id')
+        self.dispatcher.register('billing', self.billing_created, 'entity_created', _key=order_key)
+        self.dispatcher.register('billing', self.billing_deleted, 'entity_deleted', _key=order_key)
+        self.dispatcher.register('shipping', self.shipping_created, 'entity_created', _key=order_key)
+        self.dispatcher.register('shipping', self.shipping_updated, 'entity_updated', _key=order_key)
 
     @staticmethod
     def _create_entity(_cart_id, _status='CREATED'):
@@ -34,42 +60,173 @@ class OrderService(object):
             'status': _status,
         }
 
+    def _apply_order(self, _action, _order):
+        """
+        Apply an order event to the order state.
+
+        :param _action: The event action.
+        :param _order: The order entity.
+        """
+        if _action == 'entity_deleted':
+            self.orders.pop(_order['entity_id'], None)
+        elif _action in ('entity_created', 'entity_updated'):
+            self.orders[_order['entity_id']] = _order
+        elif _action == 'entity_patched' and _order['entity_id'] in self.orders:
+            self.orders[_order['entity_id']] = apply_patch(self.orders[_order['entity_id']], _order)
+
+    def _load_orders(self):
+        """
+        Build the order state from the order event history.
+        """
+        with self.orders_lock:
+            for event in self.event_store.get('order') or []:
+                self._apply_order(event[1]['event_action'], json.loads(event[1]['event_data']))
+
+        logging.info('loaded {} orders'.format(len(self.orders)))
+
+    def _get_order(self, _order_id):
+        """
+        Get an order from the order state, or from the read model if it is not known (yet).
+
+        :param _order_id: The order ID.
+        :return: A copy of the order, or None if it could not be found.
+        """
+        order = self.orders.get(_order_id)
+        if order:
+            return dict(order)
+
+        rsp = send_message('read-model', 'get_entity', {'name': 'order', 'id': _order_id})
+        if 'error' in rsp:
+            raise Exception(rsp['error'] + ' (from read-model)')
+
+        return rsp['result']
+
+    def _publish_orders(self, _action, _orders):
+        """
+        Publish order events and apply them to the order state right away. They stay pending until they are
+        received back, received events of other services are applied before them, see order_changed.
+
+        :param _action: The event action.
+        :param _orders: A list with orders, or order patches.
+        :return: A list with futures, resolving when the events are published.
+        """
+        events = [create_event(_action, order) for order in _orders]
+        with self.orders_lock:
+            for order, event in zip(_orders, events):
+                self._apply_order(_action, dict(order))
+                self.orders_pending.setdefault(order['entity_id'], []).append((event['event_id'], _action, order))
+
+        # new orders are independent of each other, hence ordered by their ID only
+        futures = [self.publisher.publish('order', event, order['entity_id'] if _action == 'entity_created' else None)
+                   for order, event in zip(_orders, events)]
+        for order, event, future in zip(_orders, events, futures):
+            future.add_done_callback(functools.partial(self._order_published, order['entity_id'], event['event_id']))
+
+        return futures
+
+    def _order_published(self, _order_id, _event_id, _future):
+        """
+        Handle the result of publishing an order event. If it could not be published, the order is removed from
+        the order state, as the event was applied already, so that it is read from the read model instead.
+
+        :param _order_id: The order ID.
+        :param _event_id: The event ID.
+        :param _future: The future of the published event.
+        """
+        if not _future.exception():
+            return
+
+        with self.orders_lock:
+            pending = self.orders_pending.get(_order_id, [])
+            if _event_id not in [event_id for event_id, _, _ in pending]:
+                return
+
+            self._drop_pending(_order_id, _event_id)
+            self.orders.pop(_order_id, None)
+
+    def _drop_pending(self, _order_id, _event_id):
+        """
+        Drop a pending own event of an order, the orders lock must be held.
+
+        :param _order_id: The order ID.
+        :param _event_id: The event ID.
+        """
+        pending = [event for event in self.orders_pending.get(_order_id, []) if event[0] != _event_id]
+        if pending:
+            self.orders_pending[_order_id] = pending
+        else:
+            self.orders_pending.pop(_order_id, None)
+
     def start(self):
         logging.info('starting ...')
-        self.event_store.subscribe('billing', self.billing_created)
-        self.event_store.subscribe('billing', self.billing_deleted)
-        self.event_store.subscribe('shipping', self.shipping_created)
-        self.event_store.subscribe('shipping', self.shipping_updated)
+        self.dispatcher.start()
+        self._load_orders()
         self.consumers.start()
         self.consumers.wait()
 
     def stop(self):
-        self.event_store.unsubscribe('billing', self.billing_created)
-        self.event_store.unsubscribe('billing', self.billing_deleted)
-        self.event_store.unsubscribe('shipping', self.shipping_created)
-        self.event_store.unsubscribe('shipping', self.shipping_updated)
+        self.dispatcher.stop()
         self.consumers.stop()
+        self.publisher.stop()
         logging.info('stopped.')
 
     def create_orders(self, _req):
         orders = _req if isinstance(_req, list) else [_req]
-        order_ids = []
+        idempotency_key = _req.get('idempotency_key') if isinstance(_req, dict) else None
+
+        # replay a retried request
+        if idempotency_key:
+            order_id = self.idempotency.replay(idempotency_key)
+            if order_id:
+                return {
+                    "result": [order_id]
+                }
+
+        new_orders = []
+        results = []
 
+        # validate all orders first
         for order in orders:
             try:
                 new_order = OrderService._create_entity(order['cart_id'])
-            except KeyError:
-                return {
+            except (KeyError, TypeError):
+                results.append({
                     "error": "missing mandatory parameter 'cart_id'"
+                })
+                continue
+
+            new_orders.append(new_order)
+            results.append({
+                "result": new_order['entity_id']
+            })
+
+        # reserve the idempotency key, a concurrent retry may have been faster
+        if idempotency_key and new_orders:
+            order_id = self.idempotency.reserve(idempotency_key, new_orders[0]['entity_id'])
+            if order_id:
+                return {
+                    "result": [order_id]
                 }
 
-            # trigger event
-            self.event_store.publish('order', create_event('entity_created', new_order))
+        # trigger events, release the idempotency key if they could not be published
+        try:
+            for future in self._publish_orders('entity_created', new_orders):
+                future.result()
+        except Exception:
+            if idempotency_key and new_orders:
+                self.idempotency.release(idempotency_key, new_orders[0]['entity_id'])
+            raise
+
+        if isinstance(_req, list):
+            return {
+                "result": results
+            }
 
-            order_ids.append(new_order['entity_id'])
+        if 'error' in results[0]:
+            return results[0]
 
         return {
-            "result": order_ids
+            "result": [results[0]['result']]
         }
 
     def update_order(self, _req):
@@ -80,12 +237,7 @@ class OrderService(object):
                 "error": "missing mandatory parameter 'entity_id'"
             }
 
-        rsp = send_message('read-model', 'get_entity', {'name': 'order', 'id': order_id})
-        if 'error' in rsp:
-            rsp['error'] += ' (from read-model)'
-            return rsp
-
-        order = rsp['result']
+        order = self._get_order(order_id)
         if not order:
             return {
                 "error": "could not find order"
@@ -102,13 +254,13 @@ class OrderService(object):
             }
 
         # trigger event
-        self.event_store.publish('order', create_event('entity_updated', order))
+        self._publish_orders('entity_updated', [order])[0].result()
 
         return {
             "result": True
         }
 
-    def delete_order(self, _req):
+    def patch_order(self, _req):
         try:
             order_id = _req['entity_id']
         except KeyError:
@@ -116,80 +268,90 @@ class OrderService(object):
                 "error": "missing mandatory parameter 'entity_id'"
             }
 
-        rsp = send_message('read-model', 'get_entity', {'name': 'order', 'id': order_id})
-        if 'error' in rsp:
-            rsp['error'] += ' (from read-model)'
-            return rsp
-
-        order = rsp['result']
+        order = self._get_order(order_id)
         if not order:
             return {
                 "error": "could not find order"
             }
 
-        # trigger event
-        self.event_store.publish('order', create_event('entity_deleted', order))
+        # trigger event, if any prop changed
+        patch = create_patch(order, {prop_name: _req[prop_name] for prop_name in ['cart_id', 'status']
+                                     if prop_name in _req})
+        if patch:
+            self._publish_orders('entity_patched', [patch])[0].result()
 
         return {
             "result": True
         }
 
-    def billing_created(self, _item):
-        if _item.event_action != 'entity_created':
-            return
+    def delete_order(self, _req):
+        try:
+            order_id = _req['entity_id']
+        except KeyError:
+            return {
+                "error": "missing mandatory parameter 'entity_id'"
+            }
 
-        billing = json.loads(_item.event_data)
-        rsp = send_message('read-model', 'get_entity', {'name': 'order', 'id': billing['order_id']})
-        order = rsp['result']
-        if not order['status'] == 'IN_STOCK':
-            return
+        order = self._get_order(order_id)
+        if not order:
+            return {
+                "error": "could not find order"
+            }
 
-        order['status'] = 'CLEARED'
-        self.event_store.publish('order', create_event('entity_updated', order))
+        # trigger event
+        self._publish_orders('entity_deleted', [order])[0].result()
 
-    def billing_deleted(self, _item):
-        if _item.event_action != 'entity_delted':
-            return
+        return {
+            "result": True
+        }
 
-        billing = json.loads(_item.event_data)
-        rsp = send_message('read-model', 'get_entity', {'name': 'order', 'id': billing['order_id']})
-        order = rsp['result']
-        if not order['status'] == 'CLEARED':
+    def order_changed(self, _item, _order):
+        with self.orders_lock:
+            self._drop_pending(_order['entity_id'], _item.event_id)
+            self._apply_order(_item.event_action, _order)
+
+            # own events which are not received back yet follow this event, hence they are applied again on top
+            for _, action, order in self.orders_pending.get(_order['entity_id'], []):
+                self._apply_order(action, dict(order))
+
+    def billing_created(self, _item, _billing):
+        order = self._get_order(_billing['order_id'])
+        if not order or not order['status'] == 'IN_STOCK':
             return
 
-        order['status'] = 'UNCLEARED'
-        self.event_store.publish('order', create_event('entity_updated', order))
+        self._publish_orders('entity_patched', [create_patch(order, {'status': 'CLEARED'})])
 
-    def shipping_created(self, _item):
-        if _item.event_action != 'entity_created':
+    def billing_deleted(self, _item, _billing):
+        order = self._get_order(_billing['order_id'])
+        if not order or not order['status'] == 'CLEARED':
             return
 
-        shipping = json.loads(_item.event_data)
-        rsp = send_message('read-model', 'get_entity', {'name': 'order', 'id': shipping['order_id']})
-        order = rsp['result']
-        if not order['status'] == 'CLEARED':
+        self._publish_orders('entity_patched', [create_patch(order, {'status': 'UNCLEARED'})])
+
+    def shipping_created(self, _item, _shipping):
+        order = self._get_order(_shipping['order_id'])
+        if not order or not order['status'] == 'CLEARED':
             return
 
-        order['status'] = 'SHIPPED'
-        self.event_store.publish('order', create_event('entity_updated', order))
+        self._publish_orders('entity_patched', [create_patch(order, {'status': 'SHIPPED'})])
 
-    def shipping_updated(self, _item):
-        if _item.event_action != 'entity_updated':
+    def shipping_updated(self, _item, _shipping):
+        if not _shipping['delivered']:
             return
 
-        shipping = json.loads(_item.event_data)
-        if not shipping['delivered']:
+        order = self._get_order(_shipping['order_id'])
+        if not order or order['status'] == 'DELIVERED':
             return
 
-        rsp = send_message('read-model', 'get_entity', {'name': 'order', 'id': shipping['order_id']})
-        order = rsp['result']
-        order['status'] = 'DELIVERED'
-        self.event_store.publish('order', create_event('entity_updated', order))
+        self._publish_orders('entity_patched', [create_patch(order, {'status': 'DELIVERED'})])
 
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)-6s] %(message)s')
 
-o = OrderService()
+REDIS_HOST = os.getenv('ORDER_SERVICE_REDIS_HOST', 'localhost')
+REDIS_PORT = int(os.getenv('ORDER_SERVICE_REDIS_PORT', '6379'))
+
+o = OrderService(_redis_host=REDIS_HOST, _redis_port=REDIS_PORT)
 
 signal.signal(signal.SIGINT, lambda n, h: o.stop())
 signal.signal(signal.SIGTERM, lambda n, h: o.stop())
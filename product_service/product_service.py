@@ -1,8 +1,13 @@
 import logging
 import signal
+import time
 import uuid
 
 from event_store.event_store_client import EventStoreClient, create_event
+from lib.entity_patch import create_patch
+from lib.event_dispatcher import EventDispatcher
+from lib.event_publisher import EventPublisher
+from lib.product_catalogue import ProductCatalogue
 from message_queue.message_queue_client import Consumers, send_message
 
 
@@ -15,7 +20,13 @@ class ProductService(object):
         self.event_store = EventStoreClient()
         self.consumers = Consumers('product-service', [self.create_products,
                                                        self.update_product,
-                                                       self.delete_product])
+                                                       self.patch_product,
+                                                       self.delete_product,
+                                                       self.upsert_products])
+        self.publisher = EventPublisher(self.event_store)
+        self.catalogue = ProductCatalogue()
+        self.dispatcher = EventDispatcher(self.event_store)
+        self.dispatcher.register('product', self.product_changed)
 
     @staticmethod
     def _create_entity(_name, _price):
@@ -34,32 +45,51 @@ class ProductService(object):
 
     def start(self):
         logging.info('starting ...')
+        self.dispatcher.start()
+        self.catalogue.load(self.event_store)
         self.consumers.start()
         self.consumers.wait()
 
     def stop(self):
+        self.dispatcher.stop()
         self.consumers.stop()
+        self.publisher.stop()
         logging.info('stopped.')
 
     def create_products(self, _req):
         products = _req if isinstance(_req, list) else [_req]
-        product_ids = []
+        new_products = []
+        results = []
 
+        # validate all products first
         for product in products:
             try:
                 new_product = ProductService._create_entity(product['name'], product['price'])
-            except KeyError:
-                return {
+            except (KeyError, TypeError):
+                results.append({
                     "error": "missing mandatory parameter 'name' and/or 'price'"
-                }
+                })
+                continue
+
+            new_products.append(new_product)
+            results.append({
+                "result": new_product['entity_id']
+            })
+
+        # trigger events
+        events = [create_event('entity_created', new_product) for new_product in new_products]
+        self.publisher.publish_all('product', events, [new_product['entity_id'] for new_product in new_products])
 
-            # trigger event
-            self.event_store.publish('product', create_event('entity_created', new_product))
+        if isinstance(_req, list):
+            return {
+                "result": results
+            }
 
-            product_ids.append(new_product['entity_id'])
+        if 'error' in results[0]:
+            return results[0]
 
         return {
-            "result": product_ids
+            "result": [results[0]['result']]
         }
 
     def update_product(self, _req):
@@ -92,7 +122,38 @@ class ProductService(object):
             }
 
         # trigger event
-        self.event_store.publish('product', create_event('entity_updated', product))
+        self.publisher.publish('product', create_event('entity_updated', product)).result()
+
+        return {
+            "result": True
+        }
+
+    def patch_product(self, _req):
+        try:
+            product_id = _req['entity_id']
+        except KeyError:
+            return {
+                "error": "missing mandatory parameter 'entity_id'"
+            }
+
+        product = self.catalogue.get(product_id)
+        if not product:
+            rsp = send_message('read-model', 'get_entity', {'name': 'product', 'id': product_id})
+            if 'error' in rsp:
+                rsp['error'] += ' (from read-model)'
+                return rsp
+
+            product = rsp['result']
+            if not product:
+                return {
+                    "error": "could not find product"
+                }
+
+        # trigger event, if any prop changed
+        patch = create_patch(product, {prop_name: _req[prop_name] for prop_name in ['name', 'price']
+                                       if prop_name in _req})
+        if patch:
+            self.publisher.publish('product', create_event('entity_patched', patch)).result()
 
         return {
             "result": True
@@ -118,12 +179,62 @@ class ProductService(object):
             }
 
         # trigger event
-        self.event_store.publish('product', create_event('entity_deleted', product))
+        self.publisher.publish('product', create_event('entity_deleted', product)).result()
 
         return {
             "result": True
         }
 
+    def upsert_products(self, _req):
+        start = time.time()
+        created = []
+        updated = []
+        failed = 0
+
+        # compare with the catalogue, unchanged products are skipped
+        for product in _req:
+            try:
+                name, price = product['name'], int(product['price'])
+            except (KeyError, TypeError, ValueError):
+                failed += 1
+                continue
+
+            current = self.catalogue.get(product.get('entity_id'))
+            if not current:
+                new_product = ProductService._create_entity(name, price)
+                new_product['entity_id'] = product.get('entity_id') or new_product['entity_id']
+                created.append(new_product)
+            else:
+                patch = create_patch(current, {'name': name, 'price': price})
+                if patch:
+                    updated.append(patch)
+
+        # trigger events, updates only carry the changed props
+        events = [create_event('entity_created', product) for product in created]
+        events += [create_event('entity_patched', patch) for patch in updated]
+        products = created + updated
+        self.publisher.publish_all('product', events, [product['entity_id'] for product in products])
+        [self.catalogue.apply(event['event_action'], product) for event, product in zip(events, products)]
+
+        elapsed = time.time() - start
+        change_ratio = len(products) / len(_req) if _req else 0
+        logging.info('upserted {} products, {} created, {} updated, {} failed, change ratio {:.2%}, {:.2f}s'.format(
+            len(_req), len(created), len(updated), failed, change_ratio, elapsed))
+
+        return {
+            "result": {
+                "created": len(created),
+                "updated": len(updated),
+                "unchanged": len(_req) - len(products) - failed,
+                "failed": failed,
+                "change_ratio": change_ratio,
+                "elapsed": elapsed
+            }
+        }
+
+    def product_changed(self, _item, _product):
+        self.catalogue.apply(_item.event_action, _product)
+
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)-6s] %(message)s')
 
@@ -0,0 +1,81 @@
+import bisect
+import threading
+
+
+class MailProjection(object):
+    """
+    Mail Projection class, the sent mails in the order of their events, indexed by recipient and time.
+
+    Mails are identified by their position, which also serves as pagination cursor. The time index holds the
+    running maximum of the event TS, so it is sorted even if the clocks of the publishers are not in sync.
+    """
+
+    def __init__(self):
+        self.mails = []
+        self.max_ts = []
+        self.recipients = {}
+        self.event_ids = set()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.mails)
+
+    def add(self, _event_id, _event_ts, _mail):
+        """
+        Add a mail, mails of events which are already added are ignored.
+
+        :param _event_id: The event ID.
+        :param _event_ts: The event TS.
+        :param _mail: A dict with the recipient and the message of the mail.
+        """
+        with self.lock:
+            if _event_id in self.event_ids:
+                return
+            self.event_ids.add(_event_id)
+
+            pos = len(self.mails)
+            self.mails.append({
+                'event_id': _event_id,
+                'event_ts': float(_event_ts),
+                'recipient': _mail['recipient'],
+                'message': _mail['message']
+            })
+            self.max_ts.append(max(float(_event_ts), self.max_ts[-1] if self.max_ts else 0))
+            self.recipients.setdefault(_mail['recipient'], []).append(pos)
+
+    def query(self, _to=None, _since=None, _limit=100, _cursor=None):
+        """
+        Query mails in the order they were sent.
+
+        :param _to: An optional recipient.
+        :param _since: An optional TS, only mails sent at or after it are returned.
+        :param _limit: The maximum amount of mails, at least 1.
+        :param _cursor: An optional cursor of a previous query, to get the next page.
+        :return: A tuple with a list of mails and the cursor of the next page, None if there are no more mails.
+        :raise ValueError: In case the limit is less than 1.
+        """
+        if _limit < 1:
+            raise ValueError('invalid limit {}'.format(_limit))
+
+        with self.lock:
+            start = int(_cursor) if _cursor else 0
+            if _since:
+                start = max(start, bisect.bisect_left(self.max_ts, float(_since)))
+
+            # positions of the mails to scan, without copying
+            if _to:
+                positions = self.recipients.get(_to, [])
+            else:
+                positions = range(len(self.mails))
+
+            result = []
+            cursor = None
+            for i in range(bisect.bisect_left(positions, start), len(positions)):
+                if len(result) == _limit:
+                    cursor = str(positions[i])
+                    break
+                mail = self.mails[positions[i]]
+                if not _since or mail['event_ts'] >= float(_since):
+                    result.append(mail)
+
+            return result, cursor
@@ -9,7 +9,14 @@ import redis
 
 from domain_model import DomainModel
 from event_store.event_store_client import EventStoreClient, create_event
+from lib.bloom_filter import RotatingBloomFilter
+from lib.cart_items import ITEM_ACTIONS, apply_item, get_items
+from lib.entity_patch import apply_patch
+from lib.read_batch import ReadBatch, resolve_params
 from message_queue.message_queue_client import Consumers
+from mail_projection import MailProjection
+from time_index import TimeIndex
+from unique_index import UniqueIndex
 
 
 class ReadModel(object):
@@ -17,19 +24,42 @@ class ReadModel(object):
     Read Model class.
     """
 
+    # entities with time indexes, on their creation TS and on TS properties
+    TIME_INDEXES = {
+        'shipping': ['delivered']
+    }
+
+    # entities with unique indexes, on properties whose values are unique among the entities
+    UNIQUE_INDEXES = {
+        'customer': ['email']
+    }
+
     def __init__(self, _redis_host='localhost', _redis_port=6379):
         self.event_store = EventStoreClient()
         self.consumers = Consumers('read-model', [self.get_entity,
                                                   self.get_entities,
+                                                  self.get_entity_ids,
+                                                  self.batch,
                                                   self.get_mails,
                                                   self.get_unbilled_orders,
                                                   self.get_unshipped_orders,
-                                                  self.get_delivered_orders])
+                                                  self.get_delivered_orders,
+                                                  self.get_undelivered_orders])
         self.domain_model = DomainModel(
             redis.StrictRedis(host=_redis_host, port=_redis_port, decode_responses=True)
         )
         self.subscriptions = {}
         self.locks = {}
+        self.replays = {}
+        self.replays_lock = threading.Lock()
+        self.mails = None
+        self.mails_lock = threading.Lock()
+        self.time_indexes = {}
+        self.time_indexes_lock = threading.Lock()
+        self.unique_indexes = {}
+        self.unique_indexes_lock = threading.Lock()
+        self.items = {}
+        self.seen = RotatingBloomFilter()
 
     @staticmethod
     def _deduce_entities(_events):
@@ -42,23 +72,23 @@ class ReadModel(object):
         if not _events:
             return {}
 
-        # find 'created' events
-        result = {json.loads(e[1]['event_data'])['entity_id']: json.loads(e[1]['event_data'])
-                  for e in filter(lambda x: x[1]['event_action'] == 'entity_created', _events)}
+        result = {}
+        for _, event in _events:
+            entity = json.loads(event['event_data'])
 
-        # remove 'deleted' events
-        deleted = {json.loads(e[1]['event_data'])['entity_id']: json.loads(e[1]['event_data'])
-                   for e in filter(lambda x: x[1]['event_action'] == 'entity_deleted', _events)}
+            if event['event_action'] in ('entity_created', 'entity_updated'):
+                result[entity['entity_id']] = entity
 
-        for d_id, d_data in deleted.items():
-            del result[d_id]
+            if event['event_action'] == 'entity_deleted':
+                result.pop(entity['entity_id'], None)
 
-        # change 'updated' events
-        updated = {json.loads(e[1]['event_data'])['entity_id']: json.loads(e[1]['event_data'])
-                   for e in filter(lambda x: x[1]['event_action'] == 'entity_updated', _events)}
+            if event['event_action'] == 'entity_patched' and entity['entity_id'] in result:
+                result[entity['entity_id']] = apply_patch(result[entity['entity_id']], entity)
 
-        for u_id, u_data in updated.items():
-            result[u_id] = u_data
+            if event['event_action'] in ITEM_ACTIONS and entity['entity_id'] in result:
+                cart = result[entity['entity_id']]
+                items = apply_item(get_items(cart), event['event_action'], entity)
+                result[entity['entity_id']] = apply_patch(cart, {'items': items})
 
         return result
 
@@ -69,19 +99,270 @@ class ReadModel(object):
         :param _name: The entity name.
         :param _event: The event data.
         """
-        if not self.domain_model.exists(_name):
+        # events delivered again are dropped, an item event must not be applied twice
+        if not self.seen.add('{}:{}'.format(_name, _event.event_id)):
+            logging.info('dropping duplicate {} event {}'.format(_name, _event.event_id))
             return
 
         entity = json.loads(_event.event_data)
 
-        if _event.event_action == 'entity_created':
-            self.domain_model.create(_name, entity)
+        with self.replays_lock:
+            [buffer.append(_event) for buffer in self.replays.get(_name, [])]
+            time_indexes = self.time_indexes.get(_name)
+            unique_indexes = self.unique_indexes.get(_name)
+
+        # the domain model is updated first, so that an event is not lost if it cannot be indexed
+        if self.domain_model.exists(_name):
+            self._track_model(_name, _event.event_action, entity)
+        else:
+            self.items.pop(_name, None)
+
+        if time_indexes:
+            ReadModel._index_entity(time_indexes, _event.event_action, _event.event_ts, entity)
+
+        if unique_indexes:
+            ReadModel._index_unique(unique_indexes, _event.event_action, entity)
+
+    def _track_model(self, _name, _action, _entity):
+        """
+        Apply an entity event to the domain model.
+
+        :param _name: The entity name.
+        :param _action: The event action.
+        :param _entity: The entity, or an entity patch or item.
+        """
+        if _action == 'entity_created':
+            self.domain_model.create(_name, _entity)
+
+        if _action == 'entity_deleted':
+            self.domain_model.delete(_name, _entity)
+
+        # the domain model sets the given props only, i.e. a patch is applied in place
+        if _action in ('entity_updated', 'entity_patched'):
+            self.domain_model.update(_name, _entity)
+
+        # an item event changes a single line, the items are written as a whole
+        if _action in ITEM_ACTIONS:
+            items, entity_id = self._query_items(_name), _entity['entity_id']
+            if entity_id in items:
+                items[entity_id] = apply_item(items[entity_id], _action, _entity)
+                self.domain_model.update(_name, {'entity_id': entity_id, 'items': items[entity_id]})
+        else:
+            self._track_items(_name, _action, _entity)
+
+    def _query_items(self, _name):
+        """
+        Query the items of all carts, they are loaded from the domain model on first use and kept up to date by
+        the cart events, so that an item event does not load all carts to change a single line.
+
+        :param _name: The entity name.
+        :return: A dict mapping cart ID -> items.
+        """
+        if _name not in self.items:
+            self.items[_name] = {entity_id: get_items(cart) for entity_id, cart in self._query_entities(_name).items()}
+
+        return self.items[_name]
+
+    def _track_items(self, _name, _action, _entity):
+        """
+        Keep the items of carts up to date, once they are loaded.
+
+        :param _name: The entity name.
+        :param _action: The event action.
+        :param _entity: The entity, or an entity patch.
+        """
+        if _name not in self.items:
+            return
+
+        entity_id = _entity['entity_id']
+        if _action == 'entity_deleted':
+            self.items[_name].pop(entity_id, None)
+        elif _action in ('entity_created', 'entity_updated'):
+            self.items[_name][entity_id] = get_items(_entity)
+        elif _action == 'entity_patched' and {'items', 'product_ids'} & _entity.keys():
+            self.items[_name][entity_id] = get_items(_entity)
+
+    @staticmethod
+    def _index_entity(_indexes, _action, _event_ts, _entity):
+        """
+        Apply an entity event to the time indexes of the entity.
+
+        :param _indexes: A dict mapping 'created' or property name -> time index.
+        :param _action: The event action.
+        :param _event_ts: The event TS.
+        :param _entity: The entity.
+        """
+        entity_id = _entity['entity_id']
+        if _action == 'entity_deleted':
+            [index.remove(entity_id) for index in _indexes.values()]
+            return
+
+        if _action == 'entity_created':
+            _indexes['created'].set(entity_id, _event_ts)
+
+        for prop_name, index in _indexes.items():
+            if prop_name == 'created' or (_action == 'entity_patched' and prop_name not in _entity):
+                continue
+            if _entity.get(prop_name):
+                index.set(entity_id, _entity[prop_name])
+            else:
+                index.remove(entity_id)
+
+    def _query_time_index(self, _name, _prop_name):
+        """
+        Query a time index, the time indexes of an entity are built from its events on first use.
+
+        :param _name: The entity name.
+        :param _prop_name: 'created' or the property name.
+        :return: The time index.
+        """
+        if _name in self.time_indexes:
+            return self.time_indexes[_name][_prop_name]
+
+        with self.time_indexes_lock:
+            if _name in self.time_indexes:
+                return self.time_indexes[_name][_prop_name]
+
+            # make sure the entities are tracked
+            self._query_entities(_name)
+            self._subscribe_entities(_name)
+
+            indexes = {prop_name: TimeIndex() for prop_name in ['created'] + ReadModel.TIME_INDEXES[_name]}
+            self._replay_events(
+                _name, lambda _id, _action, _ts, _entity: ReadModel._index_entity(indexes, _action, _ts, _entity),
+                functools.partial(self.time_indexes.__setitem__, _name, indexes))
+
+            return indexes[_prop_name]
+
+    @staticmethod
+    def _index_unique(_indexes, _action, _entity):
+        """
+        Apply an entity event to the unique indexes of the entity.
+
+        :param _indexes: A dict mapping property name -> unique index.
+        :param _action: The event action.
+        :param _entity: The entity.
+        """
+        for prop_name, index in _indexes.items():
+            if _action == 'entity_deleted':
+                index.remove(_entity['entity_id'])
+            elif _action in ('entity_created', 'entity_updated'):
+                index.set(_entity['entity_id'], _entity.get(prop_name))
+            elif _action == 'entity_patched' and prop_name in _entity:
+                index.set(_entity['entity_id'], _entity[prop_name])
+
+    def _query_unique_index(self, _name, _prop_name):
+        """
+        Query a unique index, the unique indexes of an entity are built from its events on first use.
+
+        :param _name: The entity name.
+        :param _prop_name: The property name.
+        :return: The unique index.
+        """
+        if _name in self.unique_indexes:
+            return self.unique_indexes[_name][_prop_name]
+
+        with self.unique_indexes_lock:
+            if _name in self.unique_indexes:
+                return self.unique_indexes[_name][_prop_name]
+
+            # make sure the entities are tracked
+            self._query_entities(_name)
+            self._subscribe_entities(_name)
+
+            indexes = {prop_name: UniqueIndex() for prop_name in ReadModel.UNIQUE_INDEXES[_name]}
+            self._replay_events(
+                _name, lambda _id, _action, _ts, _entity: ReadModel._index_unique(indexes, _action, _entity),
+                functools.partial(self.unique_indexes.__setitem__, _name, indexes))
+
+            return indexes[_prop_name]
+
+    def _replay_events(self, _topic, _apply, _commit):
+        """
+        Apply the event history of a topic, e.g. to build an index. The topic must be subscribed to already, events
+        received meanwhile are buffered and applied afterwards, so that no event is lost or applied out of order.
+
+        :param _topic: The event topic.
+        :param _apply: A function to call with the ID, action, TS and decoded data of each event.
+        :param _commit: A function to call when all events are applied, e.g. to register the index, so that
+                        subsequent events are applied by the event handler.
+        """
+        buffer = []
+        with self.replays_lock:
+            self.replays.setdefault(_topic, []).append(buffer)
+
+        try:
+            seen = set()
+            for _, event in self.event_store.get(_topic) or []:
+                seen.add(event['event_id'])
+                _apply(event['event_id'], event['event_action'], event['event_ts'],
+                       json.loads(event['event_data']))
+
+            while True:
+                with self.replays_lock:
+                    items, buffer[:] = list(buffer), []
+                    if not items:
+                        _commit()
+                        return
+
+                for item in items:
+                    if item.event_id not in seen:
+                        seen.add(item.event_id)
+                        _apply(item.event_id, item.event_action, item.event_ts, json.loads(item.event_data))
+        finally:
+            with self.replays_lock:
+                self.replays[_topic].remove(buffer)
+
+    @staticmethod
+    def _add_mail(_mails, _event_id, _action, _event_ts, _mail):
+        """
+        Apply a mail event to the mail projection.
+
+        :param _mails: The mail projection.
+        :param _event_id: The event ID.
+        :param _action: The event action.
+        :param _event_ts: The event TS.
+        :param _mail: The mail.
+        """
+        if _action == 'mail_sent':
+            _mails.add(_event_id, _event_ts, _mail)
+
+    def _track_mails(self, _event):
+        """
+        Keep track of mail events.
+
+        :param _event: The event data.
+        """
+        with self.replays_lock:
+            [buffer.append(_event) for buffer in self.replays.get('mail', [])]
+            mails = self.mails
+
+        if mails is not None:
+            ReadModel._add_mail(mails, _event.event_id, _event.event_action, _event.event_ts,
+                                json.loads(_event.event_data))
+
+    def _query_mails(self):
+        """
+        Query the mail projection, it is built from the mail events on first use.
+
+        :return: The mail projection.
+        """
+        if self.mails is not None:
+            return self.mails
+
+        with self.mails_lock:
+            if self.mails is not None:
+                return self.mails
 
-        if _event.event_action == 'entity_deleted':
-            self.domain_model.delete(_name, entity)
+            # track mails, mails sent while the history is replayed are buffered
+            self.event_store.subscribe('mail', self._track_mails)
+            self.subscriptions['mail'] = self._track_mails
 
-        if _event.event_action == 'entity_updated':
-            self.domain_model.update(_name, entity)
+            mails = MailProjection()
+            self._replay_events('mail', functools.partial(ReadModel._add_mail, mails),
+                                functools.partial(setattr, self, 'mails', mails))
+
+            return self.mails
 
     def _query_entities(self, _name):
         """
@@ -111,12 +392,21 @@ class ReadModel(object):
                 self.domain_model.create(_name, entity)
 
             # track entities
+            self._subscribe_entities(_name)
+
+            return entities
+
+    def _subscribe_entities(self, _name):
+        """
+        Subscribe to the events of an entity, unless already subscribed.
+
+        :param _name: The entity name.
+        """
+        if _name not in self.subscriptions:
             tracking_handler = functools.partial(self._track_entities, _name)
             self.event_store.subscribe(_name, tracking_handler)
             self.subscriptions[_name] = tracking_handler
 
-            return entities
-
     def _query_defined_entities(self, _name, _props):
         """
         Query entities with defined properities.
@@ -125,6 +415,16 @@ class ReadModel(object):
         :param _props: A dict mapping property name -> property value(s).
         :return: A dict mapping entity ID -> entity.
         """
+        # look up a unique property in its index, instead of scanning all entities, if a value is not unique, e.g. of
+        # entities created before the index, only the last entity with it is found
+        if len(_props) == 1 and next(iter(_props)) in ReadModel.UNIQUE_INDEXES.get(_name, []):
+            prop_name, prop_value = next(iter(_props.items()))
+            index = self._query_unique_index(_name, prop_name)
+            entities = self._query_entities(_name)
+            entity_ids = [index.get(value) for value in (prop_value if isinstance(prop_value, list) else [prop_value])]
+
+            return {entity_id: entities[entity_id] for entity_id in entity_ids if entity_id in entities}
+
         result = {}
         for entity_id, entity in self._query_entities(_name).items():
             for prop_name, prop_value in _props.items():
@@ -179,15 +479,32 @@ class ReadModel(object):
 
         return unshipped
 
-    def _delivered_orders(self):
+    def _delivered_orders(self, _from=None, _to=None):
         """
-        Query all delivered orders.
+        Query delivered orders, optionally within a time range.
 
-        :return: a dict mapping entity ID -> entity.
+        :param _from: An optional TS, orders delivered at or after it are included.
+        :param _to: An optional TS, orders delivered before it are included.
+        :return: a list with the shippings of the orders.
         """
         shippings = self._query_entities('shipping')
+        shipping_ids = self._query_time_index('shipping', 'delivered').range(_from, _to)
+
+        return [shippings[shipping_id] for shipping_id in shipping_ids if shipping_id in shippings]
 
-        return list(filter(lambda x: x['delivered'], shippings.values()))
+    def _undelivered_orders(self, _before=None):
+        """
+        Query shipped but undelivered orders, optionally shipped before a TS.
+
+        :param _before: An optional TS, orders shipped before it are included.
+        :return: a list with the shippings of the orders.
+        """
+        shippings = self._query_entities('shipping')
+        delivered = self._query_time_index('shipping', 'delivered')
+        shipping_ids = self._query_time_index('shipping', 'created').range(None, _before)
+
+        return [shippings[shipping_id] for shipping_id in shipping_ids
+                if shipping_id not in delivered and shipping_id in shippings]
 
     def start(self):
         logging.info('starting ...')
@@ -247,9 +564,73 @@ class ReadModel(object):
                 'result': list(self._query_entities(_req['name']).values())
             }
 
+    def get_entity_ids(self, _req):
+        try:
+            index = self._query_unique_index(_req['name'], _req['prop'])
+        except (KeyError, TypeError):
+            return {
+                "error": "missing mandatory parameter 'name' and/or 'prop', or no unique index"
+            }
+
+        if not isinstance(_req.get('values'), list):
+            return {
+                "error": "missing mandatory parameter 'values'"
+            }
+
+        return {
+            'result': [index.get(value) for value in _req['values']]
+        }
+
+    def batch(self, _req):
+        if not isinstance(_req, list):
+            return {
+                "error": "invalid parameter, a list of requests is expected"
+            }
+
+        # requests may refer to the results of earlier ones, hence they are processed in order
+        results = []
+        for req in _req:
+            try:
+                if req['func'] not in ReadBatch.FUNCS:
+                    raise ValueError('unknown function {}'.format(req['func']))
+                params = resolve_params(req.get('params') or {}, results)
+            except (KeyError, TypeError, ValueError) as e:
+                results.append({
+                    "error": "invalid request: {}".format(e)
+                })
+                continue
+
+            if params is None:
+                results.append({
+                    'result': None
+                })
+                continue
+
+            try:
+                results.append(getattr(self, req['func'])(params))
+            except Exception as e:
+                logging.exception('could not process batch request {}'.format(req['func']))
+                results.append({
+                    "error": "could not process request: {}".format(e)
+                })
+
+        return {
+            'result': results
+        }
+
     def get_mails(self, _req):
+        _req = _req or {}
+        try:
+            mails, cursor = self._query_mails().query(_req.get('to'), _req.get('since'), int(_req.get('limit', 100)),
+                                                      _req.get('cursor'))
+        except ValueError:
+            return {
+                "error": "invalid parameter 'since', 'limit' and/or 'cursor'"
+            }
+
         return {
-            'result': self.event_store.get('mail') or []
+            'result': mails,
+            'cursor': cursor
         }
 
     def get_unbilled_orders(self, _req):
@@ -263,9 +644,26 @@ class ReadModel(object):
         }
 
     def get_delivered_orders(self, _req):
-        return {
-            'result': self._delivered_orders()
-        }
+        _req = _req or {}
+        try:
+            return {
+                'result': self._delivered_orders(_req.get('from'), _req.get('to'))
+            }
+        except ValueError:
+            return {
+                "error": "invalid parameter 'from' and/or 'to'"
+            }
+
+    def get_undelivered_orders(self, _req):
+        _req = _req or {}
+        try:
+            return {
+                'result': self._undelivered_orders(_req.get('before'))
+            }
+        except ValueError:
+            return {
+                "error": "invalid parameter 'before'"
+            }
 
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)-6s] %(message)s')
@@ -0,0 +1,67 @@
+import bisect
+import logging
+import threading
+
+
+class TimeIndex(object):
+    """
+    Time Index class, a sorted index of entity IDs by TS, for range queries.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.timestamps = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, _entity_id):
+        return _entity_id in self.timestamps
+
+    def _remove(self, _entity_id):
+        ts = self.timestamps.pop(_entity_id, None)
+        if ts is not None:
+            del self.entries[bisect.bisect_left(self.entries, (ts, _entity_id))]
+
+    def set(self, _entity_id, _ts):
+        """
+        Set the TS of an entity. An entity with an invalid TS, e.g. a non-numeric one, is removed instead.
+
+        :param _entity_id: The entity ID.
+        :param _ts: The TS.
+        """
+        try:
+            ts = float(_ts)
+        except (TypeError, ValueError):
+            logging.warning('not indexing entity {} with invalid TS {!r}'.format(_entity_id, _ts))
+            ts = None
+
+        with self.lock:
+            self._remove(_entity_id)
+            if ts is not None:
+                bisect.insort(self.entries, (ts, _entity_id))
+                self.timestamps[_entity_id] = ts
+
+    def remove(self, _entity_id):
+        """
+        Remove an entity.
+
+        :param _entity_id: The entity ID.
+        """
+        with self.lock:
+            self._remove(_entity_id)
+
+    def range(self, _from=None, _to=None):
+        """
+        Query the entities within a time range.
+
+        :param _from: An optional TS, the range includes it.
+        :param _to: An optional TS, the range excludes it.
+        :return: A list with the entity IDs, ordered by TS.
+        """
+        with self.lock:
+            start = bisect.bisect_left(self.entries, (float(_from),)) if _from is not None else 0
+            end = bisect.bisect_left(self.entries, (float(_to),)) if _to is not None else len(self.entries)
+
+            return [entity_id for _, entity_id in self.entries[start:end]]
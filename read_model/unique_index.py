@@ -0,0 +1,69 @@
+import threading
+
+
+class UniqueIndex(object):
+    """
+    Unique Index class, an index of entity IDs by a property value which is unique among the entities, e.g. an email
+    address. Values are compared case-insensitive, ignoring surrounding whitespace.
+    """
+
+    def __init__(self):
+        self.entity_ids = {}
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entity_ids)
+
+    def __contains__(self, _value):
+        return UniqueIndex.normalize(_value) in self.entity_ids
+
+    @staticmethod
+    def normalize(_value):
+        """
+        Normalize a value for comparison.
+
+        :param _value: The value.
+        :return: The normalized value.
+        """
+        return _value.strip().lower() if isinstance(_value, str) else _value
+
+    def _remove(self, _entity_id):
+        value = self.values.pop(_entity_id, None)
+        if value is not None and self.entity_ids.get(value) == _entity_id:
+            del self.entity_ids[value]
+
+    def set(self, _entity_id, _value):
+        """
+        Set the value of an entity, an entity which had the value before loses it.
+
+        :param _entity_id: The entity ID.
+        :param _value: The value, None to remove the entity.
+        """
+        with self.lock:
+            self._remove(_entity_id)
+            if _value is None:
+                return
+
+            value = UniqueIndex.normalize(_value)
+            self.values.pop(self.entity_ids.get(value), None)
+            self.entity_ids[value] = _entity_id
+            self.values[_entity_id] = value
+
+    def remove(self, _entity_id):
+        """
+        Remove an entity.
+
+        :param _entity_id: The entity ID.
+        """
+        with self.lock:
+            self._remove(_entity_id)
+
+    def get(self, _value):
+        """
+        Get the entity with a value.
+
+        :param _value: The value.
+        :return: The entity ID, or None if no entity has the value.
+        """
+        return self.entity_ids.get(UniqueIndex.normalize(_value))
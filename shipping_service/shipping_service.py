@@ -1,9 +1,17 @@
 import json
 import logging
+import os
 import signal
+import threading
 import uuid
 
 from event_store.event_store_client import EventStoreClient, create_event
+from lib.bloom_filter import RotatingBloomFilter
+from lib.consumer_group import ConsumerGroup
+from lib.event_dispatcher import EventDispatcher
+from lib.event_publisher import EventPublisher
+from lib.keyed_executor import KeyedExecutor
+from lib.redis_channel import RedisChannel
 from message_queue.message_queue_client import Consumers, send_message
 
 
@@ -12,11 +20,21 @@ class ShippingService(object):
     Shipping Service class.
     """
 
-    def __init__(self):
+    def __init__(self, _workers=8, _max_queue=100, _redis_host='localhost', _redis_port=6379):
         self.event_store = EventStoreClient()
+        self.publisher = EventPublisher(self.event_store)
         self.consumers = Consumers('shipping-service', [self.create_shippings,
                                                         self.update_shipping,
-                                                        self.delete_shipping])
+                                                        self.delete_shipping,
+                                                        self.mark_delivered])
+        self.shippings = {}
+        self.shipping_orders = {}
+        self.shippings_lock = threading.Lock()
+        self.group = ConsumerGroup(RedisChannel(_redis_host, _redis_port), 'shipping-service')
+        self.executor = KeyedExecutor('shipping-service', _workers, _max_queue)
+        self.dispatcher = EventDispatcher(self.event_store, self.group, RotatingBloomFilter(), self.executor)
+        self.dispatcher.register('billing', self.billing_created, 'entity_created')
+        self.dispatcher.register('shipping', self.shipping_changed, _broadcast=True)
 
     @staticmethod
     def _create_entity(_order_id, _delivered=0):
@@ -33,15 +51,79 @@ class ShippingService(object):
             'delivered': _delivered
         }
 
+    @staticmethod
+    def _valid_ts(_ts):
+        """
+        Check a TS indicating delivery, it must be numeric, e.g. as indexed by the read model.
+
+        :param _ts: The TS.
+        :return: True if the TS is valid, else False.
+        """
+        try:
+            float(_ts)
+        except (TypeError, ValueError):
+            return False
+
+        return True
+
+    def _apply_shipping(self, _action, _shipping):
+        """
+        Apply a shipping event to the shipping index.
+
+        :param _action: The event action.
+        :param _shipping: The shipping entity.
+        """
+        if _action == 'entity_deleted':
+            self.shippings.pop(_shipping['entity_id'], None)
+            if self.shipping_orders.get(_shipping['order_id']) == _shipping['entity_id']:
+                del self.shipping_orders[_shipping['order_id']]
+        elif _action in ('entity_created', 'entity_updated'):
+            self.shippings[_shipping['entity_id']] = _shipping
+            self.shipping_orders[_shipping['order_id']] = _shipping['entity_id']
+
+    def _load_shippings(self):
+        """
+        Build the shipping index from the shipping event history.
+        """
+        with self.shippings_lock:
+            for event in self.event_store.get('shipping') or []:
+                self._apply_shipping(event[1]['event_action'], json.loads(event[1]['event_data']))
+
+        logging.info('indexed {} shippings'.format(len(self.shippings)))
+
+    def _get_shipping(self, _shipping_id=None, _order_id=None):
+        """
+        Get a shipping by its ID or its order ID from the shipping index, or from the read model if it is not
+        indexed (yet).
+
+        :param _shipping_id: The shipping ID.
+        :param _order_id: The order ID, if the shipping ID is not given.
+        :return: A copy of the shipping, or None if it could not be found.
+        """
+        shipping = self.shippings.get(_shipping_id or self.shipping_orders.get(_order_id))
+        if shipping:
+            return dict(shipping)
+
+        if _shipping_id:
+            rsp = send_message('read-model', 'get_entity', {'name': 'shipping', 'id': _shipping_id})
+        else:
+            rsp = send_message('read-model', 'get_entity', {'name': 'shipping', 'props': {'order_id': _order_id}})
+        if 'error' in rsp:
+            raise Exception(rsp['error'] + ' (from read-model)')
+
+        return rsp['result']
+
     def start(self):
         logging.info('starting ...')
-        self.event_store.subscribe('billing', self.billing_created)
+        self.dispatcher.start()
+        self._load_shippings()
         self.consumers.start()
         self.consumers.wait()
 
     def stop(self):
-        self.event_store.unsubscribe('billing', self.billing_created)
+        self.dispatcher.stop()
         self.consumers.stop()
+        self.publisher.stop()
         logging.info('stopped.')
 
     def create_shippings(self, _req):
@@ -57,7 +139,7 @@ class ShippingService(object):
                 }
 
             # trigger event
-            self.event_store.publish('shipping', create_event('entity_created', new_shipping))
+            self.publisher.publish('shipping', create_event('entity_created', new_shipping)).result()
 
             shipping_ids.append(new_shipping['entity_id'])
 
@@ -93,9 +175,13 @@ class ShippingService(object):
             return {
                 "result": "missing mandatory parameter 'order_id' and/or 'delivered"
             }
+        if not ShippingService._valid_ts(shipping['delivered']):
+            return {
+                "error": "invalid parameter 'delivered'"
+            }
 
         # trigger event
-        self.event_store.publish('shipping', create_event('entity_updated', shipping))
+        self.publisher.publish('shipping', create_event('entity_updated', shipping)).result()
 
         return {
             "result": True
@@ -121,24 +207,67 @@ class ShippingService(object):
             }
 
         # trigger event
-        self.event_store.publish('shipping', create_event('entity_deleted', shipping))
+        self.publisher.publish('shipping', create_event('entity_deleted', shipping)).result()
 
         return {
             "result": True
         }
 
-    def billing_created(self, _item):
-        if _item.event_action != 'entity_created':
-            return
+    def mark_delivered(self, _req):
+        confirmations = _req if isinstance(_req, list) else [_req]
+        results = []
+        shippings = []
+
+        for confirmation in confirmations:
+            if not isinstance(confirmation, dict):
+                results.append({"error": "invalid confirmation, expected an object with 'entity_id' or 'order_id'"})
+                continue
+            if not confirmation.get('delivered') or not (confirmation.get('entity_id') or confirmation.get('order_id')):
+                results.append({"error": "missing mandatory parameter 'entity_id' or 'order_id' and/or 'delivered'"})
+                continue
+            if not ShippingService._valid_ts(confirmation['delivered']):
+                results.append({"error": "invalid parameter 'delivered'"})
+                continue
+
+            try:
+                shipping = self._get_shipping(confirmation.get('entity_id'), confirmation.get('order_id'))
+            except Exception as e:
+                results.append({"error": str(e)})
+                continue
 
-        billing = json.loads(_item.event_data)
-        shipping = ShippingService._create_entity(billing['order_id'])
-        self.event_store.publish('shipping', create_event('entity_created', shipping))
+            if not shipping:
+                results.append({"error": "could not find shipping"})
+                continue
+
+            shipping['delivered'] = confirmation['delivered']
+            shippings.append(shipping)
+            results.append({"result": shipping['entity_id']})
+
+        # trigger events
+        self.publisher.publish_all('shipping', [create_event('entity_updated', shipping) for shipping in shippings],
+                                   [shipping['entity_id'] for shipping in shippings])
+
+        return {
+            "result": results
+        }
+
+    def shipping_changed(self, _item, _shipping):
+        with self.shippings_lock:
+            self._apply_shipping(_item.event_action, _shipping)
+
+    def billing_created(self, _item, _billing):
+        shipping = ShippingService._create_entity(_billing['order_id'])
+        self.publisher.publish('shipping', create_event('entity_created', shipping))
 
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)-6s] %(message)s')
 
-p = ShippingService()
+WORKERS = int(os.getenv('SHIPPING_SERVICE_WORKERS', '8'))
+MAX_QUEUE = int(os.getenv('SHIPPING_SERVICE_MAX_QUEUE', '100'))
+REDIS_HOST = os.getenv('SHIPPING_SERVICE_REDIS_HOST', 'localhost')
+REDIS_PORT = int(os.getenv('SHIPPING_SERVICE_REDIS_PORT', '6379'))
+
+p = ShippingService(_workers=WORKERS, _max_queue=MAX_QUEUE, _redis_host=REDIS_HOST, _redis_port=REDIS_PORT)
 
 signal.signal(signal.SIGINT, lambda n, h: p.stop())
 signal.signal(signal.SIGTERM, lambda n, h: p.stop())
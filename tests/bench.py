@@ -0,0 +1,305 @@
+import collections
+import json
+import logging
+import random
+import sys
+import time
+import uuid
+
+from urllib import request
+
+from tests.common import BASE_URL, create_carts, create_customers, create_inventories, create_products, \
+    http_cmd_req, get_result
+
+
+def bench_bulk_import(amount=10000):
+    """
+    Measure the throughput of bulk imports.
+
+    :param amount: The amount of entities per import.
+    """
+    for name, entities in [('customer', create_customers(amount)), ('product', create_products(amount))]:
+        start = time.time()
+        rsp = http_cmd_req('{}/{}'.format(BASE_URL, name), entities)
+        results = get_result(rsp)
+        elapsed = time.time() - start
+
+        failed = len([result for result in results if 'error' in result])
+        logging.info("imported {} {}s ({} failed) in {:.2f}s, {:.0f} items/s".format(
+            amount - failed, name, failed, elapsed, amount / elapsed))
+
+
+def bench_mark_delivered(amount=100000, chunk=10000):
+    """
+    Measure the throughput of bulk delivery confirmations, half of them by shipping ID, half by order ID.
+
+    :param amount: The amount of confirmations.
+    :param chunk: The amount of confirmations per request.
+    """
+    order_ids = [str(uuid.uuid4()) for _ in range(amount)]
+    shipping_ids = []
+    for i in range(0, amount, chunk):
+        shippings = [{'order_id': order_id} for order_id in order_ids[i:i + chunk]]
+        shipping_ids += get_result(http_cmd_req('{}/shipping'.format(BASE_URL), shippings))
+
+    time.sleep(1)
+
+    confirmations = [{'entity_id': shipping_id, 'delivered': time.time()} if i % 2 else
+                     {'order_id': order_id, 'delivered': time.time()}
+                     for i, (shipping_id, order_id) in enumerate(zip(shipping_ids, order_ids))]
+
+    start = time.time()
+    results = []
+    for i in range(0, amount, chunk):
+        results += get_result(http_cmd_req('{}/shippings/delivered'.format(BASE_URL), confirmations[i:i + chunk]))
+    elapsed = time.time() - start
+
+    failed = len([result for result in results if 'error' in result])
+    logging.info("confirmed {} deliveries ({} failed) in {:.2f}s, {:.0f} confirmations/s".format(
+        amount - failed, failed, elapsed, amount / elapsed))
+
+
+def bench_reconciliation(amount=1000000, products=100000):
+    """
+    Measure the time of a billing reconciliation, in-process.
+
+    :param amount: The amount of billings, orders and carts.
+    :param products: The amount of products.
+    """
+    from billing_service.reconciliation import reconcile
+    from lib.product_catalogue import ProductCatalogue
+
+    prices = {str(uuid.uuid4()): random.randint(10, 1000) for _ in range(products)}
+    catalogue = ProductCatalogue()
+    for product_id, price in prices.items():
+        catalogue.apply('entity_created', {'entity_id': product_id, 'name': product_id, 'price': price})
+    product_ids = list(prices.keys())
+    carts = {str(uuid.uuid4()): dict(collections.Counter(random.choices(product_ids, k=random.randint(1, 10))))
+             for _ in range(amount)}
+    orders = {str(uuid.uuid4()): cart_id for cart_id in carts.keys()}
+    billings = [{
+        'entity_id': str(uuid.uuid4()),
+        'order_id': order_id,
+        'amount': sum([prices[product_id] * quantity for product_id, quantity in carts[cart_id].items()]) +
+        (1 if random.random() < 0.01 else 0)
+    } for order_id, cart_id in orders.items()]
+
+    start = time.time()
+    result = reconcile(catalogue, carts, orders, billings)
+    elapsed = time.time() - start
+
+    logging.info("reconciled {} billings ({} mismatches) in {:.2f}s, {:.0f} billings/s".format(
+        result['billings'], len(result['mismatches']), elapsed, amount / elapsed))
+
+
+def wait_for_order(_order_id, _status, _timeout=10):
+    """
+    Wait until an order has reached a status.
+
+    :param _order_id: The order ID.
+    :param _status: The status to wait for.
+    :param _timeout: The timeout in seconds.
+    :return: The order.
+    :raise Exception: In case of a timeout.
+    """
+    deadline = time.time() + _timeout
+    while time.time() < deadline:
+        order = get_result(request.urlopen('{}/order/{}'.format(BASE_URL, _order_id)))
+        if order and order['status'] == _status:
+            return order
+        time.sleep(0.005)
+
+    raise Exception('order {} did not reach status {}'.format(_order_id, _status))
+
+
+def bench_order_lifecycle(amount=10):
+    """
+    Measure the end-to-end latency of the order lifecycle, i.e. order -> billing -> shipping -> delivery.
+
+    :param amount: The amount of orders.
+    """
+    customer_ids = [result['result'] for result in
+                    get_result(http_cmd_req('{}/customer'.format(BASE_URL), create_customers(1)))]
+    products = create_products(10)
+    product_ids = [result['result'] for result in get_result(http_cmd_req('{}/product'.format(BASE_URL), products))]
+    get_result(http_cmd_req('{}/inventory'.format(BASE_URL), create_inventories(product_ids, amount * 10)))
+    prices = {product_id: product['price'] for product_id, product in zip(product_ids, products)}
+
+    time.sleep(1)
+
+    latencies = {'in_stock': [], 'shipped': [], 'delivered': [], 'total': []}
+    for cart in create_carts(amount, [{'entity_id': customer_ids[0]}], [{'entity_id': _id} for _id in product_ids]):
+        cart_id = get_result(http_cmd_req('{}/cart'.format(BASE_URL), cart))[0]
+
+        start = time.time()
+        order_id = get_result(http_cmd_req('{}/order'.format(BASE_URL), {'cart_id': cart_id}))[0]
+        wait_for_order(order_id, 'IN_STOCK')
+        in_stock = time.time()
+
+        total = sum([prices[product_id] * quantity for product_id, quantity in cart['items'].items()])
+        get_result(http_cmd_req('{}/billing'.format(BASE_URL), {'order_id': order_id, 'amount': total}))
+        wait_for_order(order_id, 'SHIPPED')
+        shipped = time.time()
+
+        shippings = get_result(request.urlopen('{}/shippings'.format(BASE_URL)))
+        shipping = [shipping for shipping in shippings if shipping['order_id'] == order_id][0]
+        shipping['delivered'] = time.time()
+        get_result(http_cmd_req('{}/shipping/{}'.format(BASE_URL, shipping['entity_id']), shipping, 'PUT'))
+        wait_for_order(order_id, 'DELIVERED')
+        delivered = time.time()
+
+        latencies['in_stock'].append(in_stock - start)
+        latencies['shipped'].append(shipped - in_stock)
+        latencies['delivered'].append(delivered - shipped)
+        latencies['total'].append(delivered - start)
+
+    for step, values in latencies.items():
+        logging.info("{}: avg {:.1f}ms, max {:.1f}ms".format(
+            step, 1000 * sum(values) / len(values), 1000 * max(values)))
+
+
+def bench_event_publisher(amount=10000, latency=0.001):
+    """
+    Measure the publish throughput of the event publisher, against the event store if it is reachable,
+    else against a stub with a fixed latency per publish.
+
+    :param amount: The amount of events.
+    :param latency: The latency of the stub in seconds.
+    """
+    from lib.event_publisher import EventPublisher
+
+    try:
+        from event_store.event_store_client import EventStoreClient, create_event
+        event_store = EventStoreClient()
+    except ImportError:
+        from tests.lib import EventStoreStub
+        event_store = EventStoreStub(_latency=latency)
+        logging.info("using event store stub with {:.1f}ms latency".format(1000 * latency))
+
+        def create_event(_action, _data):
+            return {'event_id': str(uuid.uuid4()), 'event_action': _action, 'event_data': _data}
+
+    events = [create_event('entity_created', {'entity_id': str(uuid.uuid4())}) for _ in range(amount)]
+
+    start = time.time()
+    for event in events:
+        event_store.publish('bench', event)
+    logging.info("published {} events one by one, {:.0f} events/s".format(amount, amount / (time.time() - start)))
+
+    publisher = EventPublisher(event_store)
+    for name, keys in [('in topic order', None), ('in entity order', [event['event_id'] for event in events])]:
+        start = time.time()
+        publisher.publish_all('bench', events, keys)
+        logging.info("published {} events {}, {:.0f} events/s".format(amount, name, amount / (time.time() - start)))
+
+    publisher.stop()
+
+
+def bench_entity_patch(amount=100000):
+    """
+    Measure the size of update events, full entities vs. patches of the changed props.
+
+    :param amount: The amount of updates per entity.
+    """
+    from lib.entity_patch import apply_patch, create_patch
+
+    updates = {
+        'order status': ({'cart_id': str(uuid.uuid4()), 'status': 'IN_STOCK'}, {'status': 'CLEARED'}),
+        'inventory amount': ({'product_id': str(uuid.uuid4()), 'amount': 100}, {'amount': 99}),
+        'product price': (create_products(1)[0], {'price': 999}),
+        'customer email': (create_customers(1)[0], {'email': 'patched@ordershop.local'}),
+        'cart customer': ({'customer_id': str(uuid.uuid4()), 'items': {str(uuid.uuid4()): 1 for _ in range(10)}},
+                          {'customer_id': str(uuid.uuid4())}),
+    }
+
+    for name, (entity, props) in updates.items():
+        entity['entity_id'] = str(uuid.uuid4())
+        full = len(json.dumps(apply_patch(entity, props)))
+
+        start = time.time()
+        for _ in range(amount):
+            patch = json.dumps(create_patch(entity, props))
+        elapsed = time.time() - start
+
+        logging.info("{}: {} bytes full, {} bytes patched ({:.0%} less), patch {:.2f}us".format(
+            name, full, len(patch), 1 - len(patch) / full, 1e6 * elapsed / amount))
+
+
+def bench_cart_items(lines=20000, products=5000):
+    """
+    Measure the cost of counting the products of a large cart against its inventories, in-process, for a list of
+    product IDs vs. a dict of items.
+
+    :param lines: The amount of products in the cart.
+    :param products: The amount of distinct products.
+    """
+    from lib.cart_items import get_items
+
+    product_ids = [str(uuid.uuid4()) for _ in range(products)]
+    cart = {'product_ids': random.choices(product_ids, k=lines)}
+    inventories = [{'product_id': product_id, 'amount': lines} for product_id in product_ids]
+
+    start = time.time()
+    [cart['product_ids'].count(inventory['product_id']) for inventory in inventories]
+    elapsed = time.time() - start
+    logging.info("counted {} lines of {} products as list in {:.3f}s".format(lines, products, elapsed))
+
+    start = time.time()
+    items = get_items(cart)
+    [items.get(inventory['product_id'], 0) for inventory in inventories]
+    elapsed = time.time() - start
+    logging.info("counted {} lines of {} products as items in {:.3f}s".format(lines, products, elapsed))
+
+
+def bench_service_calls(amount=100, calls=8, latency=0.01):
+    """
+    Measure the duration of reports issuing independent service calls, in-process with a fixed latency per call,
+    sequential vs. in parallel.
+
+    :param amount: The amount of reports.
+    :param calls: The amount of calls per report.
+    :param latency: The latency of a call in seconds.
+    """
+    from lib.service_calls import ServiceCalls, gather
+
+    def send_message(_service_name, _func_name, _params):
+        time.sleep(latency)
+        return {'result': []}
+
+    start = time.time()
+    for _ in range(amount):
+        [send_message('read-model', 'get_entities', {'name': 'order'}) for _ in range(calls)]
+    elapsed = time.time() - start
+    logging.info("{} reports with {} sequential calls in {:.2f}s, {:.1f}ms per report".format(
+        amount, calls, elapsed, 1000 * elapsed / amount))
+
+    service_calls = ServiceCalls(_send_message=send_message)
+    start = time.time()
+    for _ in range(amount):
+        gather([service_calls.call('read-model', 'get_entities', {'name': 'order'}) for _ in range(calls)])
+    elapsed = time.time() - start
+    service_calls.stop()
+    logging.info("{} reports with {} parallel calls in {:.2f}s, {:.1f}ms per report".format(
+        amount, calls, elapsed, 1000 * elapsed / amount))
+
+
+BENCHMARKS = {
+    'bulk_import': bench_bulk_import,
+    'mark_delivered': bench_mark_delivered,
+    'reconciliation': bench_reconciliation,
+    'order_lifecycle': bench_order_lifecycle,
+    'event_publisher': bench_event_publisher,
+    'crm_contacts': bench_crm_contacts,
+    'mail_outbox': bench_mail_outbox,
+    'product_catalogue': bench_product_catalogue,
+    'entity_patch': bench_entity_patch,
+    'cart_items': bench_cart_items,
+    'service_calls': bench_service_calls,
+}
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    for bench in sys.argv[1:] or BENCHMARKS.keys():
+        logging.info("running {} ...".format(bench))
+        BENCHMARKS[bench]()
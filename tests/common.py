@@ -1,3 +1,4 @@
+import collections
 import json
 import random
 import string
@@ -8,24 +9,26 @@ from urllib import request
 BASE_URL = 'http://localhost:5000'
 
 
-def http_cmd_req(_url, _data=None, _method='POST'):
+def http_cmd_req(_url, _data=None, _method='POST', _headers=None):
     """
     Do a HTTP request.
 
     :param _url: The URL of the request.
     :param _data: The JSON payload.
     :param _method: The HTTP method, defaults to POST.
+    :param _headers: A dict with optional additional headers.
     :return: The response.
     """
+    headers = dict(_headers or {})
     if _data:
         data = json.dumps(_data).encode('utf-8')
-        headers = {
+        headers.update({
             'Content-Type': 'application/json; charset=utf-8',
             'Content-Length': len(data)
-        }
+        })
         req = request.Request(_url, data=data, headers=headers, method=_method)
     else:
-        req = request.Request(_url, method=_method)
+        req = request.Request(_url, headers=headers, method=_method)
 
     return request.urlopen(req)
 
@@ -115,7 +118,7 @@ def create_carts(amount, customers, products):
     for _ in range(amount):
         orders.append({
             "customer_id": get_any_id(customers),
-            "product_ids": [get_any_id(products) for _ in range(random.randint(1, 10))],
+            "items": dict(collections.Counter([get_any_id(products) for _ in range(random.randint(1, 10))])),
         })
 
     return orders
@@ -0,0 +1,1004 @@
+import asyncio
+import json
+import os
+import queue
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+from types import SimpleNamespace
+
+from billing_service.reconciliation import reconcile
+from crm_service.contact_view import ContactView
+from lib import cart_items
+from lib.batcher import Batcher, collect
+from lib.bloom_filter import RotatingBloomFilter
+from lib.consumer_group import ConsumerGroup
+from lib.entity_patch import apply_patch, create_patch
+from lib.event_dispatcher import EventDispatcher
+from lib.event_publisher import EventPublisher
+from lib.event_replay import EventReplay
+from lib.idempotency_keys import IdempotencyKeys
+from lib.keyed_executor import KeyedExecutor
+from lib.product_catalogue import ProductCatalogue
+from lib.read_batch import ReadBatch, resolve_params
+from lib.service_calls import ServiceCalls, gather, gather_async
+from lib.ttl_cache import TTLCache
+from mail_service.outbox import DeliveryPool, Outbox, SmtpDelivery
+from read_model.mail_projection import MailProjection
+from read_model.time_index import TimeIndex
+from read_model.unique_index import UniqueIndex
+
+
+class EventStoreStub(object):
+    """
+    Event Store Stub class, records subscriptions and published events, and serves a given event history.
+    """
+
+    def __init__(self, _latency=0):
+        self.latency = _latency
+        self.subscriptions = {}
+        self.published = []
+        self.history = {}
+        self.lock = threading.Lock()
+
+    def get(self, _topic):
+        return [(i, vars(item)) for i, item in enumerate(self.history.get(_topic, []))]
+
+    def publish(self, _topic, _event):
+        time.sleep(self.latency)
+        if _event.get('fail'):
+            raise Exception('publish failed')
+        with self.lock:
+            self.published.append((_topic, _event))
+
+    def subscribe(self, _topic, _handler):
+        self.subscriptions.setdefault(_topic, []).append(_handler)
+
+    def unsubscribe(self, _topic, _handler):
+        self.subscriptions[_topic].remove(_handler)
+
+
+class SmtpServerStub(socketserver.ThreadingTCPServer):
+    """
+    SMTP Server Stub class, accepts mails on a local port and records them. The first mails can be rejected.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, _fail=0):
+        super().__init__(('127.0.0.1', 0), SmtpHandlerStub)
+        self.port = self.server_address[1]
+        self.fail = _fail
+        self.mails = []
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class SmtpHandlerStub(socketserver.StreamRequestHandler):
+    """
+    SMTP Handler Stub class, speaks just enough SMTP for smtplib.
+    """
+
+    def reply(self, _line):
+        self.wfile.write((_line + '\r\n').encode('utf-8'))
+
+    def handle(self):
+        self.reply('220 stub')
+        recipients = []
+        for line in self.rfile:
+            command = line.decode('utf-8').strip().upper()
+            if command.startswith('EHLO') or command.startswith('HELO'):
+                self.reply('250 stub')
+            elif command.startswith('MAIL'):
+                recipients = []
+                self.reply('250 OK')
+            elif command.startswith('RCPT'):
+                recipients.append(line.decode('utf-8').split(':', 1)[1].strip().strip('<>'))
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 go ahead')
+                data = b''.join(iter(self.rfile.readline, b'.\r\n'))
+                with self.server.lock:
+                    if self.server.fail:
+                        self.server.fail -= 1
+                        self.reply('451 try again')
+                        continue
+                    self.server.mails.append((recipients, data))
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                break
+            else:
+                self.reply('250 OK')
+
+
+def create_item(_action, _data):
+    """
+    Create an event as received from a subscription.
+
+    :param _action: The event action.
+    :param _data: A dict with the event data.
+    :return: The event.
+    """
+    return SimpleNamespace(event_id=str(uuid.uuid4()), event_ts=time.time(), event_action=_action,
+                           event_data=json.dumps(_data))
+
+
+def create_event(_action, _data):
+    """
+    Create an event as published.
+
+    :param _action: The event action.
+    :param _data: A dict with the event data.
+    :return: The event.
+    """
+    return {'event_action': _action, 'event_data': json.dumps(_data)}
+
+
+class TTLCacheTestCase(unittest.TestCase):
+    """
+    TTL Cache Test Case class.
+    """
+
+    def test_get(self):
+        cache = TTLCache()
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.setdefault('a', 1), 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_setdefault(self):
+        cache = TTLCache()
+        self.assertEqual(cache.setdefault('a', 1), 1)
+        self.assertEqual(cache.setdefault('a', 2), 1)
+
+    def test_max_size(self):
+        cache = TTLCache(_max_size=2)
+        [cache.setdefault(key, key) for key in ['a', 'b', 'c']]
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('c'), 'c')
+
+    def test_ttl(self):
+        cache = TTLCache(_ttl=0.01)
+        cache.setdefault('a', 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_pop(self):
+        cache = TTLCache()
+        cache.setdefault('a', 1)
+        self.assertIsNone(cache.pop('a', 2))
+        self.assertEqual(cache.pop('a', 1), 1)
+        self.assertIsNone(cache.get('a'))
+
+
+class IdempotencyKeysTestCase(unittest.TestCase):
+    """
+    Idempotency Keys Test Case class.
+    """
+
+    def test_reserve(self):
+        keys = IdempotencyKeys()
+        self.assertIsNone(keys.replay('a'))
+        self.assertIsNone(keys.reserve('a', '1'))
+        with self.assertLogs(level='INFO'):
+            self.assertEqual(keys.reserve('a', '2'), '1')
+            self.assertEqual(keys.replay('a'), '1')
+
+    def test_release(self):
+        keys = IdempotencyKeys()
+        keys.reserve('a', '1')
+        keys.release('a', '2')
+        self.assertEqual(keys.get('a'), '1')
+        keys.release('a', '1')
+        self.assertIsNone(keys.reserve('a', '2'))
+
+
+class RotatingBloomFilterTestCase(unittest.TestCase):
+    """
+    Rotating Bloom Filter Test Case class.
+    """
+
+    def test_add(self):
+        seen = RotatingBloomFilter()
+        self.assertTrue(seen.add('a'))
+        self.assertFalse(seen.add('a'))
+        self.assertIn('a', seen)
+        self.assertNotIn('b', seen)
+
+    def test_rotate(self):
+        seen = RotatingBloomFilter(_capacity=10)
+        self.assertTrue(all(seen.add(key) for key in range(20)))
+        self.assertIn(10, seen)
+        seen.add(20)
+        self.assertNotIn(0, seen)
+
+    def test_false_positive_rate(self):
+        seen = RotatingBloomFilter(_capacity=1000, _error_rate=0.01)
+        [seen.add(key) for key in range(1000)]
+        self.assertAlmostEqual(seen.false_positive_rate, 0.01, delta=0.002)
+        self.assertLess(sum(key in seen for key in range(1000, 11000)) / 10000, 0.02)
+        self.assertEqual(seen.memory, 2 * 1199)
+
+
+class EventDispatcherTestCase(unittest.TestCase):
+    """
+    Event Dispatcher Test Case class.
+    """
+
+    def test_subscribe_once(self):
+        event_store = EventStoreStub()
+        dispatcher = EventDispatcher(event_store)
+        dispatcher.register('order', lambda i, d: None, 'entity_created')
+        dispatcher.register('order', lambda i, d: None, 'entity_deleted')
+        dispatcher.start()
+        self.assertEqual(len(event_store.subscriptions['order']), 1)
+        dispatcher.stop()
+        self.assertEqual(len(event_store.subscriptions['order']), 0)
+
+    def test_dispatch(self):
+        event_store = EventStoreStub()
+        dispatcher = EventDispatcher(event_store)
+        handled = []
+        dispatcher.register('order', lambda i, d: handled.append(('created', d)), 'entity_created')
+        dispatcher.register('order', lambda i, d: handled.append(('any', d)))
+        dispatcher.start()
+
+        [handler] = event_store.subscriptions['order']
+        handler(create_item('entity_created', {'entity_id': 1}))
+        handler(create_item('entity_updated', {'entity_id': 2}))
+
+        self.assertEqual(handled, [('created', {'entity_id': 1}), ('any', {'entity_id': 1}), ('any', {'entity_id': 2})])
+        self.assertIs(handled[0][1], handled[1][1])
+
+    def test_failing_handler(self):
+        dispatcher = EventDispatcher(EventStoreStub())
+        handled = []
+        dispatcher.register('order', lambda i, d: 1 / 0)
+        dispatcher.register('order', lambda i, d: handled.append(d))
+
+        with self.assertLogs(level='ERROR'):
+            dispatcher.dispatch('order', create_item('entity_created', {'entity_id': 1}))
+        self.assertEqual(handled, [{'entity_id': 1}])
+
+    def test_group(self):
+        group = ConsumerGroup(EventStoreStub(), 'test', _create_event=create_event)
+        group.owned = set()
+        dispatcher = EventDispatcher(EventStoreStub(), group)
+        handled = []
+        dispatcher.register('order', lambda i, d: handled.append('grouped'))
+        dispatcher.register('order', lambda i, d: handled.append('broadcast'), _broadcast=True)
+
+        dispatcher.dispatch('order', create_item('entity_created', {'entity_id': 1}))
+        self.assertEqual(handled, ['broadcast'])
+
+    def test_key(self):
+        group = ConsumerGroup(EventStoreStub(), 'test', _create_event=create_event)
+        group.owned = {ConsumerGroup._hash('order-1') % group.partitions}
+        dispatcher = EventDispatcher(EventStoreStub(), group)
+        handled = []
+        dispatcher.register('billing', lambda i, d: handled.append('billing'))
+        dispatcher.register('billing', lambda i, d: handled.append('order'), _key=lambda d: d.get('order_id'))
+
+        dispatcher.dispatch('billing', create_item('entity_created', {'entity_id': 'billing-1', 'order_id': 'order-1'}))
+        self.assertEqual(handled, ['order'])
+
+    def test_filter(self):
+        dispatcher = EventDispatcher(EventStoreStub(), _filter=RotatingBloomFilter())
+        handled = []
+        dispatcher.register('order', lambda i, d: handled.append(d))
+
+        item = create_item('entity_created', {'entity_id': 1})
+        dispatcher.dispatch('order', item)
+        dispatcher.dispatch('order', item)
+        dispatcher.dispatch('cart', item)
+        self.assertEqual(handled, [{'entity_id': 1}])
+
+    def test_executor(self):
+        executor = KeyedExecutor('test', _report_interval=0)
+        dispatcher = EventDispatcher(EventStoreStub(), _executor=executor)
+        handled = []
+        dispatcher.register('order', lambda i, d: handled.append(threading.current_thread()))
+        dispatcher.register('order', lambda i, d: handled.append(threading.current_thread()), _broadcast=True)
+
+        dispatcher.dispatch('order', create_item('entity_created', {'entity_id': 1}))
+        executor.stop()
+        self.assertEqual(len(handled), 2)
+        self.assertIs(handled[0], threading.current_thread())
+        self.assertIsNot(handled[1], threading.current_thread())
+
+    def test_executor_failure(self):
+        executor = KeyedExecutor('test', _report_interval=0)
+        dispatcher = EventDispatcher(EventStoreStub(), _executor=executor)
+        handled = []
+        dispatcher.register('order', lambda i, d: 1 / 0)
+        dispatcher.register('order', lambda i, d: handled.append(d))
+
+        with self.assertLogs(level='ERROR'):
+            dispatcher.dispatch('order', create_item('entity_created', {'entity_id': 1}))
+            executor.stop()
+        self.assertEqual(handled, [{'entity_id': 1}])
+        self.assertEqual(executor.metrics()['failed'], 1)
+
+
+class EventReplayTestCase(unittest.TestCase):
+    """
+    Event Replay Test Case class.
+    """
+
+    def setUp(self):
+        self.event_store = EventStoreStub()
+        self.carts = {}
+        self.replay = EventReplay(self.apply, threading.Lock(), ['cart'])
+
+    def apply(self, _topic, _action, _cart):
+        if _action == 'entity_created':
+            self.carts[_cart['entity_id']] = cart_items.get_items(_cart)
+        else:
+            self.carts[_cart['entity_id']] = cart_items.apply_item(self.carts[_cart['entity_id']], _action, _cart)
+
+    def receive(self, _item):
+        self.replay.receive('cart', _item, json.loads(_item.event_data))
+
+    def test_replay(self):
+        created = create_item('entity_created', {'entity_id': '1', 'items': {'a': 1}})
+        added = create_item('item_added', cart_items.create_item('1', 'a', 1))
+        self.event_store.history['cart'] = [created, added]
+
+        # events received before the replay are buffered, the ones in the history are skipped
+        self.receive(added)
+        self.receive(create_item('item_added', cart_items.create_item('1', 'a', 2)))
+        self.assertEqual(self.carts, {})
+
+        self.replay.replay(self.event_store, 'cart')
+        self.assertEqual(self.carts, {'1': {'a': 4}})
+
+        self.receive(create_item('item_removed', cart_items.create_item('1', 'a', 1)))
+        self.assertEqual(self.carts, {'1': {'a': 3}})
+
+
+class KeyedExecutorTestCase(unittest.TestCase):
+    """
+    Keyed Executor Test Case class.
+    """
+
+    def test_key_order(self):
+        executor = KeyedExecutor('test', _workers=4, _report_interval=0)
+        handled = {}
+        for n in range(100):
+            executor.submit(n % 10, lambda k, n: handled.setdefault(k, []).append(n), n % 10, n)
+        executor.stop()
+        self.assertEqual(handled, {k: list(range(k, 100, 10)) for k in range(10)})
+
+    def test_backpressure(self):
+        executor = KeyedExecutor('test', _workers=1, _max_queue=1, _report_interval=0)
+        release = threading.Event()
+        executor.submit('a', release.wait)
+        executor.submit('a', release.wait)
+
+        submitted = threading.Event()
+        threading.Thread(target=lambda: (executor.submit('a', release.wait), submitted.set())).start()
+        self.assertFalse(submitted.wait(0.05))
+        release.set()
+        self.assertTrue(submitted.wait(1))
+        executor.stop()
+
+    def test_metrics(self):
+        executor = KeyedExecutor('test', _report_interval=0)
+        with self.assertLogs(level='ERROR'):
+            executor.submit('a', time.sleep, 0.01)
+            executor.submit('a', lambda: 1 / 0)
+            executor.stop()
+
+        metrics = executor.metrics(True)
+        self.assertEqual((metrics['queued'], metrics['completed'], metrics['failed']), (0, 2, 1))
+        self.assertGreaterEqual(metrics['latency_max'], 0.01)
+        self.assertEqual(executor.metrics()['completed'], 0)
+
+
+class ConsumerGroupTestCase(unittest.TestCase):
+    """
+    Consumer Group Test Case class.
+    """
+
+    def test_partitions(self):
+        event_store = EventStoreStub()
+        groups = [ConsumerGroup(event_store, 'test', _interval=0.01, _create_event=create_event) for _ in range(3)]
+        self.assertTrue(all(not group.owned for group in groups))
+        [group.start() for group in groups]
+        self.assertEqual([event['event_action'] for _, event in event_store.published[:2]],
+                         ['member_joined', 'member_alive'])
+
+        # every member knows every alive member, each partition is owned by exactly one of them
+        for topic, event in list(event_store.published):
+            item = create_item(event['event_action'], json.loads(event['event_data']))
+            [group.member_changed(item) for group in groups]
+        self.assertTrue(all(len(group.members) == 3 for group in groups))
+        self.assertEqual(sorted(p for group in groups for p in group.owned), list(range(64)))
+        self.assertTrue(all(sum(group.owns(key) for group in groups) == 1 for key in range(100)))
+
+        # partitions of a leaving member are taken over by the others
+        groups[0].stop()
+        item = create_item('member_left', {'member_id': groups[0].member_id})
+        [group.member_changed(item) for group in groups[1:]]
+        self.assertEqual(sorted(p for group in groups[1:] for p in group.owned), list(range(64)))
+        [group.stop() for group in groups[1:]]
+
+    def test_join(self):
+        event_store = EventStoreStub()
+        group = ConsumerGroup(event_store, 'test', _interval=0.01, _create_event=create_event)
+        group.start()
+
+        # a joining member is answered, but it takes partitions once it is alive
+        group.member_changed(create_item('member_joined', {'member_id': 'other'}))
+        self.assertEqual(event_store.published[-1][1]['event_action'], 'member_alive')
+        self.assertEqual(len(group.owned), 64)
+        group.member_changed(create_item('member_alive', {'member_id': 'other'}))
+        self.assertLess(len(group.owned), 64)
+        group.stop()
+
+    def test_timeout(self):
+        group = ConsumerGroup(EventStoreStub(), 'test', _interval=0.01, _timeout=0.02, _create_event=create_event)
+        group.start()
+        group.member_changed(create_item('member_alive', {'member_id': 'other'}))
+        self.assertLess(len(group.owned), 64)
+        time.sleep(0.1)
+        self.assertEqual(len(group.members), 1)
+        self.assertEqual(len(group.owned), 64)
+        group.stop()
+
+
+class CartItemsTestCase(unittest.TestCase):
+    """
+    Cart Items Test Case class.
+    """
+
+    def test_get(self):
+        self.assertEqual(cart_items.get_items({'items': {'a': '2', 'b': 1}}), {'a': 2, 'b': 1})
+        self.assertEqual(cart_items.get_items({'product_ids': ['a', 'b', 'a']}), {'a': 2, 'b': 1})
+        self.assertEqual(cart_items.get_items({}), {})
+
+    def test_apply(self):
+        items = {'a': 2}
+        items = cart_items.apply_item(items, 'item_added', cart_items.create_item('1', 'b', 3))
+        self.assertEqual(items, {'a': 2, 'b': 3})
+        self.assertEqual(cart_items.apply_item(items, 'item_added', cart_items.create_item('1', 'b', 1)),
+                         {'a': 2, 'b': 4})
+        self.assertEqual(cart_items.apply_item(items, 'item_removed', cart_items.create_item('1', 'b', 1)),
+                         {'a': 2, 'b': 2})
+        self.assertEqual(cart_items.apply_item(items, 'item_removed', cart_items.create_item('1', 'a', 5)), {'b': 3})
+        self.assertEqual(cart_items.apply_item(items, 'item_removed', cart_items.create_item('1', 'b')), {'a': 2})
+        self.assertEqual(items, {'a': 2, 'b': 3})
+
+    def test_concurrent_adds(self):
+        events = [cart_items.create_item('1', 'a', 1) for _ in range(2)]
+        items = {'a': 1}
+        for event in events:
+            items = cart_items.apply_item(items, 'item_added', event)
+        self.assertEqual(items, {'a': 3})
+
+
+class EntityPatchTestCase(unittest.TestCase):
+    """
+    Entity Patch Test Case class.
+    """
+
+    def test_create(self):
+        order = {'entity_id': '1', 'cart_id': '2', 'status': 'CREATED'}
+        self.assertEqual(create_patch(order, {'cart_id': '2', 'status': 'IN_STOCK'}),
+                         {'entity_id': '1', 'status': 'IN_STOCK'})
+        self.assertIsNone(create_patch(order, {'entity_id': '3', 'status': 'CREATED'}))
+
+    def test_apply(self):
+        order = {'entity_id': '1', 'cart_id': '2', 'status': 'CREATED'}
+        patched = apply_patch(order, {'entity_id': '1', 'status': 'IN_STOCK'})
+        self.assertEqual(patched, {'entity_id': '1', 'cart_id': '2', 'status': 'IN_STOCK'})
+        self.assertEqual(order['status'], 'CREATED')
+
+
+class EventPublisherTestCase(unittest.TestCase):
+    """
+    Event Publisher Test Case class.
+    """
+
+    def test_publish(self):
+        event_store = EventStoreStub()
+        publisher = EventPublisher(event_store)
+        self.assertTrue(publisher.publish('order', {'n': 1}).result(timeout=1))
+        publisher.stop()
+        self.assertEqual(event_store.published, [('order', {'n': 1})])
+
+    def test_publish_stopped(self):
+        publisher = EventPublisher(EventStoreStub(), _max_delay=1)
+        future = publisher.publish('order', {'n': 1})
+        publisher.stop()
+        self.assertTrue(future.result(timeout=0))
+        self.assertRaises(RuntimeError, publisher.publish, 'order', {'n': 2})
+
+    def test_topic_order(self):
+        event_store = EventStoreStub(_latency=0.001)
+        publisher = EventPublisher(event_store, _max_batch=10)
+        futures = [publisher.publish(topic, {'n': n}) for n in range(50) for topic in ['order', 'cart']]
+        [future.result(timeout=5) for future in futures]
+        publisher.stop()
+        for topic in ['order', 'cart']:
+            self.assertEqual([event['n'] for t, event in event_store.published if t == topic], list(range(50)))
+
+    def test_failure(self):
+        event_store = EventStoreStub()
+        publisher = EventPublisher(event_store, _max_delay=0.05)
+        with self.assertLogs(level='ERROR'):
+            futures = [publisher.publish('order', event) for event in [{'n': 1}, {'fail': True}, {'n': 2}]]
+            with self.assertRaises(Exception):
+                futures[1].result(timeout=1)
+        publisher.stop()
+        self.assertTrue(futures[0].result())
+        self.assertRaises(Exception, futures[2].result)
+        self.assertEqual(event_store.published, [('order', {'n': 1})])
+
+
+class BatcherTestCase(unittest.TestCase):
+    """
+    Batcher Test Case class.
+    """
+
+    def test_collect(self):
+        q = queue.Queue()
+        [q.put(n) for n in range(5)]
+        self.assertEqual(collect(q, 3, 0), ([0, 1, 2], False))
+        self.assertEqual(collect(q, 3, 0), ([3, 4], False))
+        q.put(5)
+        q.put(None)
+        self.assertEqual(collect(q, 3, 1), ([5], True))
+        q.put(None)
+        self.assertEqual(collect(q, 3, 1), ([], True))
+
+    def test_max_batch(self):
+        batches = []
+        batcher = Batcher(batches.append, _max_batch=10, _max_delay=1)
+        [batcher.add(n) for n in range(25)]
+        batcher.stop()
+        self.assertEqual(batches, [list(range(0, 10)), list(range(10, 20)), list(range(20, 25))])
+
+    def test_max_delay(self):
+        batches = []
+        batcher = Batcher(batches.append, _max_delay=0.01)
+        batcher.add(1)
+        time.sleep(0.05)
+        batcher.add(2)
+        batcher.stop()
+        self.assertEqual(batches, [[1], [2]])
+
+    def test_failure(self):
+        batches = []
+        batcher = Batcher(lambda b: batches.append(b) if b != [1] else 1 / 0, _max_delay=0.01)
+        with self.assertLogs(level='ERROR'):
+            batcher.add(1)
+            time.sleep(0.05)
+        batcher.add(2)
+        batcher.stop()
+        self.assertEqual(batches, [[2]])
+
+
+class ProductCatalogueTestCase(unittest.TestCase):
+    """
+    Product Catalogue Test Case class.
+    """
+
+    def setUp(self):
+        self.catalogue = ProductCatalogue(_capacity=2)
+        for n in range(5):
+            self.catalogue.apply('entity_created', {'entity_id': str(n), 'name': 'p{}'.format(n), 'price': str(n * 10)})
+
+    def test_apply(self):
+        self.assertEqual(len(self.catalogue), 5)
+        self.catalogue.apply('entity_updated', {'entity_id': '1', 'name': 'q', 'price': 15})
+        self.assertEqual(self.catalogue.get('1'), {'entity_id': '1', 'name': 'q', 'price': 15})
+        self.catalogue.apply('entity_deleted', {'entity_id': '2'})
+        self.assertIsNone(self.catalogue.get('2'))
+        self.catalogue.apply('entity_created', {'entity_id': '5', 'name': 'p5', 'price': 50})
+        self.assertEqual(self.catalogue.rows['5'], 2)
+        self.assertEqual(len(self.catalogue), 5)
+
+    def test_patch(self):
+        self.catalogue.apply('entity_patched', {'entity_id': '1', 'price': 15})
+        self.assertEqual(self.catalogue.get('1'), {'entity_id': '1', 'name': 'p1', 'price': 15})
+        self.catalogue.apply('entity_patched', {'entity_id': 'x', 'price': 15})
+        self.assertNotIn('x', self.catalogue)
+
+    def test_totals(self):
+        totals, complete = self.catalogue.totals([{'1': 1, '2': 1}, {}, {'4': 2}, {'1': 1, 'x': 1}])
+        self.assertEqual(list(totals[:3]), [30, 0, 80])
+        self.assertEqual(list(complete), [True, True, True, False])
+        self.assertEqual(self.catalogue.total({'1': 1, '2': 3}), 70)
+        self.assertEqual(self.catalogue.total({}), 0)
+        self.assertIsNone(self.catalogue.total({'1': 1, 'x': 1}))
+        self.assertGreater(self.catalogue.memory, 0)
+
+
+class ContactViewTestCase(unittest.TestCase):
+    """
+    Contact View Test Case class.
+    """
+
+    def setUp(self):
+        self.view = ContactView()
+        self.events = {
+            'customer': [create_item('entity_created', {'entity_id': 'u', 'name': 'Jane', 'email': 'jane@a.b'})],
+            'product': [create_item('entity_created', {'entity_id': str(n), 'name': 'p{}'.format(n), 'price': n * 10})
+                        for n in range(3)],
+            'cart': [create_item('entity_created', {'entity_id': 'c', 'customer_id': 'u', 'items': {'1': 1}})],
+            'order': [create_item('entity_created', {'entity_id': 'o', 'cart_id': 'c', 'status': 'CREATED'})]
+        }
+
+    def load(self):
+        event_store = EventStoreStub()
+        event_store.history = self.events
+        for name in ContactView.NAMES:
+            self.view.load(event_store, name)
+
+    def test_apply(self):
+        for name, items in self.events.items():
+            [self.view.apply(name, item.event_action, json.loads(item.event_data)) for item in items]
+        self.assertEqual(self.view.get_order_contact('o'), {'name': 'Jane', 'email': 'jane@a.b', 'total': 10})
+        self.assertIsNone(self.view.get_order_contact('x'))
+
+        self.view.apply('product', 'entity_updated', {'entity_id': '1', 'name': 'p1', 'price': 15})
+        self.assertEqual(self.view.get_cart_contact('c')['total'], 15)
+
+        self.view.apply('customer', 'entity_deleted', {'entity_id': 'u'})
+        self.assertIsNone(self.view.get_order_contact('o'))
+
+    def test_patch(self):
+        self.load()
+        self.view.apply('customer', 'entity_patched', {'entity_id': 'u', 'email': 'jane@b.c'})
+        self.view.apply('cart', 'entity_patched', {'entity_id': 'c', 'items': {'2': 2}})
+        self.view.apply('order', 'entity_patched', {'entity_id': 'o', 'status': 'IN_STOCK'})
+        self.assertEqual(self.view.get_order_contact('o'), {'name': 'Jane', 'email': 'jane@b.c', 'total': 40})
+
+        # patches of unknown entities are ignored
+        self.view.apply('cart', 'entity_patched', {'entity_id': 'x', 'customer_id': 'u'})
+        self.assertNotIn('x', self.view.carts)
+
+    def test_items(self):
+        self.load()
+        self.view.apply('cart', 'item_added', cart_items.create_item('c', '2', 2))
+        self.view.apply('cart', 'item_removed', cart_items.create_item('c', '1'))
+        self.assertEqual(self.view.carts['c'], ('u', {'2': 2}))
+        self.assertEqual(self.view.get_order_contact('o')['total'], 40)
+
+        self.view.apply('cart', 'item_added', cart_items.create_item('c', 'x', 1))
+        self.assertIsNone(self.view.get_order_contact('o')['total'])
+
+    def test_load(self):
+        self.events['cart'].append(create_item('item_added', cart_items.create_item('c', '1', 1)))
+        self.events['order'].append(create_item('entity_deleted', {'entity_id': 'o'}))
+        self.load()
+        self.assertEqual(self.view.carts['c'], ('u', {'1': 2}))
+        self.assertEqual(self.view.get_cart_contact('c'), {'name': 'Jane', 'email': 'jane@a.b', 'total': 20})
+        self.assertIsNone(self.view.get_order_contact('o'))
+
+    def test_replay(self):
+        added = create_item('item_added', cart_items.create_item('c', '1', 1))
+        self.events['cart'].append(added)
+
+        # events received before the load are applied after it, unless they are in the history
+        for item in [added, create_item('item_added', cart_items.create_item('c', '2', 1))]:
+            self.view.receive('cart', item, json.loads(item.event_data))
+        self.assertEqual(self.view.carts, {})
+
+        self.load()
+        self.assertEqual(self.view.carts['c'], ('u', {'1': 2, '2': 1}))
+
+        item = create_item('item_removed', cart_items.create_item('c', '2', 1))
+        self.view.receive('cart', item, json.loads(item.event_data))
+        self.assertEqual(self.view.carts['c'], ('u', {'1': 2}))
+
+
+class ReconciliationTestCase(unittest.TestCase):
+    """
+    Reconciliation Test Case class.
+    """
+
+    def setUp(self):
+        self.catalogue = ProductCatalogue()
+        for n in range(3):
+            self.catalogue.apply('entity_created', {'entity_id': str(n), 'name': 'p{}'.format(n), 'price': n * 10})
+        self.carts = {'a': {'1': 2}, 'b': {'1': 1, '2': 1}, 'c': {'1': 1, 'x': 1}}
+        self.orders = {'o1': 'a', 'o2': 'b', 'o3': 'c', 'o4': 'd'}
+
+    def test_reconcile(self):
+        billings = [
+            {'entity_id': 'b1', 'order_id': 'o1', 'amount': 20},
+            {'entity_id': 'b2', 'order_id': 'o2', 'amount': '25'},
+            {'entity_id': 'b3', 'order_id': 'o3', 'amount': 10},
+            {'entity_id': 'b4', 'order_id': 'o4', 'amount': 10},
+            {'entity_id': 'b5', 'order_id': 'o5', 'amount': 0}
+        ]
+        result = reconcile(self.catalogue, self.carts, self.orders, billings)
+        self.assertEqual(result['billings'], 5)
+        self.assertEqual(result['mismatches'], [{'billing_id': 'b2', 'order_id': 'o2', 'amount': 25, 'expected': 30}])
+
+        # unknown products, carts and orders are resolved to the sentinel, they never mismatch
+        self.assertEqual(result['unresolved'], ['b3', 'b4', 'b5'])
+
+    def test_sentinel(self):
+        # the last cart must not be taken for the sentinel
+        billings = [{'entity_id': 'b1', 'order_id': 'o2', 'amount': 30},
+                    {'entity_id': 'b2', 'order_id': 'o5', 'amount': 30}]
+        result = reconcile(self.catalogue, {'a': {'1': 2}, 'b': {'1': 1, '2': 1}}, self.orders, billings)
+        self.assertEqual((result['mismatches'], result['unresolved']), ([], ['b2']))
+
+    def test_empty(self):
+        self.assertEqual(reconcile(self.catalogue, {}, {}, []), {'billings': 0, 'mismatches': [], 'unresolved': []})
+        result = reconcile(self.catalogue, {}, self.orders, [{'entity_id': 'b1', 'order_id': 'o1', 'amount': 20}])
+        self.assertEqual((result['mismatches'], result['unresolved']), ([], ['b1']))
+
+
+class OutboxTestCase(unittest.TestCase):
+    """
+    Outbox Test Case class.
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_ack(self):
+        outbox = Outbox(self.path, _segment_size=2)
+        [outbox.append({'n': n}) for n in range(5)]
+        self.assertEqual(outbox.depth, 5)
+        self.assertEqual(len(os.listdir(self.path)), 3)
+
+        for _ in range(4):
+            record_id, mail = outbox.get(0)
+            outbox.ack(record_id)
+        self.assertEqual(outbox.depth, 1)
+        self.assertEqual(sorted(os.listdir(self.path)), ['0000000003.log'])
+        outbox.close()
+
+    def test_recover(self):
+        outbox = Outbox(self.path, _segment_size=2)
+        [outbox.append({'n': n}) for n in range(3)]
+        outbox.ack(outbox.get(0)[0])
+        outbox.close()
+
+        # an incomplete mail, e.g. after a crash
+        with open(os.path.join(self.path, '0000000002.log'), 'a') as f:
+            f.write('{"n":')
+
+        with self.assertLogs(level='WARNING'):
+            outbox = Outbox(self.path, _segment_size=2)
+        self.assertEqual([outbox.get(0)[1]['n'] for _ in range(outbox.depth)], [1, 2])
+        outbox.close()
+
+    def test_delivery(self):
+        server = SmtpServerStub(_fail=1)
+        outbox = Outbox(self.path)
+        delivery = DeliveryPool(outbox, SmtpDelivery('127.0.0.1', server.port), _workers=2, _backoff=0.01)
+        delivery.start()
+        with self.assertLogs(level='WARNING'):
+            [outbox.append({'to': 'a{}@b.c'.format(n), 'msg': 'hello', 'ts': time.time()}) for n in range(10)]
+            deadline = time.time() + 5
+            while outbox.depth and time.time() < deadline:
+                time.sleep(0.01)
+        delivery.stop()
+        delivery.deliver.close()
+        outbox.close()
+        server.stop()
+
+        metrics = delivery.metrics()
+        self.assertEqual((metrics['depth'], metrics['delivered'], metrics['retried']), (0, 10, 1))
+        self.assertEqual(sorted(recipients[0] for recipients, data in server.mails),
+                         sorted('a{}@b.c'.format(n) for n in range(10)))
+
+    def test_give_up(self):
+        outbox = Outbox(self.path)
+        delivery = DeliveryPool(outbox, lambda m: 1 / 0, _workers=1, _max_attempts=2, _backoff=0.01)
+        delivery.start()
+        with self.assertLogs(level='ERROR'):
+            outbox.append({'to': 'a@b.c', 'msg': 'hello', 'ts': time.time()})
+            deadline = time.time() + 5
+            while outbox.depth and time.time() < deadline:
+                time.sleep(0.01)
+        delivery.stop()
+        outbox.close()
+        self.assertEqual((delivery.metrics()['failed'], delivery.metrics()['retried']), (1, 1))
+
+
+class MailProjectionTestCase(unittest.TestCase):
+    """
+    Mail Projection Test Case class.
+    """
+
+    def setUp(self):
+        self.mails = MailProjection()
+        for n in range(10):
+            self.mails.add(str(n), 100 + n, {'recipient': 'a@b.c' if n % 2 else 'b@c.d', 'message': str(n)})
+
+    def test_add(self):
+        self.mails.add('0', 100, {'recipient': 'b@c.d', 'message': '0'})
+        self.assertEqual(len(self.mails), 10)
+
+    def test_pages(self):
+        mails, cursor = self.mails.query(_limit=4)
+        self.assertEqual([mail['message'] for mail in mails], ['0', '1', '2', '3'])
+        mails, cursor = self.mails.query(_limit=4, _cursor=cursor)
+        self.assertEqual([mail['message'] for mail in mails], ['4', '5', '6', '7'])
+        mails, cursor = self.mails.query(_limit=4, _cursor=cursor)
+        self.assertEqual([mail['message'] for mail in mails], ['8', '9'])
+        self.assertIsNone(cursor)
+        self.assertRaises(ValueError, self.mails.query, _limit=0)
+        self.assertRaises(ValueError, self.mails.query, _limit=-1)
+
+    def test_filter(self):
+        mails, cursor = self.mails.query(_to='a@b.c', _since=104, _limit=2)
+        self.assertEqual([mail['message'] for mail in mails], ['5', '7'])
+        mails, cursor = self.mails.query(_to='a@b.c', _since=104, _limit=2, _cursor=cursor)
+        self.assertEqual([mail['message'] for mail in mails], ['9'])
+        self.assertEqual(self.mails.query(_to='x@y.z'), ([], None))
+
+    def test_unordered_ts(self):
+        self.mails.add('10', 50, {'recipient': 'a@b.c', 'message': '10'})
+        self.mails.add('11', 200, {'recipient': 'a@b.c', 'message': '11'})
+        mails, cursor = self.mails.query(_since=109)
+        self.assertEqual([mail['message'] for mail in mails], ['9', '11'])
+
+
+class TimeIndexTestCase(unittest.TestCase):
+    """
+    Time Index Test Case class.
+    """
+
+    def test_range(self):
+        index = TimeIndex()
+        [index.set(str(n), 100 + n) for n in range(10)]
+        self.assertEqual(index.range(), [str(n) for n in range(10)])
+        self.assertEqual(index.range(103, 106), ['3', '4', '5'])
+        self.assertEqual(index.range(_from=108), ['8', '9'])
+        self.assertEqual(index.range(_to=101.5), ['0', '1'])
+
+    def test_update(self):
+        index = TimeIndex()
+        index.set('a', 2)
+        index.set('b', 1)
+        index.set('a', 0)
+        self.assertEqual(index.range(), ['a', 'b'])
+        index.remove('a')
+        index.remove('c')
+        self.assertEqual(index.range(), ['b'])
+        self.assertNotIn('a', index)
+        self.assertEqual(len(index), 1)
+
+    def test_invalid(self):
+        index = TimeIndex()
+        index.set('a', '1.5')
+        with self.assertLogs(level='WARNING'):
+            index.set('b', 'tomorrow')
+            self.assertEqual(index.range(), ['a'])
+            index.set('a', None)
+            self.assertEqual(index.range(), [])
+
+
+class UniqueIndexTestCase(unittest.TestCase):
+    """
+    Unique Index Test Case class.
+    """
+
+    def test_get(self):
+        index = UniqueIndex()
+        index.set('a', 'A@b.c')
+        index.set('b', 'b@c.d')
+        self.assertEqual(index.get(' a@B.c '), 'a')
+        self.assertIsNone(index.get('x@y.z'))
+        self.assertIn('B@C.D', index)
+        self.assertEqual(len(index), 2)
+
+    def test_update(self):
+        index = UniqueIndex()
+        index.set('a', 'a@b.c')
+        index.set('a', 'x@y.z')
+        self.assertIsNone(index.get('a@b.c'))
+        self.assertEqual(index.get('x@y.z'), 'a')
+        index.set('b', 'x@y.z')
+        index.remove('a')
+        self.assertEqual(index.get('x@y.z'), 'b')
+        index.set('b', None)
+        self.assertEqual(len(index), 0)
+
+
+class ReadBatchTestCase(unittest.TestCase):
+    """
+    Read Batch Test Case class.
+    """
+
+    def test_send(self):
+        requests = []
+        batch = ReadBatch(lambda service, func, req: requests.append((service, func, req)) or {
+            'result': [{'result': {'entity_id': '1'}}, {'result': None}]
+        })
+        order = batch.get_entity('order', '1')
+        batch.get_entity('cart', ReadBatch.ref(order, 'cart_id'))
+        self.assertEqual(batch.send(), [{'entity_id': '1'}, None])
+        self.assertEqual(requests, [('read-model', 'batch', [
+            {'func': 'get_entity', 'params': {'name': 'order', 'id': '1'}},
+            {'func': 'get_entity', 'params': {'name': 'cart', 'id': {'ref': 0, 'prop': 'cart_id'}}}
+        ])])
+
+    def test_send_error(self):
+        batch = ReadBatch(lambda service, func, req: {'result': [{'error': 'more than 1 result found'}]})
+        batch.get_entities('order', _props={'status': 'CREATED'})
+        self.assertRaises(Exception, batch.send)
+
+    def test_resolve(self):
+        results = [{'result': {'cart_id': '2', 'items': {'a': 1, 'b': 2}}}, {'result': None}]
+        self.assertEqual(resolve_params({'name': 'cart', 'id': ReadBatch.ref(0, 'cart_id')}, results),
+                         {'name': 'cart', 'id': '2'})
+        self.assertEqual(resolve_params({'ids': ReadBatch.ref(0, 'items')}, results), {'ids': ['a', 'b']})
+        self.assertIsNone(resolve_params({'id': ReadBatch.ref(1, 'cart_id')}, results))
+        self.assertIsNone(resolve_params({'id': ReadBatch.ref(0, 'customer_id')}, results))
+        self.assertRaises(ValueError, resolve_params, {'id': ReadBatch.ref(2, 'cart_id')}, results)
+
+        results.append({'result': [{'entity_id': '1'}]})
+        self.assertRaises(ValueError, resolve_params, {'id': ReadBatch.ref(2, 'entity_id')}, results)
+        self.assertRaises(ValueError, resolve_params, {'ids': ReadBatch.ref(2, 'items')}, results)
+
+
+class ServiceCallsTestCase(unittest.TestCase):
+    """
+    Service Calls Test Case class.
+    """
+
+    @staticmethod
+    def send_message(_service_name, _func_name, _params):
+        time.sleep(_params.get('latency', 0.1))
+
+        return {'result': _params['n']}
+
+    def setUp(self):
+        self.calls = ServiceCalls(_send_message=ServiceCallsTestCase.send_message)
+
+    def tearDown(self):
+        self.calls.stop()
+
+    def test_gather(self):
+        start = time.time()
+        rsps = gather([self.calls.call('read-model', 'get_entity', {'n': n}) for n in range(8)], 5)
+        self.assertEqual([rsp['result'] for rsp in rsps], list(range(8)))
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_timeout(self):
+        futures = [self.calls.call('read-model', 'get_entity', {'n': 0, 'latency': 0.5})]
+        self.assertRaises(TimeoutError, gather, futures, 0.1)
+
+    def test_return_exceptions(self):
+        futures = [self.calls.call('read-model', 'get_entity', {'n': 0, 'latency': 0.5}),
+                   self.calls.call('read-model', 'get_entity', {'n': 1, 'latency': 0}),
+                   self.calls.call('read-model', 'get_entity', {})]
+        rsps = gather(futures, 0.1, True)
+        self.assertIsInstance(rsps[0], TimeoutError)
+        self.assertEqual(rsps[1], {'result': 1})
+        self.assertIsInstance(rsps[2], KeyError)
+
+    def test_gather_async(self):
+        async def query():
+            futures = [self.calls.call_async('read-model', 'get_entity', {'n': n}) for n in range(8)]
+            return await gather_async(futures, 5)
+
+        start = time.time()
+        rsps = asyncio.run(query())
+        self.assertEqual([rsp['result'] for rsp in rsps], list(range(8)))
+        self.assertLess(time.time() - start, 0.5)
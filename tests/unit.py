@@ -1,5 +1,6 @@
 import time
 import unittest
+import uuid
 from urllib import request
 
 from tests.common import BASE_URL, create_carts, create_customers, create_inventories, create_orders, create_products, \
@@ -72,7 +73,8 @@ class OrderShopTestCase(unittest.TestCase):
         products = get_result(rsp)
 
         # update second cart
-        carts[1]['product_ids'][0] = get_any_id(products, carts[1]['product_ids'][0])
+        product_id = get_any_id(products, next(iter(carts[1]['items'])))
+        carts[1]['items'] = {product_id: 1}
         rsp = http_cmd_req('{}/cart/{}'.format(BASE_URL, carts[1]['entity_id']), carts[1], 'PUT')
         updated = get_result(rsp)
 
@@ -82,8 +84,8 @@ class OrderShopTestCase(unittest.TestCase):
         # double check result
         rsp = request.urlopen('{}/cart/{}'.format(BASE_URL, carts[1]['entity_id']))
         cart = get_result(rsp)
-        self.assertIsNotNone(cart['product_ids'][0])
-        self.assertEqual(carts[1]['product_ids'][0], cart['product_ids'][0])
+        self.assertIsNotNone(cart['items'])
+        self.assertEqual(list(cart['items'].keys()), [product_id])
 
     def test_c_create_orders(self):
 
@@ -130,19 +132,29 @@ class OrderShopTestCase(unittest.TestCase):
         cart = get_result(rsp)
 
         # get products of cart
-        rsps = [request.urlopen('{}/product/{}'.format(BASE_URL, product_id)) for product_id in cart['product_ids']]
+        rsps = [request.urlopen('{}/product/{}'.format(BASE_URL, product_id)) for product_id in cart['items']]
         products = [get_result(rsp) for rsp in rsps]
 
         # calculate total amount
-        amount = sum([int(product['price']) for product in products])
+        amount = sum([int(product['price']) * int(quantity)
+                      for product, quantity in zip(products, cart['items'].values())])
 
         # perform billing
-        rsp = http_cmd_req('{}/billing'.format(BASE_URL), {'order_id': orders[0]['entity_id'], 'amount': amount})
+        billing = {'order_id': orders[0]['entity_id'], 'amount': amount}
+        headers = {'Idempotency-Key': str(uuid.uuid4())}
+        rsp = http_cmd_req('{}/billing'.format(BASE_URL), billing, _headers=headers)
         billing_id = get_result(rsp)
 
         # check result
         self.assertIsNotNone(billing_id)
 
+        # retry billing
+        rsp = http_cmd_req('{}/billing'.format(BASE_URL), billing, _headers=headers)
+        retried_billing_id = get_result(rsp)
+
+        # check result
+        self.assertEqual(billing_id, retried_billing_id)
+
     def test_f_unbilled_orders(self):
 
         # get unbilled orders